@@ -0,0 +1,1159 @@
+"""
+Бенчмарки бота. Запускаются вручную и не обращаются к Telegram:
+
+    python bench.py lsh --sizes 1000,10000,100000,1000000
+    python bench.py rules --extra-words 0,1000,10000
+    python bench.py ledger --users 100000 --posts-per-user 3
+    python bench.py images --sizes 1000,10000,100000,1000000
+    python bench.py search --sizes 10000,100000,300000
+    python bench.py load --users 500 --scenarios onboarding,albums,duplicates
+    python bench.py transport --pool-sizes 1,16,64,256 --requests 500
+    python bench.py logging --errors 5000 --write-latency 0.0005
+    python bench.py startup --posts 20000 --budget 1.5
+    python bench.py persistence --users 100000 --touched 2000 --changed 500
+
+startup — проверка регрессий: завершается с кодом 1, если холодный запуск
+до ответа на первый апдейт дольше бюджета.
+"""
+import argparse
+import asyncio
+import copy
+import functools
+import io
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timedelta
+
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+os.environ.setdefault("POST_STORE", "memory")
+os.environ.setdefault("DRAFT_PERSISTENCE", "0")
+
+import bot  # noqa: E402
+from telegram import Update  # noqa: E402
+from telegram.error import RetryAfter  # noqa: E402
+from telegram.ext import Application, ExtBot, PersistenceInput, PicklePersistence  # noqa: E402
+from PIL import Image  # noqa: E402
+
+ACTIONS = ["Продам", "Куплю", "Обменяю", "Продаю", "Покупка", "Продажа"]
+ITEMS = ["акк", "аккаунт", "донат", "пушки", "броню", "клан", "ресурсы", "кристаллы", "золото", "руны"]
+SYLLABLES = ["ка", "ро", "ми", "ла", "то", "не", "ва", "зу", "ры", "шо", "де", "пи", "ку", "со", "га"]
+
+def make_vocabulary(rng: random.Random, size: int) -> list[str]:
+    return ["".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))) for _ in range(size)]
+
+def make_ad(rng: random.Random, vocabulary: list[str], username: str | None = None) -> str:
+    """Синтетическое объявление: действие, предмет, описание, цена и контакт."""
+    words = rng.sample(vocabulary, rng.randint(10, 25))
+    username = username or f"seller_{rng.randint(10000, 99999)}"
+    return (
+        f"{rng.choice(ACTIONS)} {rng.choice(ITEMS)} {rng.randint(1, 120)} лвл, "
+        f"{' '.join(words)}. Цена {rng.randint(1, 500) * 10}₽. Контакты: @{username}"
+    )
+
+def make_near_copy(rng: random.Random, text: str) -> str:
+    """Перепост того же объявления с мелкой правкой (одно слово заменено)."""
+    words = text.split()
+    words[rng.randrange(2, len(words))] = "срочно"
+    return " ".join(words)
+
+def make_corpus(rng: random.Random, vocabulary: list[str], size: int) -> list[tuple[str, str]]:
+    """Корпус (текст, ник автора): в основном корректные объявления и типичные нарушения."""
+    corpus = []
+    for _ in range(size):
+        text = make_ad(rng, vocabulary)
+        username = text.rsplit("@", 1)[1]
+        kind = rng.random()
+        if kind < 0.05:
+            text = text.replace(f"@{username}", "")
+        elif kind < 0.1:
+            text = text.split(" ", 1)[1]
+        elif kind < 0.15:
+            text += " сука"
+        elif kind < 0.2:
+            text = text.upper()
+        elif kind < 0.25:
+            text += " пишите в @shop_helper_bot"
+        elif kind < 0.3:
+            text += " или @another_seller"
+        corpus.append((text, username))
+    return corpus
+
+def legacy_check_message(text: str, user_username: str, forbidden_words) -> tuple[bool, str]:
+    """check_message до перехода на MessageRules — эталон для сравнения."""
+    text_lower = text.lower()
+    user_username = (user_username or "").lower()
+    usernames = re.findall(r"@([a-zA-Z0-9_]{5,})", text)
+    if not usernames:
+        return False, "❌ В сообщении отсутствует контактная информация (@username)."
+    actions = ["продам", "обмен", "куплю", "продаю", "обменяю", "покупка", "продажа", "#офтоп", "#оффтоп"]
+    if not any(action in text_lower for action in actions):
+        return False, "❌ Укажите действие: продам/куплю/обмен"
+    if any(word in text_lower for word in forbidden_words):
+        return False, "❌ Обнаружен мат. Уберите его."
+    if len(text) > 10 and (sum(c.isupper() for c in text) / len(text) > 0.7):
+        return False, "❌ Слишком много текста в верхнем регистре (капс)."
+    if re.search(r"@[a-zA-Z0-9_]*bot\b", text_lower):
+        return False, "❌ Упоминания ботов запрещены."
+    for username in usernames:
+        username_lower = username.lower()
+        if username_lower.endswith("bot"):
+            continue
+        if username_lower not in [user_username, "vardges_grigoryan"]:
+            return False, f"❌ Упоминание @{username} запрещено. Укажите свой контакт (@ваш_ник)."
+    return True, "✅ Сообщение соответствует требованиям."
+
+def bench_rules(args):
+    rng = random.Random(args.seed)
+    vocabulary = make_vocabulary(rng, 20000)
+    corpus = make_corpus(rng, vocabulary, args.messages)
+    print(f"{'слов мата':>10} {'старая, мкс':>12} {'MessageRules, мкс':>18} {'расхождений':>12}")
+    for extra in (int(value) for value in args.extra_words.split(",")):
+        # Расширенный список: реальные слова плюс сгенерированные, которых нет в корпусе
+        forbidden_words = set(bot.FORBIDDEN_WORDS) | {f"{word}ъъ" for word in make_vocabulary(rng, extra)}
+        rules = bot.MessageRules(bot.ACTION_WORDS, forbidden_words, [bot.ADMIN_USERNAME])
+
+        began = time.perf_counter()
+        legacy = [legacy_check_message(text, username, forbidden_words) for text, username in corpus]
+        legacy_us = (time.perf_counter() - began) / len(corpus) * 1e6
+
+        began = time.perf_counter()
+        compiled = [rules.check(text, username) for text, username in corpus]
+        compiled_us = (time.perf_counter() - began) / len(corpus) * 1e6
+
+        mismatches = sum(old != new for old, new in zip(legacy, compiled))
+        print(f"{len(forbidden_words):>10} {legacy_us:>12.1f} {compiled_us:>18.1f} {mismatches:>12}")
+
+def bench_lsh(args):
+    rng = random.Random(args.seed)
+    vocabulary = make_vocabulary(rng, 20000)
+    lookups = args.lookups
+    print(f"{'постов':>10} {'вставка, мкс':>14} {'поиск p50, мкс':>16} {'поиск p99, мкс':>16} {'найдено/ожидалось':>18}")
+    for size in (int(value) for value in args.sizes.split(",")):
+        index = bot.DuplicateIndex(bot.DUPLICATE_WINDOW, bot.DUPLICATE_THRESHOLD)
+        now = datetime.now()
+        start = now - timedelta(hours=23)
+        step = timedelta(hours=23) / size
+        texts = []
+
+        began = time.perf_counter()
+        for i in range(size):
+            text = make_ad(rng, vocabulary)
+            index.add(i, text, start + step * i)
+            if i % max(size // lookups, 1) == 0:
+                texts.append(text)
+        insert_us = (time.perf_counter() - began) / size * 1e6
+
+        # Половина запросов — новые объявления, половина — перепосты уже проиндексированных
+        queries = [make_ad(rng, vocabulary) for _ in range(lookups // 2)]
+        originals = rng.sample(texts, min(lookups // 2, len(texts)))
+        copies = [make_near_copy(rng, text) for text in originals]
+        expected = sum(
+            bot.jaccard_similarity(bot.token_hashes(copy), bot.token_hashes(text)) >= bot.DUPLICATE_THRESHOLD
+            for copy, text in zip(copies, originals)
+        )
+        queries += copies
+        timings = []
+        found = 0
+        for query in queries:
+            began = time.perf_counter()
+            match = index.find_similar(query, now)
+            timings.append((time.perf_counter() - began) * 1e6)
+            found += match is not None
+        timings.sort()
+        p50 = statistics.median(timings)
+        p99 = timings[int(len(timings) * 0.99) - 1]
+        print(f"{size:>10} {insert_us:>14.1f} {p50:>16.1f} {p99:>16.1f} {found:>7}/{expected:<6}")
+
+def calculate_similarity(text1: str, text2: str) -> float:
+    """Прежняя схожесть двух текстов (0.0 - 1.0) по общим словам (для сравнения)."""
+    if not text1 or not text2:
+        return 0.0
+
+    # Приводим к нижнему регистру и убираем лишние пробелы
+    text1 = text1.lower().strip()
+    text2 = text2.lower().strip()
+
+    if text1 == text2:
+        return 1.0
+
+    # Простой алгоритм схожести на основе общих слов
+    words1 = set(text1.split())
+    words2 = set(text2.split())
+
+    if not words1 or not words2:
+        return 0.0
+
+    intersection = words1.intersection(words2)
+    union = words1.union(words2)
+
+    return len(intersection) / len(union) if union else 0.0
+
+def legacy_check_limit_and_duplicates(user_posts: dict, user_id: int, text: str) -> bool:
+    """Прежняя проверка по словарю user_posts с полными текстами (для сравнения)."""
+    now = datetime.now()
+    entry = user_posts.get(user_id)
+    if entry is None:
+        return True
+    if entry["date"] == now.date() and entry["count"] >= bot.DAILY_POST_LIMIT:
+        return False
+    for post_text, posted_at in entry["posts"]:
+        if now - posted_at < timedelta(days=1) and calculate_similarity(text, post_text) >= 0.9:
+            return False
+    return True
+
+def make_posts(args, now: datetime):
+    rng = random.Random(args.seed)
+    vocabulary = make_vocabulary(rng, 20000)
+    for user_id in range(args.users):
+        for _ in range(args.posts_per_user):
+            yield user_id, make_ad(rng, vocabulary), now - timedelta(hours=rng.uniform(0, 30))
+
+def bench_ledger(args):
+    now = datetime.now()
+    rng = random.Random(args.seed + 1)
+    vocabulary = make_vocabulary(rng, 20000)
+    queries = [(rng.randrange(args.users), make_ad(rng, vocabulary)) for _ in range(args.checks)]
+
+    # Тексты генерируются внутри замера: user_posts их хранит, журнал — только отпечатки
+    tracemalloc.start()
+    user_posts = {}
+    for user_id, text, posted_at in make_posts(args, now):
+        entry = user_posts.setdefault(user_id, {"posts": [], "count": 0, "date": posted_at.date()})
+        if entry["date"] != posted_at.date():
+            entry["count"], entry["date"] = 0, posted_at.date()
+        entry["posts"].append([text, posted_at])
+        entry["count"] += 1
+    legacy_mb = tracemalloc.get_traced_memory()[0] / 2**20
+    tracemalloc.stop()
+
+    shop = bot.shops[0]
+    tracemalloc.start()
+    shop.post_ledger = bot.PostLedger(bot.DUPLICATE_WINDOW)
+    for user_id, text, posted_at in make_posts(args, now):
+        shop.post_ledger.add(user_id, bot.token_hashes(text), posted_at.timestamp())
+    ledger_mb = tracemalloc.get_traced_memory()[0] / 2**20
+    tracemalloc.stop()
+
+    started = time.perf_counter()
+    for user_id, text in queries:
+        legacy_check_limit_and_duplicates(user_posts, user_id, text)
+    legacy_us = (time.perf_counter() - started) / len(queries) * 1e6
+
+    # Глобальный индекс к журналу не относится, его проверка отключена
+    check_global_duplicates = bot.check_global_duplicates
+    bot.check_global_duplicates = lambda shop, text, now: (True, "")
+    try:
+        started = time.perf_counter()
+        for user_id, text in queries:
+            bot.check_post_limit_and_duplicates(shop, user_id, text)
+        ledger_us = (time.perf_counter() - started) / len(queries) * 1e6
+    finally:
+        bot.check_global_duplicates = check_global_duplicates
+
+    started = time.perf_counter()
+    evicted = shop.post_ledger.sweep(now.timestamp())
+    sweep_ms = (time.perf_counter() - started) * 1e3
+
+    print(f"{'':<12} {'память, МБ':>11} {'проверка, мкс':>14}")
+    print(f"{'user_posts':<12} {legacy_mb:>11.1f} {legacy_us:>14.1f}")
+    print(f"{'PostLedger':<12} {ledger_mb:>11.1f} {ledger_us:>14.1f}")
+    print(f"sweep: {sweep_ms:.1f} мс, выброшено {evicted} пользователей, осталось {len(shop.post_ledger)}")
+
+@functools.lru_cache(maxsize=4096)
+def render_photo(seed: str, upload: str = "", size: int = 90) -> bytes:
+    """
+    JPEG-«скриншот»: крупные случайные блоки, заданные seed. Повторные загрузки
+    (upload) того же изображения отличаются качеством сжатия, как в Telegram.
+    """
+    rng = random.Random(seed)
+    image = Image.new("L", (8, 8))
+    image.putdata([rng.randrange(256) for _ in range(64)])
+    image = image.resize((size, size), Image.Resampling.BILINEAR)
+    output = io.BytesIO()
+    image.save(output, "JPEG", quality=random.Random(upload).randint(60, 95))
+    return output.getvalue()
+
+class SyntheticPhotoFetcher:
+    """
+    Замена TelegramPhotoFetcher без сети. Изображение задаёт часть file_id до «#»:
+    file_id с одинаковым началом — это повторные загрузки одного и того же скриншота.
+    """
+
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    async def fetch(self, bot, file_id: str) -> bytes:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        seed, _, upload = file_id.partition("#")
+        return render_photo(seed, upload)
+
+def random_hash(rng: random.Random) -> int:
+    return rng.getrandbits(bot.IMAGE_HASH_BITS)
+
+def flip_bits(rng: random.Random, value: int, count: int) -> int:
+    for bit in rng.sample(range(bot.IMAGE_HASH_BITS), count):
+        value ^= 1 << bit
+    return value
+
+def bench_images(args):
+    rng = random.Random(args.seed)
+
+    # Стоимость отпечатка одной маленькой копии (90x90, как самый маленький PhotoSize)
+    photo = render_photo("bench", "upload")
+    began = time.perf_counter()
+    for _ in range(1000):
+        bot.dhash(photo)
+    print(f"dHash 90x90 JPEG: {(time.perf_counter() - began) * 1000:.1f} мкс")
+    print(f"повторная загрузка: расстояние {(bot.dhash(photo) ^ bot.dhash(render_photo('bench', 'other'))).bit_count()} бит")
+
+    print(f"{'постов':>10} {'вставка, мкс':>14} {'поиск p50, мкс':>16} {'поиск p99, мкс':>16} {'найдено/ожидалось':>18}")
+    for size in (int(value) for value in args.sizes.split(",")):
+        index = bot.ImageIndex(bot.DUPLICATE_WINDOW, args.distance)
+        now = datetime.now()
+        start = now - timedelta(hours=23)
+        step = timedelta(hours=23) / size
+        stored = []
+
+        began = time.perf_counter()
+        for i in range(size):
+            hashes = tuple(random_hash(rng) for _ in range(rng.randint(1, 5)))
+            index.add(i, hashes, start + step * i)
+            if i % max(size // args.lookups, 1) == 0:
+                stored.append(hashes[0])
+        insert_us = (time.perf_counter() - began) / size * 1e6
+
+        # Половина запросов — новые изображения, половина — перезагрузки уже проиндексированных
+        queries = [random_hash(rng) for _ in range(args.lookups // 2)]
+        copies = [flip_bits(rng, value, rng.randint(0, args.distance)) for value in stored[:args.lookups // 2]]
+        queries += copies
+        timings = []
+        found = 0
+        for query in queries:
+            began = time.perf_counter()
+            match = index.find_similar((query,), now)
+            timings.append((time.perf_counter() - began) * 1e6)
+            found += match is not None
+        timings.sort()
+        p50 = statistics.median(timings)
+        p99 = timings[int(len(timings) * 0.99) - 1]
+        print(f"{size:>10} {insert_us:>14.1f} {p50:>16.1f} {p99:>16.1f} {found:>7}/{len(copies):<6}")
+
+def make_search_queries(rng: random.Random, vocabulary: list[str], count: int) -> list[str]:
+    """Запросы покупателей: предмет, иногда действие, слово описания и потолок цены."""
+    queries = []
+    for _ in range(count):
+        parts = [rng.choice(ITEMS)]
+        if rng.random() < 0.5:
+            parts.insert(0, rng.choice(ACTIONS).lower())
+        if rng.random() < 0.3:
+            parts.append(rng.choice(vocabulary))
+        if rng.random() < 0.3:
+            parts.append(f"до {rng.randint(1, 500) * 10}")
+        queries.append(" ".join(parts))
+    return queries
+
+# Запрос, объявление, должно ли оно найтись — проверяются до замеров
+SEARCH_EXAMPLES = [
+    ("куплю акк до 500", "Куплю аккаунты до 500 руб", True),
+    ("куплю аккаунт", "Куплю аккаунты до 500 руб", True),
+    ("продам аккаунты", "Продам акк 80 лвл, цена 300", True),
+    ("продам кристы", "Продам кристаллы, 1000 за 100₽", True),
+    ("продам акк", "Куплю аккаунты до 500 руб", False),
+    ("куплю акк от 600", "Куплю аккаунты до 500 руб", False),
+]
+
+def check_search_examples() -> bool:
+    ok = True
+    for query, text, expected in SEARCH_EXAMPLES:
+        index = bot.SearchIndex(bot.SEARCH_WINDOW)
+        now = datetime.now()
+        index.add(text, 1, now)
+        terms, action, min_price, max_price = bot.parse_search_query(query)
+        if bool(index.search(terms, now, action, min_price, max_price)) != expected:
+            print(f"Запрос «{query}» {'не находит' if expected else 'находит'} «{text}»")
+            ok = False
+    return ok
+
+def bench_search(args):
+    if not check_search_examples():
+        return 1
+    rng = random.Random(args.seed)
+    vocabulary = make_vocabulary(rng, 20000)
+    queries = make_search_queries(rng, vocabulary, args.queries)
+    print(f"{'объявлений':>10} {'сборка, с':>10} {'запрос p50, мс':>15} {'запрос p99, мс':>15} {'найдено в ср.':>14}")
+    for size in (int(value) for value in args.sizes.split(",")):
+        now = datetime.now()
+        start = now - bot.SEARCH_WINDOW + timedelta(minutes=1)
+        step = (now - start) / size
+        posts = [(make_ad(rng, vocabulary), start + step * i) for i in range(size)]
+
+        # Сборка индекса — то же, что восстановление из хранилища при запуске
+        index = bot.SearchIndex(bot.SEARCH_WINDOW)
+        began = time.perf_counter()
+        for message_id, (text, posted_at) in enumerate(posts, 1):
+            index.add(text, message_id, posted_at)
+        build_s = time.perf_counter() - began
+
+        timings = []
+        found = 0
+        for query in queries:
+            began = time.perf_counter()
+            terms, action, min_price, max_price = bot.parse_search_query(query)
+            found += len(index.search(terms, now, action, min_price, max_price))
+            timings.append((time.perf_counter() - began) * 1000)
+        timings.sort()
+        p50 = statistics.median(timings)
+        p99 = timings[int(len(timings) * 0.99) - 1]
+        print(f"{size:>10} {build_s:>10.2f} {p50:>15.2f} {p99:>15.2f} {found / len(queries):>14.1f}")
+
+# ---------- Нагрузочный прогон хендлеров ----------
+BENCH_CHANNEL = {"id": -1001, "type": "channel", "username": bot.CHANNEL_ID.lstrip("@")}
+
+class FakeBot(ExtBot):
+    """
+    Бот без сети: вместо запросов к Bot API отвечает правдоподобными объектами
+    с задержкой latency. Отправки в канал с вероятностью retry_after_rate
+    завершаются RetryAfter. Пользователи из joining при первой проверке
+    каждого чата ещё не подписаны.
+    """
+
+    def __init__(self, latency: float, retry_after_rate: float, rng: random.Random):
+        super().__init__(token="0:bench")
+        with self._unfrozen():
+            self.latency = latency
+            self.retry_after_rate = retry_after_rate
+            self.rng = rng
+            self.calls: Counter = Counter()
+            self.channel_sends: Counter = Counter()
+            self.joining: set[int] = set()
+            self._checked: set[tuple[str, int]] = set()
+            self._message_ids = itertools.count(1)
+
+    def _message(self, chat_id) -> dict:
+        chat = BENCH_CHANNEL if chat_id == bot.CHANNEL_ID else {"id": chat_id, "type": "private"}
+        return {"message_id": next(self._message_ids), "date": int(time.time()), "chat": chat}
+
+    async def _do_post(self, endpoint: str, data: dict, **kwargs):
+        self.calls[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.rng.uniform(0.5, 1.5) * self.latency)
+
+        chat_id = data.get("chat_id")
+        if chat_id == bot.CHANNEL_ID and endpoint.startswith("send"):
+            if self.rng.random() < self.retry_after_rate:
+                raise RetryAfter(1)
+            self.channel_sends[endpoint] += 1
+
+        if endpoint == "getUpdates":
+            return []
+        if endpoint == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        if endpoint == "getChatMember":
+            user_id = data["user_id"]
+            key = (chat_id, user_id)
+            status = "member"
+            if user_id in self.joining and key not in self._checked:
+                self._checked.add(key)
+                status = "left"
+            return {"status": status, "user": make_user(user_id)}
+        if endpoint == "sendMediaGroup":
+            return [self._message(chat_id) for _ in data["media"]]
+        if endpoint == "sendPhoto":
+            file_id = f"sent_{next(self._message_ids)}"
+            photo = [{"file_id": file_id, "file_unique_id": file_id, "width": 90, "height": 90}]
+            return {**self._message(chat_id), "photo": photo}
+        if endpoint.startswith("send") or endpoint.startswith("edit"):
+            return self._message(chat_id)
+        return True
+
+def make_user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": "User", "username": f"seller_{user_id}"}
+
+class UpdateFactory:
+    def __init__(self):
+        self._ids = itertools.count(1)
+
+    def message(self, user_id: int, text: str | None = None, **fields) -> dict:
+        message = {
+            "message_id": next(self._ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": make_user(user_id),
+            **fields,
+        }
+        if text is not None:
+            message["text"] = text
+            if text.startswith("/"):
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": next(self._ids), "message": message}
+
+    def photo(self, user_id: int, index: int, image: str | None = None, **fields) -> dict:
+        """Фотография; image — какое изображение загружено (по умолчанию своё у каждой)."""
+        image = image or f"photo_{user_id}_{index}"
+        photo = [
+            {"file_id": f"{image}#thumb_{user_id}_{index}", "file_unique_id": f"t{user_id}_{index}", "width": 90, "height": 90},
+            {"file_id": f"{image}#{user_id}_{index}", "file_unique_id": f"u{user_id}_{index}", "width": 1280, "height": 1280},
+        ]
+        return self.message(user_id, photo=photo, **fields)
+
+    def callback(self, user_id: int, data: str) -> dict:
+        message = self.message(user_id, "Проверить подписку")["message"]
+        return {
+            "update_id": next(self._ids),
+            "callback_query": {
+                "id": str(next(self._ids)), "from": make_user(user_id), "chat_instance": "bench",
+                "data": data, "message": message,
+            },
+        }
+
+    def joined(self, user_id: int, chat: dict) -> dict:
+        user = make_user(user_id)
+        return {
+            "update_id": next(self._ids),
+            "chat_member": {
+                "chat": chat, "from": user, "date": int(time.time()),
+                "old_chat_member": {"status": "left", "user": user},
+                "new_chat_member": {"status": "member", "user": user},
+            },
+        }
+
+def onboarding_scenario(rng, vocabulary, users, factory, fake):
+    """Наплыв новых пользователей: /start, вступление в канал и беседу, «Проверить подписку»."""
+    fake.joining.update(users)
+    chat = {"id": -1002, "type": "supergroup", "username": bot.CHAT_ID.lstrip("@")}
+    updates = [factory.message(user_id, "/start") for user_id in users]
+    updates += [factory.joined(user_id, BENCH_CHANNEL) for user_id in users]
+    updates += [factory.joined(user_id, chat) for user_id in users]
+    updates += [factory.callback(user_id, "check_subscription") for user_id in users]
+    return updates
+
+def albums_scenario(rng, vocabulary, users, factory, fake):
+    """Черновики с альбомом из 5 фотографий и текстом объявления."""
+    updates = []
+    for user_id in users:
+        updates.append(factory.message(user_id, "📤 Разместить объявление"))
+        updates += [factory.photo(user_id, i, media_group_id=f"album_{user_id}") for i in range(5)]
+    updates += [factory.message(user_id, make_ad(rng, vocabulary, f"seller_{user_id}")) for user_id in users]
+    return updates
+
+def duplicates_scenario(rng, vocabulary, users, factory, fake):
+    """Перекупщики: 70% объявлений — перепосты десятка исходных с разных аккаунтов."""
+    originals = [make_ad(rng, vocabulary, "placeholder").rsplit(" Контакты:", 1)[0] for _ in range(10)]
+    updates = []
+    for user_id in users:
+        if rng.random() < 0.7:
+            text = f"{rng.choice(originals)} Контакты: @seller_{user_id}"
+        else:
+            text = make_ad(rng, vocabulary, f"seller_{user_id}")
+        updates.append(factory.message(user_id, "📤 Разместить объявление"))
+        updates.append(factory.message(user_id, text))
+    return updates
+
+def screenshots_scenario(rng, vocabulary, users, factory, fake):
+    """Перекупщики: 70% объявлений — один из десятка скриншотов с новой подписью."""
+    updates = []
+    for user_id in users:
+        image = f"screenshot_{rng.randrange(10)}" if rng.random() < 0.7 else None
+        caption = make_ad(rng, vocabulary, f"seller_{user_id}")
+        updates.append(factory.photo(user_id, 0, image, caption=caption))
+    return updates
+
+def flood_scenario(rng, vocabulary, users, factory, fake):
+    """Каждый десятый — спамер (30 сообщений и 20 фотографий подряд), остальные подают одно объявление."""
+    updates = []
+    for user_id in users:
+        updates.append(factory.message(user_id, "📤 Разместить объявление"))
+        if user_id % 10 == 0:
+            updates += [factory.message(user_id, make_ad(rng, vocabulary, f"seller_{user_id}")) for _ in range(30)]
+            updates += [factory.photo(user_id, i) for i in range(20)]
+        else:
+            updates.append(factory.message(user_id, make_ad(rng, vocabulary, f"seller_{user_id}")))
+    return updates
+
+SCENARIOS = {
+    "onboarding": onboarding_scenario,
+    "albums": albums_scenario,
+    "duplicates": duplicates_scenario,
+    "screenshots": screenshots_scenario,
+    "flood": flood_scenario,
+}
+
+def reset_bot_state(args) -> "bot.Shop":
+    """Каждый сценарий начинается с пустых кэшей, индекса и очереди публикаций; магазин работает круглосуточно."""
+    shop = bot.Shop.from_config({
+        "name": bot.DEFAULT_SHOP,
+        "token": os.environ["BOT_TOKEN"],
+        "channel_rate_per_minute": args.channel_rate,
+        "start_hour": 0,
+        "end_hour": 24,
+    })
+    bot.shops = [shop]
+    bot.post_store = bot.MemoryPostStore()
+    bot.membership_cache = bot.MembershipCache(bot.MEMBERSHIP_TTL, bot.MEMBERSHIP_NEGATIVE_TTL, bot.MEMBERSHIP_CACHE_SIZE)
+    bot.deferred_posts = bot.DeferredQueue(":memory:")
+    bot.image_hasher = bot.ImageHasher(SyntheticPhotoFetcher(args.latency), bot.IMAGE_HASH_WORKERS, bot.IMAGE_HASH_CACHE_SIZE)
+    bot.update_scheduler = bot.UserScheduler(args.concurrency, bot.UPDATE_BACKLOG)
+    bot.flood_limiter = bot.FloodLimiter(bot.FLOOD_LIMITS, bot.FLOOD_CACHE_SIZE)
+    bot.ALBUM_DEBOUNCE = args.album_debounce
+    return shop
+
+def flood_shed_total() -> float:
+    return sum(sample.value for metric in bot.FLOOD_SHED.collect() for sample in metric.samples)
+
+async def run_scenario(name: str, args) -> dict:
+    rng = random.Random(args.seed)
+    vocabulary = make_vocabulary(rng, 5000)
+    shop = reset_bot_state(args)
+    fake = FakeBot(args.latency, args.retry_after_rate, rng)
+    application = bot.build_application(shop, telegram_bot=fake)
+    users = list(range(1000, 1000 + args.users))
+    updates = [Update.de_json(data, fake) for data in SCENARIOS[name](rng, vocabulary, users, UpdateFactory(), fake)]
+
+    # Замеряем обработку апдейта хендлерами, а не постановку в очередь планировщика
+    latencies = []
+    process_update = Application.process_update
+
+    async def timed_process_update(self, update):
+        began = time.perf_counter()
+        try:
+            await process_update(self, update)
+        finally:
+            latencies.append(time.perf_counter() - began)
+
+    Application.process_update = timed_process_update
+
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    fake.calls.clear()
+    shed_before = flood_shed_total()
+
+    began = time.perf_counter()
+    for update in updates:
+        await application.update_queue.put(update)
+    await application.update_queue.join()
+    # Альбомы обрабатываются по таймеру (stop дожидается их задач), публикации — в фоне
+    await asyncio.sleep(args.album_debounce + 0.05)
+    await application.stop()
+    await shop.publisher.stop(timeout=3600)
+    elapsed = time.perf_counter() - began
+
+    await application.post_stop(application)
+    await application.shutdown()
+    Application.process_update = process_update
+
+    latencies.sort()
+
+    def percentile(p: float) -> float:
+        return latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000
+
+    published = sum(fake.channel_sends.values())
+    return {
+        "scenario": name,
+        "updates": len(updates),
+        "elapsed": elapsed,
+        "throughput": len(updates) / elapsed,
+        "p50": percentile(0.5),
+        "p95": percentile(0.95),
+        "p99": percentile(0.99),
+        "published": published,
+        "shed": int(flood_shed_total() - shed_before),
+        "calls_per_post": sum(fake.calls.values()) / published if published else float("nan"),
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+def bench_load(args):
+    logging.getLogger().setLevel(logging.WARNING)
+    if args.child:
+        print(json.dumps(asyncio.run(run_scenario(args.scenarios, args))), flush=True)
+        return
+
+    print(
+        f"{'сценарий':<12} {'апдейтов':>9} {'апд/с':>8} {'p50, мс':>8} {'p95, мс':>8} {'p99, мс':>8} "
+        f"{'постов':>7} {'отброшено':>10} {'вызовов/пост':>13} {'RSS, МБ':>8}"
+    )
+    # Каждый сценарий в своём процессе: ru_maxrss — пик за весь процесс, иначе
+    # сценарий унаследовал бы пик предыдущих
+    options = [
+        "--users", str(args.users), "--latency", str(args.latency), "--retry-after-rate", str(args.retry_after_rate),
+        "--channel-rate", str(args.channel_rate), "--album-debounce", str(args.album_debounce),
+        "--concurrency", str(args.concurrency), "--seed", str(args.seed),
+    ]
+    for name in args.scenarios.split(","):
+        command = [sys.executable, __file__, "load", "--child", "--scenarios", name, *options]
+        child = subprocess.run(command, stdout=subprocess.PIPE, text=True)
+        if child.returncode != 0:
+            print(f"Сценарий {name}: дочерний процесс завершился с ошибкой")
+            return 1
+        result = json.loads(child.stdout.splitlines()[-1])
+        print(
+            f"{result['scenario']:<12} {result['updates']:>9} {result['throughput']:>8.1f} "
+            f"{result['p50']:>8.2f} {result['p95']:>8.2f} {result['p99']:>8.2f} "
+            f"{result['published']:>7} {result['shed']:>10} {result['calls_per_post']:>13.1f} {result['peak_rss_mb']:>8.1f}"
+        )
+
+class PoolWaitRecorder:
+    """Подменяет гистограмму ожидания пула, чтобы считать точные перцентили."""
+
+    def __init__(self):
+        self.values = []
+
+    def observe(self, value: float):
+        self.values.append(value)
+
+def make_api_server(latency: float, poll: float):
+    """Локальный HTTP-сервер вместо api.telegram.org: отвечает с задержкой, getUpdates держит соединение poll секунд."""
+    import tornado.web
+
+    class MethodHandler(tornado.web.RequestHandler):
+        async def post(self, token: str, method: str):
+            await asyncio.sleep(poll if method == "getUpdates" else latency)
+            self.write({"ok": True, "result": [] if method == "getUpdates" else True})
+
+    server = tornado.web.Application([(r"/bot([^/]+)/(\w+)", MethodHandler)]).listen(0, "127.0.0.1")
+    port = next(iter(server._sockets.values())).getsockname()[1]
+    return server, f"http://127.0.0.1:{port}/bot0:bench"
+
+async def run_transport(pool_size: int, args) -> dict:
+    server, base_url = make_api_server(args.latency, args.poll)
+    api = bot.InstrumentedRequest(
+        "bench", pool_size, pool_size, bot.BOT_API_KEEPALIVE_EXPIRY, pool_timeout=args.pool_timeout
+    )
+    updates = api if args.shared_updates else bot.InstrumentedRequest("bench-updates", 1, 1, bot.BOT_API_KEEPALIVE_EXPIRY)
+    api._pool_wait = waits = PoolWaitRecorder()
+    await api.initialize()
+    await updates.initialize()
+
+    latencies = []
+    timeouts = 0
+
+    async def send(index: int):
+        nonlocal timeouts
+        began = time.perf_counter()
+        try:
+            await api.post(f"{base_url}/sendMessage")
+        except bot.TimedOut:
+            timeouts += 1
+        latencies.append(time.perf_counter() - began)
+
+    # Долгий опрос начинается раньше всплеска отправок и держит своё соединение
+    polling = [asyncio.create_task(updates.post(f"{base_url}/getUpdates", read_timeout=args.poll + 5))]
+    await asyncio.sleep(0.01)
+    began = time.perf_counter()
+    await asyncio.gather(*(send(index) for index in range(args.requests)))
+    elapsed = time.perf_counter() - began
+    await asyncio.gather(*polling)
+
+    await api.shutdown()
+    await updates.shutdown()
+    server.stop()
+
+    latencies.sort()
+    waits.values.sort()
+
+    def percentile(values: list[float], p: float) -> float:
+        return values[min(int(len(values) * p), len(values) - 1)] * 1000 if values else 0.0
+
+    return {
+        "pool": pool_size,
+        "elapsed": elapsed,
+        "p50": percentile(latencies, 0.5),
+        "p99": percentile(latencies, 0.99),
+        "wait_p99": percentile(waits.values, 0.99),
+        "timeouts": timeouts,
+    }
+
+def bench_transport(args):
+    logging.getLogger().setLevel(logging.WARNING)
+    print(
+        f"Всплеск {args.requests} запросов, ответ API {args.latency * 1000:.0f} мс, "
+        f"getUpdates {'в общем пуле' if args.shared_updates else 'в отдельном пуле'}"
+    )
+    print(f"{'пул':>5} {'время, с':>9} {'p50, мс':>8} {'p99, мс':>8} {'ожидание p99, мс':>17} {'таймаутов пула':>15}")
+    for pool_size in (int(size) for size in args.pool_sizes.split(",")):
+        result = asyncio.run(run_transport(pool_size, args))
+        print(
+            f"{result['pool']:>5} {result['elapsed']:>9.2f} {result['p50']:>8.1f} {result['p99']:>8.1f} "
+            f"{result['wait_p99']:>17.1f} {result['timeouts']:>15}"
+        )
+
+class SlowStream:
+    """Поток вывода, который блокирует каждую запись, как переполненный stdout или медленный сборщик логов."""
+
+    def __init__(self, write_latency: float):
+        self.write_latency = write_latency
+        self.writes = 0
+
+    def write(self, text: str):
+        time.sleep(self.write_latency)
+        self.writes += 1
+
+    def flush(self):
+        pass
+
+def make_log_setup(mode: str, stream: SlowStream):
+    """Обработчик корневого логгера: sync — прежний basicConfig, queue — очередь бота, с фильтром повторов или без."""
+    output = logging.StreamHandler(stream)
+    if mode == "sync":
+        output.setFormatter(logging.Formatter(bot.TEXT_LOG_FORMAT))
+        return output, None
+    output.setFormatter(bot.JsonFormatter())
+    handler = bot.LogQueueHandler(bot.Queue(bot.LOG_QUEUE_SIZE))
+    if mode == "queue+repeat":
+        handler.addFilter(bot.RepeatFilter(bot.LOG_REPEAT_BURST, bot.LOG_REPEAT_INTERVAL))
+    listener = bot.QueueListener(handler.queue, output)
+    listener.start()
+    return handler, listener
+
+async def run_log_storm(mode: str, args) -> dict:
+    stream = SlowStream(args.write_latency)
+    handler, listener = make_log_setup(mode, stream)
+    root = logging.getLogger()
+    saved_handlers, saved_level = root.handlers[:], root.level
+    root.handlers[:] = [handler]
+    root.setLevel(logging.INFO)
+
+    # Задержка цикла событий: насколько позже срока просыпается таймер в 1 мс
+    lags = []
+    running = True
+
+    async def probe():
+        while running:
+            began = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lags.append(time.perf_counter() - began - 0.001)
+
+    error = RuntimeError("Bad Gateway")
+    latencies = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def failing_check(user_id: int):
+        # Как check_subscriptions при недоступном getChatMember: ответ API и запись об ошибке
+        async with semaphore:
+            began = time.perf_counter()
+            await asyncio.sleep(args.latency)
+            if mode == "sync":
+                bot.logger.error(f"Ошибка проверки подписки на канал @shop: {error}")
+            else:
+                bot.logger.error(
+                    "Ошибка проверки подписки на канал %s: %s", "@shop", error, extra={"user_id": user_id}
+                )
+            latencies.append(time.perf_counter() - began)
+
+    prober = asyncio.create_task(probe())
+    began = time.perf_counter()
+    await asyncio.gather(*(failing_check(user_id) for user_id in range(args.errors)))
+    elapsed = time.perf_counter() - began
+    running = False
+    await prober
+
+    root.handlers[:], root.level = saved_handlers, saved_level
+    if listener is not None:
+        listener.stop()
+
+    lags.sort()
+    latencies.sort()
+
+    def percentile(values: list[float], p: float) -> float:
+        return values[min(int(len(values) * p), len(values) - 1)] * 1000
+
+    return {
+        "mode": mode,
+        "elapsed": elapsed,
+        "lag_p99": percentile(lags, 0.99),
+        "lag_max": lags[-1] * 1000,
+        "p99": percentile(latencies, 0.99),
+        "written": stream.writes,
+    }
+
+def bench_logging(args):
+    print(
+        f"{args.errors} ошибок getChatMember, запись в лог {args.write_latency * 1000:.2f} мс, "
+        f"{args.concurrency} проверок одновременно"
+    )
+    print(
+        f"{'режим':<14} {'время, с':>9} {'задержка цикла p99, мс':>23} {'макс, мс':>9} "
+        f"{'проверка p99, мс':>17} {'записано':>9}"
+    )
+    for mode in args.modes.split(","):
+        result = asyncio.run(run_log_storm(mode, args))
+        print(
+            f"{result['mode']:<14} {result['elapsed']:>9.2f} {result['lag_p99']:>23.1f} {result['lag_max']:>9.1f} "
+            f"{result['p99']:>17.1f} {result['written']:>9}"
+        )
+
+def seed_post_store(path: str, posts: int, seed: int):
+    """Хранилище, которое бот восстанавливает при запуске: объявления за окно поиска дубликатов."""
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(rng, 5000)
+    store = bot.SQLitePostStore(path, bot.POST_FLUSH_BATCH)
+    now = datetime.now()
+    for index in range(posts):
+        posted_at = now - timedelta(seconds=rng.uniform(0, bot.DUPLICATE_WINDOW.total_seconds()))
+        store.add_post(bot.DEFAULT_SHOP, 1000 + index % 5000, make_ad(rng, vocabulary), posted_at, index + 1)
+    store.close()
+
+async def run_startup_child(args):
+    """Холодный процесс: сборка приложений, запуск как в main() и ответ на первый /start."""
+    fake = FakeBot(args.latency, 0, random.Random(args.seed))
+    applications = [bot.build_application(shop, telegram_bot=fake) for shop in bot.shops]
+    bot.startup.mark("build")
+
+    async def no_updates(application):
+        # Апдейты кладёт сам бенчмарк, как webhook-сервер
+        pass
+
+    await bot.start_applications(applications, no_updates)
+    await applications[0].update_queue.put(Update.de_json(UpdateFactory().message(1000, "/start"), fake))
+    # Первый апдейт обработан, когда пользователь получил приветствие
+    while not fake.calls["sendPhoto"]:
+        await asyncio.sleep(0.001)
+    bot.startup.mark("first_update")
+    # Проверка объявлений ждёт восстановления индексов, которое идёт в фоне
+    await bot.shops[0].indexes_loaded()
+    bot.startup.mark("indexes")
+    print(json.dumps({"phases": bot.startup.phases, "elapsed": time.perf_counter() - bot.PROCESS_STARTED}), flush=True)
+    await bot.stop_applications(applications)
+
+def bench_startup(args):
+    if args.child:
+        asyncio.run(run_startup_child(args))
+        return
+
+    runs = []
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, "bot.db")
+        seed_post_store(db_path, args.posts, args.seed)
+        env = {
+            **os.environ,
+            "POST_STORE": "sqlite",
+            "DB_PATH": db_path,
+            "LOG_LEVEL": "WARNING",
+            "START_HOUR": "0",
+            "END_HOUR": "24",
+            "DRAFT_PERSISTENCE": "1",
+        }
+        command = [sys.executable, __file__, "startup", "--child", "--latency", str(args.latency), "--seed", str(args.seed)]
+        for _ in range(args.runs):
+            began = time.perf_counter()
+            child = subprocess.Popen(command, stdout=subprocess.PIPE, env=env, text=True)
+            line = child.stdout.readline()
+            wall = time.perf_counter() - began
+            if child.wait() != 0 or not line:
+                print("Дочерний процесс завершился с ошибкой")
+                return 1
+            result = json.loads(line)
+            # Время от запуска интерпретатора до ответа на первый апдейт: загрузка индексов идёт после
+            runs.append({**result, "wall": wall - result["phases"]["indexes"]})
+
+    phases = list(runs[0]["phases"])
+    print(f"Холодный запуск, {args.posts} объявлений в хранилище, ответ API {args.latency * 1000:.0f} мс")
+    print(" ".join(f"{phase:>13}" for phase in phases) + f" {'до апдейта, с':>14}")
+    for run in runs:
+        print(" ".join(f"{run['phases'][phase]:>13.3f}" for phase in phases) + f" {run['wall']:>14.3f}")
+
+    wall = statistics.median(run["wall"] for run in runs)
+    if wall > args.budget:
+        print(f"Медиана {wall:.3f} с больше бюджета {args.budget:.3f} с")
+        return 1
+    print(f"Медиана {wall:.3f} с в пределах бюджета {args.budget:.3f} с")
+
+def make_draft(rng: random.Random, vocabulary: list[str], user_id: int) -> dict:
+    photos = [f"photo_{user_id}_{index}" for index in range(rng.randint(0, 5))]
+    return {
+        "awaiting_post": True,
+        "post_photos": photos,
+        "post_thumbnails": {photo: f"thumb_{photo}" for photo in photos},
+        "post_text": make_ad(rng, vocabulary),
+    }
+
+def written_bytes() -> int:
+    """Байты, переданные процессом в write() (Linux, /proc/self/io)."""
+    with open("/proc/self/io") as io_stats:
+        for line in io_stats:
+            if line.startswith("wchar:"):
+                return int(line.split()[1])
+    return 0
+
+def file_size(path: str) -> int:
+    return sum(os.path.getsize(name) for name in (path, path + "-wal") if os.path.exists(name))
+
+async def run_persistence(backend: str, path: str, args) -> dict:
+    rng = random.Random(args.seed)
+    vocabulary = make_vocabulary(rng, 5000)
+    user_data = {user_id: make_draft(rng, vocabulary, user_id) for user_id in range(args.users)}
+
+    def make_persistence():
+        if backend == "sqlite":
+            return bot.SQLitePersistence(path, bot.DEFAULT_SHOP, bot.DRAFT_TTL, bot.DRAFT_FLUSH_INTERVAL)
+        persistence = PicklePersistence(
+            path, store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False), on_flush=True
+        )
+        persistence.set_bot(ExtBot(token="0:bench"))
+        return persistence
+
+    async def write(persistence):
+        # Как Application.update_persistence: раз в интервал, затем запись пачки
+        if backend == "sqlite":
+            persistence.write_pending()
+        else:
+            await persistence.flush()
+
+    persistence = make_persistence()
+    for user_id, data in user_data.items():
+        await persistence.update_user_data(user_id, copy.deepcopy(data))
+    await write(persistence)
+
+    flushes = []
+    written = 0
+    users = list(user_data)
+    for _ in range(args.intervals):
+        # PTB передаёт копии user_data всех, кто получал апдейты; черновик поменялся у части из них
+        touched = rng.sample(users, args.touched)
+        for user_id in touched[:args.changed]:
+            user_data[user_id]["post_text"] = make_ad(rng, vocabulary)
+        copies = [(user_id, copy.deepcopy(user_data[user_id])) for user_id in touched]
+        bytes_before = written_bytes()
+        began = time.perf_counter()
+        for user_id, data in copies:
+            await persistence.update_user_data(user_id, data)
+        await write(persistence)
+        flushes.append(time.perf_counter() - began)
+        written += written_bytes() - bytes_before
+    if backend == "sqlite":
+        await persistence.flush()
+
+    # Перезапуск: загрузка черновиков новым экземпляром
+    began = time.perf_counter()
+    restored = await make_persistence().get_user_data()
+    restore = time.perf_counter() - began
+    assert len(restored) == args.users
+
+    flushes.sort()
+    return {
+        "backend": backend,
+        "p50": flushes[len(flushes) // 2] * 1000,
+        "max": flushes[-1] * 1000,
+        "written_mb": written / args.intervals / 2**20,
+        "size_mb": file_size(path) / 2**20,
+        "restore": restore,
+    }
+
+def bench_persistence(args):
+    print(
+        f"{args.users} черновиков, за интервал апдейты у {args.touched} пользователей, "
+        f"черновик изменён у {args.changed}, интервалов {args.intervals}"
+    )
+    print(
+        f"{'хранилище':<10} {'запись p50, мс':>15} {'макс, мс':>9} {'записано за интервал, МБ':>25} "
+        f"{'файл, МБ':>9} {'загрузка, с':>12}"
+    )
+    with tempfile.TemporaryDirectory() as directory:
+        for backend in ("sqlite", "pickle"):
+            result = asyncio.run(run_persistence(backend, os.path.join(directory, backend), args))
+            print(
+                f"{result['backend']:<10} {result['p50']:>15.1f} {result['max']:>9.1f} "
+                f"{result['written_mb']:>25.2f} {result['size_mb']:>9.1f} {result['restore']:>12.2f}"
+            )
+    print("pickle — PicklePersistence(on_flush=True) со сбросом раз в интервал; с on_flush=False файл переписывается на каждое изменение")
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки Mrush1 Bot")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    lsh = subparsers.add_parser("lsh", help="поиск похожих объявлений в глобальном индексе")
+    lsh.add_argument("--sizes", default="1000,10000,100000,1000000")
+    lsh.add_argument("--lookups", type=int, default=2000)
+    lsh.add_argument("--seed", type=int, default=1)
+    lsh.set_defaults(func=bench_lsh)
+
+    rules = subparsers.add_parser("rules", help="check_message против скомпилированных MessageRules")
+    rules.add_argument("--extra-words", default="0,100,1000,10000")
+    rules.add_argument("--messages", type=int, default=20000)
+    rules.add_argument("--seed", type=int, default=1)
+    rules.set_defaults(func=bench_rules)
+
+    ledger = subparsers.add_parser("ledger", help="память и скорость журнала постов против user_posts")
+    ledger.add_argument("--users", type=int, default=100000)
+    ledger.add_argument("--posts-per-user", type=int, default=3)
+    ledger.add_argument("--checks", type=int, default=20000)
+    ledger.add_argument("--seed", type=int, default=1)
+    ledger.set_defaults(func=bench_ledger)
+
+    images = subparsers.add_parser("images", help="поиск похожих изображений в индексе dHash")
+    images.add_argument("--sizes", default="1000,10000,100000,1000000")
+    images.add_argument("--lookups", type=int, default=2000)
+    images.add_argument("--distance", type=int, default=bot.IMAGE_HASH_DISTANCE)
+    images.add_argument("--seed", type=int, default=1)
+    images.set_defaults(func=bench_images)
+
+    search = subparsers.add_parser("search", help="сборка поискового индекса и запросы /search")
+    search.add_argument("--sizes", default="10000,100000,300000")
+    search.add_argument("--queries", type=int, default=2000)
+    search.add_argument("--seed", type=int, default=1)
+    search.set_defaults(func=bench_search)
+
+    load = subparsers.add_parser("load", help="прогон синтетических апдейтов через хендлеры приложения")
+    load.add_argument("--scenarios", default=",".join(SCENARIOS))
+    load.add_argument("--users", type=int, default=500)
+    load.add_argument("--latency", type=float, default=0.05, help="задержка ответа Bot API, с")
+    load.add_argument("--retry-after-rate", type=float, default=0.01)
+    load.add_argument("--channel-rate", type=int, default=60000, help="лимит публикаций в минуту (в Telegram ~20)")
+    load.add_argument("--album-debounce", type=float, default=0.2)
+    load.add_argument("--concurrency", type=int, default=bot.UPDATE_CONCURRENCY, help="пользователей одновременно")
+    load.add_argument("--seed", type=int, default=1)
+    load.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    load.set_defaults(func=bench_load)
+
+    transport = subparsers.add_parser("transport", help="задержки запросов к Bot API при разных размерах пула")
+    transport.add_argument("--pool-sizes", default="1,16,64,256")
+    transport.add_argument("--requests", type=int, default=500)
+    transport.add_argument("--latency", type=float, default=0.05, help="задержка ответа Bot API, с")
+    transport.add_argument("--poll", type=float, default=1.0, help="сколько getUpdates держит соединение, с")
+    transport.add_argument("--pool-timeout", type=float, default=bot.BOT_API_POOL_TIMEOUT)
+    transport.add_argument("--shared-updates", action="store_true", help="getUpdates в том же пуле, как раньше")
+    transport.set_defaults(func=bench_transport)
+
+    logs = subparsers.add_parser("logging", help="задержка цикла событий при шквале ошибок в логе")
+    logs.add_argument("--modes", default="sync,queue,queue+repeat")
+    logs.add_argument("--errors", type=int, default=5000)
+    logs.add_argument("--write-latency", type=float, default=0.0005, help="время одной записи в поток вывода, с")
+    logs.add_argument("--latency", type=float, default=0.02, help="задержка ответа Bot API, с")
+    logs.add_argument("--concurrency", type=int, default=bot.UPDATE_CONCURRENCY)
+    logs.set_defaults(func=bench_logging)
+
+    startup = subparsers.add_parser("startup", help="холодный запуск до первого апдейта против бюджета")
+    startup.add_argument("--posts", type=int, default=20000, help="объявлений в восстанавливаемом хранилище")
+    startup.add_argument("--runs", type=int, default=5)
+    startup.add_argument("--budget", type=float, default=1.5, help="допустимая медиана, с")
+    startup.add_argument("--latency", type=float, default=0.05, help="задержка ответа Bot API, с")
+    startup.add_argument("--seed", type=int, default=1)
+    startup.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    startup.set_defaults(func=bench_startup)
+
+    persistence = subparsers.add_parser("persistence", help="черновики: SQLitePersistence против PicklePersistence")
+    persistence.add_argument("--users", type=int, default=100000)
+    persistence.add_argument("--touched", type=int, default=2000, help="пользователей с апдейтами за интервал")
+    persistence.add_argument("--changed", type=int, default=500, help="из них с изменённым черновиком")
+    persistence.add_argument("--intervals", type=int, default=20)
+    persistence.add_argument("--seed", type=int, default=1)
+    persistence.set_defaults(func=bench_persistence)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,267 +1,2583 @@
+import time
+
+# Отсчёт времени от запуска процесса — до остальных импортов, чтобы учесть и их
+PROCESS_STARTED = time.perf_counter()
+
+import abc
+import asyncio
+import atexit
+import hashlib
+import hmac
+import html
+import inspect
+import io
+import json
 import logging
 import re
 import os
+import random
+import signal
+import sqlite3
 import threading
-from datetime import datetime, timedelta
+from array import array
+from bisect import bisect_left
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, time as dtime, timedelta
+from functools import lru_cache, partial, wraps
+from itertools import combinations
+from logging.handlers import QueueHandler, QueueListener
+from queue import Full, Queue
+from zoneinfo import ZoneInfo
+
+from telegram import (
+    Update,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    ReplyKeyboardMarkup,
+    KeyboardButton,
+    InputMediaPhoto
+)
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError, TimedOut
+from telegram.request import BaseRequest, HTTPXRequest
+from telegram.ext import (
+    Application,
+    BasePersistence,
+    PersistenceInput,
+    CommandHandler,
+    MessageHandler,
+    CallbackQueryHandler,
+    ApplicationHandlerStop,
+    ChatMemberHandler,
+    ContextTypes,
+    TypeHandler,
+    filters,
+)
+from dotenv import load_dotenv
+import httpx
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, disable_created_metrics, generate_latest
+from tornado.httpserver import HTTPServer
+import tornado.web
+
+# ---------- Профиль запуска ----------
+class StartupProfiler:
+    """
+    Длительность фаз запуска: mark(фаза) относит к фазе время с предыдущей отметки,
+    report() пишет сводку в лог и в метрики bot_startup_phase_seconds.
+    """
+
+    def __init__(self, started: float):
+        self.phases: dict[str, float] = {}
+        self._last = started
+
+    def mark(self, phase: str):
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self._last
+        self._last = now
+
+    def report(self):
+        for phase, seconds in self.phases.items():
+            STARTUP_PHASE.labels(phase).set(seconds)
+        logger.info(
+            "Запуск за %.2f с: %s",
+            sum(self.phases.values()),
+            ", ".join(f"{phase} {seconds:.3f} с" for phase, seconds in self.phases.items()),
+        )
+
+startup = StartupProfiler(PROCESS_STARTED)
+startup.mark("imports")
+
+# ---------- Логирование ----------
+# Настройки логирования тоже могут прийти из .env
+load_dotenv()
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# "json" — одна запись JSON в строке, "text" — прежний формат для чтения глазами
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+TEXT_LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+# Записи ждут фонового потока в очереди; не поместившиеся отбрасываются
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+# Предупреждения и ошибки с одним шаблоном сообщения: столько пишется за интервал (с),
+# остальные пропускаются, их число попадает в первую запись следующего интервала
+LOG_REPEAT_BURST = int(os.getenv("LOG_REPEAT_BURST", 5))
+LOG_REPEAT_INTERVAL = float(os.getenv("LOG_REPEAT_INTERVAL", 60))
+# Доля вызовов хендлеров, для которых пишется запись с пользователем и временем работы
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", 0.01))
+# Поля из extra, которые выносятся в JSON отдельными ключами
+LOG_FIELDS = ("shop", "user_id", "handler", "latency_ms", "reason", "suppressed")
+
+LOG_DROPPED = Counter("bot_log_dropped_total", "Записи лога, не поместившиеся в очередь")
+LOG_SUPPRESSED = Counter("bot_log_suppressed_total", "Повторяющиеся записи лога, пропущенные ограничителем")
+
+class JsonFormatter(logging.Formatter):
+    """Запись лога одной строкой JSON."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in LOG_FIELDS:
+            value = record.__dict__.get(field)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class RepeatFilter(logging.Filter):
+    """
+    Ограничивает повторы предупреждений и ошибок. Повтором считается тот же логгер,
+    уровень, шаблон сообщения и тип исключения: аргументы не учитываются, поэтому
+    сбой getChatMember для тысячи пользователей — одна и та же ошибка.
+    """
+
+    def __init__(self, burst: int, interval: float, max_size: int = 1024):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self.max_size = max_size
+        # ключ -> [начало интервала, записано, пропущено]
+        self._windows: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING:
+            return True
+        key = (record.name, record.levelno, str(record.msg), record.exc_info[0] if record.exc_info else None)
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.pop(key, None)
+            if window is None or now - window[0] >= self.interval:
+                if window is not None and window[2]:
+                    record.suppressed = window[2]
+                window = [now, 0, 0]
+            self._windows[key] = window
+            if len(self._windows) > self.max_size:
+                del self._windows[next(iter(self._windows))]
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+            window[2] += 1
+        LOG_SUPPRESSED.inc()
+        return False
+
+class LogQueueHandler(QueueHandler):
+    """
+    Кладёт запись в очередь, которую разбирает поток QueueListener: форматирование
+    и запись в поток вывода не занимают цикл событий. При переполненной очереди
+    запись отбрасывается, а не блокирует отправителя.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Очередь внутри процесса: сообщение форматирует фоновый поток
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            LOG_DROPPED.inc()
+
+def make_log_formatter() -> logging.Formatter:
+    return JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(TEXT_LOG_FORMAT)
+
+def configure_logging(stream=None) -> QueueListener:
+    """Корневой логгер пишет через очередь, вывод в stream (по умолчанию stderr) — в фоновом потоке."""
+    output = logging.StreamHandler(stream)
+    output.setFormatter(make_log_formatter())
+    handler = LogQueueHandler(Queue(LOG_QUEUE_SIZE))
+    handler.addFilter(RepeatFilter(LOG_REPEAT_BURST, LOG_REPEAT_INTERVAL))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(LOG_LEVEL)
+    listener = QueueListener(handler.queue, output)
+    listener.start()
+    # Дописываем оставшиеся записи при выходе
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = configure_logging()
+logger = logging.getLogger(__name__)
+# Каждый апдейт в режиме webhook — это HTTP-запрос; не пишем их все в лог
+logging.getLogger("tornado.access").setLevel(logging.WARNING)
+
+# ---------- Конфигурация ----------
+TOKEN = os.getenv("BOT_TOKEN")
+# Несколько магазинов в одном процессе: JSON-список настроек (см. Shop.from_config).
+# Без него единственный магазин настраивается переменными окружения ниже.
+SHOPS_PATH = os.getenv("SHOPS_PATH")
+if not TOKEN and not SHOPS_PATH:
+    raise ValueError("BOT_TOKEN не найден в переменных окружения!")
+
+# Режим работы: "webhook" (по умолчанию, если задан WEBHOOK_URL) или "polling"
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+BOT_MODE = os.getenv("BOT_MODE", "webhook" if WEBHOOK_URL else "polling")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+PORT = int(os.getenv("PORT", 8000))
+
+# Транспорт Bot API: отдельные пулы соединений для getUpdates (у каждого бота свой)
+# и для остальных запросов (общий для всех магазинов)
+BOT_API_POOL_SIZE = int(os.getenv("BOT_API_POOL_SIZE", 256))
+BOT_API_UPDATES_POOL_SIZE = int(os.getenv("BOT_API_UPDATES_POOL_SIZE", 2))
+# Сколько простаивающих соединений держать открытыми и как долго (секунды)
+BOT_API_KEEPALIVE = int(os.getenv("BOT_API_KEEPALIVE", BOT_API_POOL_SIZE))
+BOT_API_KEEPALIVE_EXPIRY = float(os.getenv("BOT_API_KEEPALIVE_EXPIRY", 30))
+# "1.1" или "2" (HTTP/2 нужен пакет python-telegram-bot[http2])
+BOT_API_HTTP_VERSION = os.getenv("BOT_API_HTTP_VERSION", "1.1")
+BOT_API_CONNECT_TIMEOUT = float(os.getenv("BOT_API_CONNECT_TIMEOUT", 5))
+BOT_API_READ_TIMEOUT = float(os.getenv("BOT_API_READ_TIMEOUT", 5))
+BOT_API_WRITE_TIMEOUT = float(os.getenv("BOT_API_WRITE_TIMEOUT", 5))
+BOT_API_POOL_TIMEOUT = float(os.getenv("BOT_API_POOL_TIMEOUT", 5))
+# Таймауты отдельных методов, "метод=чтение:запись": загрузка медиа идёт дольше
+BOT_API_METHOD_TIMEOUTS = {
+    method.strip(): tuple(float(value) for value in timeouts.split(":"))
+    for method, timeouts in (
+        item.split("=") for item in
+        os.getenv("BOT_API_METHOD_TIMEOUTS", "sendPhoto=20:30,sendDocument=20:30,sendMediaGroup=30:60").split(",")
+    )
+}
+
+# Типы апдейтов, которые обрабатывают хендлеры бота
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY, Update.CHAT_MEMBER]
+
+# После перезапуска обработать накопившиеся апдейты, а не выбрасывать их:
+# не старше CATCH_UP_MAX_AGE секунд, не больше CATCH_UP_CONCURRENCY пользователей одновременно
+CATCH_UP = os.getenv("CATCH_UP", "1") == "1"
+CATCH_UP_MAX_AGE = int(os.getenv("CATCH_UP_MAX_AGE", 3600))
+CATCH_UP_CONCURRENCY = int(os.getenv("CATCH_UP_CONCURRENCY", 16))
+
+# Настройки ниже — значения по умолчанию для магазинов из SHOPS_PATH
+# Канал (обязательная подписка)
+CHANNEL_ID = os.getenv("CHANNEL_ID", "@shop_mrush1")
+# Беседа (обязательное участие)
+CHAT_ID = "@chat_mrush1"  # Публичная супергруппа (см. https://t.me/chat_mrush1)
+
+# Часы работы в часовом поясе BOT_TIMEZONE (не зависят от пояса сервера)
+TIMEZONE = ZoneInfo(os.getenv("BOT_TIMEZONE", "Europe/Moscow"))
+TIMEZONE_LABEL = os.getenv("BOT_TIMEZONE_LABEL", "МСК")
+START_HOUR = int(os.getenv("START_HOUR", 8))
+END_HOUR = int(os.getenv("END_HOUR", 23))
+
+# Объявления, принятые в нерабочее время, выходят после START_HOUR
+# равномерно в течение DEFERRED_RELEASE_WINDOW секунд
+DEFERRED_RELEASE_WINDOW = int(os.getenv("DEFERRED_RELEASE_WINDOW", 3600))
+
+FORBIDDEN_WORDS = {"сука", "блять", "пиздец", "хуй", "ебать"}
+ACTION_WORDS = ["продам", "обмен", "куплю", "продаю", "обменяю", "покупка", "продажа", "#офтоп", "#оффтоп"]
+ADMIN_USERNAME = "vardges_grigoryan"
+RULES_URL = os.getenv("RULES_URL", "https://t.me/shop_mrush1/13")
+
+# Файл с правилами модерации (JSON), переопределяет списки выше:
+# {"actions": [...], "forbidden_words": [...], "allowed_contacts": [...],
+#  "caps_ratio": 0.7, "caps_min_length": 10}
+RULES_PATH = os.getenv("RULES_PATH")
+ALLOWED_IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif"}
+
+# Время жизни кэша подписок (секунды): подтверждённое членство и отказ
+MEMBERSHIP_TTL = int(os.getenv("MEMBERSHIP_TTL", 600))
+MEMBERSHIP_NEGATIVE_TTL = int(os.getenv("MEMBERSHIP_NEGATIVE_TTL", 30))
+MEMBERSHIP_CACHE_SIZE = int(os.getenv("MEMBERSHIP_CACHE_SIZE", 50000))
+
+MEMBER_STATUSES = ("member", "administrator", "creator")
+
+# Лимиты публикаций
+DAILY_POST_LIMIT = 3
+DUPLICATE_WINDOW = timedelta(days=1)
+
+# Повторы изображений: допустимое расстояние Хэмминга между dHash (из 64 бит),
+# потоки для декодирования и число запомненных отпечатков по file_id
+IMAGE_HASH_DISTANCE = int(os.getenv("IMAGE_HASH_DISTANCE", 6))
+IMAGE_HASH_WORKERS = int(os.getenv("IMAGE_HASH_WORKERS", 2))
+IMAGE_HASH_CACHE_SIZE = int(os.getenv("IMAGE_HASH_CACHE_SIZE", 10000))
+
+# Сколько секунд ждать следующую фотографию альбома (media_group_id)
+ALBUM_DEBOUNCE = float(os.getenv("ALBUM_DEBOUNCE", 1.0))
+
+# Параллельная обработка апдейтов: сколько пользователей одновременно
+# и сколько апдейтов может ждать, прежде чем приём новых приостановится
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", 64))
+UPDATE_BACKLOG = int(os.getenv("UPDATE_BACKLOG", 1000))
+
+# Анти-флуд: token bucket на пользователя и вид апдейта, "вид=запас:токенов_в_секунду".
+# Виды: message — текст, media — фото и картинки (запас не меньше альбома из 10),
+# command — команды, callback — нажатия inline-кнопок
+FLOOD_CONTROL = os.getenv("FLOOD_CONTROL", "1") == "1"
+FLOOD_LIMITS = {
+    kind.strip(): tuple(float(value) for value in limit.split(":"))
+    for kind, limit in (
+        item.split("=") for item in
+        os.getenv("FLOOD_LIMITS", "message=5:0.5,media=10:0.5,command=3:0.2,callback=6:1").split(",")
+    )
+}
+FLOOD_CACHE_SIZE = int(os.getenv("FLOOD_CACHE_SIZE", 100000))
+
+# Публикация в канал: Telegram допускает ~20 сообщений в минуту в один чат
+CHANNEL_RATE_PER_MINUTE = int(os.getenv("CHANNEL_RATE_PER_MINUTE", 20))
+CHANNEL_BURST = int(os.getenv("CHANNEL_BURST", 5))
+PUBLISH_MAX_ATTEMPTS = int(os.getenv("PUBLISH_MAX_ATTEMPTS", 5))
+
+# Запускать сетевые проверки объявления параллельно, а не по одной
+VALIDATE_NETWORK_CONCURRENTLY = os.getenv("VALIDATE_NETWORK_CONCURRENTLY", "1") == "1"
+
+# Как часто выбрасывать из журнала постов пользователей без постов за сутки (секунды)
+LEDGER_SWEEP_INTERVAL = int(os.getenv("LEDGER_SWEEP_INTERVAL", 600))
+
+# Поиск (/search) по объявлениям за SEARCH_WINDOW_DAYS дней
+SEARCH_WINDOW = timedelta(days=int(os.getenv("SEARCH_WINDOW_DAYS", 7)))
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", 5))
+SEARCH_MAX_RESULTS = int(os.getenv("SEARCH_MAX_RESULTS", 200))
+SEARCH_COMPACT_INTERVAL = int(os.getenv("SEARCH_COMPACT_INTERVAL", 600))
+
+# Хранилище истории постов: "sqlite" (по умолчанию) или "memory"
+POST_STORE = os.getenv("POST_STORE", "sqlite")
+DB_PATH = os.getenv("DB_PATH", "bot.db")
+POST_FLUSH_BATCH = int(os.getenv("POST_FLUSH_BATCH", 20))
+POST_FLUSH_INTERVAL = int(os.getenv("POST_FLUSH_INTERVAL", 5))
+# Посты нужны и для дубликатов, и для поиска — храним их дольше из двух окон
+POST_RETENTION = max(DUPLICATE_WINDOW, SEARCH_WINDOW)
+# Магазин из переменных окружения; ему же достаются посты баз, созданных до магазинов
+DEFAULT_SHOP = "default"
+# Черновики объявлений переживают перезапуск: изменения пишутся в SQLite пачкой раз в интервал (с)
+DRAFT_PERSISTENCE = os.getenv("DRAFT_PERSISTENCE", "1") == "1"
+DRAFT_FLUSH_INTERVAL = float(os.getenv("DRAFT_FLUSH_INTERVAL", 10))
+# Черновик, не менявшийся дольше этого, считается брошенным и удаляется
+DRAFT_TTL = timedelta(hours=float(os.getenv("DRAFT_TTL_HOURS", 24)))
+DRAFT_SWEEP_INTERVAL = int(os.getenv("DRAFT_SWEEP_INTERVAL", 3600))
+
+# Простое меню бота
+MAIN_MENU = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton("📤 Разместить объявление")],
+        [KeyboardButton("❓ Помощь")],
+    ],
+    resize_keyboard=True,
+)
+
+def subscribe_check_keyboard(channel_id: str, chat_id: str) -> InlineKeyboardMarkup:
+    """Inline-кнопки для быстрого перехода и проверки (ссылки есть только у публичных @чатов)."""
+    buttons = [
+        [InlineKeyboardButton(f"{label} {chat_ref}", url=f"https://t.me/{chat_ref[1:]}")]
+        for label, chat_ref in (("Канал", channel_id), ("Беседа", chat_id))
+        if chat_ref.startswith("@")
+    ]
+    buttons.append([InlineKeyboardButton("Проверить подписку", callback_data="check_subscription")])
+    return InlineKeyboardMarkup(buttons)
+
+# ---------- Метрики ----------
+disable_created_metrics()
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+HANDLER_LATENCY = Histogram("bot_handler_latency_seconds", "Время работы хендлера", ["handler"], buckets=LATENCY_BUCKETS)
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Исключения в хендлерах", ["handler", "error"])
+API_LATENCY = Histogram("bot_api_latency_seconds", "Время запроса к Bot API", ["method"], buckets=LATENCY_BUCKETS)
+API_ERRORS = Counter("bot_api_errors_total", "Ошибки запросов к Bot API", ["method", "error"])
+API_POOL_WAIT = Histogram("bot_api_pool_wait_seconds", "Ожидание соединения в пуле Bot API", ["pool"], buckets=LATENCY_BUCKETS)
+API_POOL_IN_USE = Gauge("bot_api_pool_in_use", "Запросы к Bot API в работе (занятые соединения)", ["pool"])
+API_POOL_SIZE = Gauge("bot_api_pool_size", "Размер пулов соединений Bot API", ["pool"])
+API_POOL_TIMEOUTS = Counter("bot_api_pool_timeouts_total", "Запросы, не дождавшиеся соединения в пуле", ["pool"])
+REJECTIONS = Counter("bot_post_rejections_total", "Отклонённые объявления по причинам", ["reason"])
+PUBLISH_QUEUE_DEPTH = Gauge("bot_publish_queue_depth", "Объявления в очереди на публикацию")
+UPDATE_QUEUE_DEPTH = Gauge("bot_update_queue_depth", "Апдейты, ожидающие обработки")
+ALBUM_BUFFERS = Gauge("bot_album_buffers", "Альбомы, ожидающие последней фотографии")
+MEMBERSHIP_CACHE_HITS = Counter("bot_membership_cache_hits_total", "Попадания в кэш подписок")
+VALIDATOR_RUNS = Counter("bot_validator_runs_total", "Запуски шагов проверки объявления", ["stage"])
+VALIDATOR_REJECTIONS = Counter("bot_validator_rejections_total", "Отказы шагов проверки объявления", ["stage"])
+MEMBERSHIP_CACHE_MISSES = Counter("bot_membership_cache_misses_total", "Промахи кэша подписок")
+CATCH_UP_UPDATES = Counter("bot_catch_up_updates_total", "Апдейты, накопившиеся за время перезапуска", ["outcome"])
+DRAFT_ROWS_WRITTEN = Counter("bot_draft_rows_written_total", "Строки черновиков, записанные или удалённые в SQLite")
+DRAFT_FLUSH_LATENCY = Histogram("bot_draft_flush_seconds", "Запись пачки изменённых черновиков", buckets=LATENCY_BUCKETS)
+DRAFTS_EXPIRED = Counter("bot_drafts_expired_total", "Брошенные черновики, удалённые по DRAFT_TTL")
+TIME_TO_READY = Gauge("bot_time_to_ready_seconds", "Время от запуска процесса до готовности")
+STARTUP_PHASE = Gauge("bot_startup_phase_seconds", "Длительность фаз запуска процесса", ["phase"])
+FLOOD_SHED = Counter("bot_flood_shed_total", "Апдейты, отброшенные анти-флудом", ["kind"])
+FLOOD_WARNINGS = Counter("bot_flood_warnings_total", "Предупреждения о флуде", ["kind"])
+FLOOD_BUCKETS = Gauge("bot_flood_buckets", "Пользователи, отслеживаемые анти-флудом")
+
+PUBLISH_QUEUE_DEPTH.set_function(lambda: sum(shop.publisher.depth for shop in shops))
+UPDATE_QUEUE_DEPTH.set_function(
+    lambda: sum(shop.application.update_queue.qsize() for shop in shops if shop.application is not None)
+)
+ALBUM_BUFFERS.set_function(lambda: len(album_buffers))
+UPDATE_SCHEDULER_BACKLOG = Gauge("bot_update_scheduler_backlog", "Апдейты, принятые планировщиком и не обработанные")
+UPDATE_SCHEDULER_BACKLOG.set_function(lambda: update_scheduler.pending)
+FLOOD_BUCKETS.set_function(lambda: len(flood_limiter))
+
+def reject(reason: str, message: str) -> tuple[bool, str]:
+    """Отказ в публикации с учётом причины в метриках."""
+    REJECTIONS.labels(reason).inc()
+    return False, message
+
+def instrument_handler(callback):
+    """Оборачивает хендлер: время работы и исключения попадают в метрики."""
+    name = callback.__name__
+    latency = HANDLER_LATENCY.labels(name)
+
+    @wraps(callback)
+    async def wrapper(update, context):
+        began = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except ApplicationHandlerStop:
+            raise
+        except Exception as e:
+            HANDLER_ERRORS.labels(name, type(e).__name__).inc()
+            raise
+        finally:
+            elapsed = time.perf_counter() - began
+            latency.observe(elapsed)
+            if random.random() < LOG_SAMPLE_RATE:
+                user = update.effective_user
+                logger.info(
+                    "Хендлер %s: %.1f мс", name, elapsed * 1000,
+                    extra={
+                        "shop": shop_of(context).name,
+                        "user_id": user.id if user else None,
+                        "handler": name,
+                        "latency_ms": round(elapsed * 1000, 2),
+                    },
+                )
+
+    return wrapper
+
+class InstrumentedRequest(HTTPXRequest):
+    """
+    HTTPXRequest, замеряющий время и ошибки каждого метода Bot API, ожидание
+    соединения в пуле и его занятость (метрики с меткой pool). method_timeouts —
+    таймауты (чтение, запись) отдельных методов: бот не задаёт таймауты в вызовах,
+    поэтому они заменяют значения по умолчанию PTB.
+    """
+
+    def __init__(
+        self,
+        pool: str,
+        connection_pool_size: int,
+        keepalive: int,
+        keepalive_expiry: float,
+        method_timeouts: dict[str, tuple[float, float]] | None = None,
+        **kwargs,
+    ):
+        self.pool = pool
+        self.method_timeouts = method_timeouts or {}
+        self._limits = httpx.Limits(
+            max_connections=connection_pool_size,
+            max_keepalive_connections=min(keepalive, connection_pool_size),
+            keepalive_expiry=keepalive_expiry,
+        )
+        self._pool_wait = API_POOL_WAIT.labels(pool)
+        self._in_use = API_POOL_IN_USE.labels(pool)
+        self._pool_timeouts = API_POOL_TIMEOUTS.labels(pool)
+        API_POOL_SIZE.labels(pool).inc(connection_pool_size)
+        super().__init__(connection_pool_size=connection_pool_size, **kwargs)
+
+    def _build_client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            **{**self._client_kwargs, "limits": self._limits, "event_hooks": {"request": [self._trace_pool_wait]}}
+        )
+
+    async def _trace_pool_wait(self, request: httpx.Request):
+        # Соединение из пула получено, когда началось подключение или отправка запроса
+        began = time.perf_counter()
+        waiting = True
+
+        async def trace(event_name: str, info: dict):
+            nonlocal waiting
+            if waiting and event_name.endswith(".started"):
+                waiting = False
+                self._pool_wait.observe(time.perf_counter() - began)
+
+        request.extensions["trace"] = trace
+
+    async def do_request(self, *args, **kwargs):
+        self._in_use.inc()
+        try:
+            return await super().do_request(*args, **kwargs)
+        except TimedOut as e:
+            if isinstance(e.__cause__, httpx.PoolTimeout):
+                self._pool_timeouts.inc()
+            raise
+        finally:
+            self._in_use.dec()
+
+    async def post(
+        self,
+        url: str,
+        request_data=None,
+        read_timeout=BaseRequest.DEFAULT_NONE,
+        write_timeout=BaseRequest.DEFAULT_NONE,
+        connect_timeout=BaseRequest.DEFAULT_NONE,
+        pool_timeout=BaseRequest.DEFAULT_NONE,
+    ):
+        method = url.rsplit("/", 1)[-1]
+        if method in self.method_timeouts:
+            read_timeout, write_timeout = self.method_timeouts[method]
+        began = time.perf_counter()
+        try:
+            return await super().post(url, request_data, read_timeout, write_timeout, connect_timeout, pool_timeout)
+        except Exception as e:
+            API_ERRORS.labels(method, type(e).__name__).inc()
+            raise
+        finally:
+            API_LATENCY.labels(method).observe(time.perf_counter() - began)
+
+def create_api_request() -> InstrumentedRequest:
+    """Пул для всех запросов, кроме getUpdates."""
+    return InstrumentedRequest(
+        "api",
+        BOT_API_POOL_SIZE,
+        BOT_API_KEEPALIVE,
+        BOT_API_KEEPALIVE_EXPIRY,
+        BOT_API_METHOD_TIMEOUTS,
+        connect_timeout=BOT_API_CONNECT_TIMEOUT,
+        read_timeout=BOT_API_READ_TIMEOUT,
+        write_timeout=BOT_API_WRITE_TIMEOUT,
+        pool_timeout=BOT_API_POOL_TIMEOUT,
+        http_version=BOT_API_HTTP_VERSION,
+    )
+
+def create_updates_request() -> InstrumentedRequest:
+    """Пул getUpdates: долгий опрос не занимает соединения, нужные для отправки."""
+    return InstrumentedRequest(
+        "updates",
+        BOT_API_UPDATES_POOL_SIZE,
+        BOT_API_UPDATES_POOL_SIZE,
+        BOT_API_KEEPALIVE_EXPIRY,
+        connect_timeout=BOT_API_CONNECT_TIMEOUT,
+        read_timeout=BOT_API_READ_TIMEOUT,
+        write_timeout=BOT_API_WRITE_TIMEOUT,
+        pool_timeout=BOT_API_POOL_TIMEOUT,
+        http_version=BOT_API_HTTP_VERSION,
+    )
+
+# ---------- Анти-флуд ----------
+class FloodBucket:
+    __slots__ = ("tokens", "updated", "warned")
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+        self.warned = False
+
+class FloodLimiter:
+    """
+    Token bucket на пару (пользователь, вид апдейта) без ожидания: апдейт либо проходит,
+    либо отбрасывается. Первый отброшенный апдейт получает предупреждение ("warn"),
+    следующие — тишину ("drop"), пока в ведре снова не появится токен.
+    Ведра хранятся в порядке последнего обращения; сверх max_size выбрасываются
+    самые давние — к тому времени они обычно уже полные, то есть ничего не теряется.
+    """
+
+    def __init__(self, limits: dict[str, tuple[float, float]], max_size: int):
+        self.limits = limits
+        self.max_size = max_size
+        self._buckets: dict[tuple[object, str], FloodBucket] = {}
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def check(self, user, kind: str, now: float | None = None) -> str:
+        """user — ключ пользователя, в боте это (магазин, user_id)."""
+        limit = self.limits.get(kind)
+        if limit is None:
+            return "pass"
+        burst, rate = limit
+        now = time.monotonic() if now is None else now
+        key = (user, kind)
+        bucket = self._buckets.pop(key, None)
+        if bucket is None:
+            bucket = FloodBucket(burst, now)
+        else:
+            bucket.tokens = min(burst, bucket.tokens + (now - bucket.updated) * rate)
+            bucket.updated = now
+        self._buckets[key] = bucket
+        if len(self._buckets) > self.max_size:
+            del self._buckets[next(iter(self._buckets))]
+
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            bucket.warned = False
+            return "pass"
+        if bucket.warned:
+            return "drop"
+        bucket.warned = True
+        return "warn"
+
+flood_limiter = FloodLimiter(FLOOD_LIMITS, FLOOD_CACHE_SIZE)
+
+FLOOD_WARNING = "⏳ Слишком много сообщений подряд. Подождите немного — пока лишние сообщения не обрабатываются."
+
+def flood_kind(update: Update) -> str | None:
+    """Вид апдейта для анти-флуда; None — апдейт не ограничивается."""
+    if update.callback_query is not None:
+        return "callback"
+    msg = update.message
+    if msg is None:
+        return None
+    if msg.photo or msg.document:
+        return "media"
+    if msg.text and msg.text.startswith("/"):
+        return "command"
+    return "message"
+
+async def flood_guard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Группа -1: отбрасывает апдейты флудящего пользователя до основных хендлеров."""
+    user = update.effective_user
+    kind = flood_kind(update)
+    if user is None or kind is None:
+        return
+    # Накопившееся за перезапуск пришло разом не по вине пользователя (см. catch_up)
+    if context.bot_data.get("catching_up"):
+        return
+    shop = shop_of(context)
+    verdict = flood_limiter.check((shop.name, user.id), kind)
+    if verdict == "pass":
+        return
+
+    FLOOD_SHED.labels(kind).inc()
+    if verdict == "warn":
+        FLOOD_WARNINGS.labels(kind).inc()
+        logger.info(
+            "Анти-флуд: пользователь %s превысил лимит (%s)", user.id, kind,
+            extra={"shop": shop.name, "user_id": user.id, "reason": f"flood_{kind}"},
+        )
+        try:
+            if update.callback_query is not None:
+                await update.callback_query.answer(FLOOD_WARNING)
+            else:
+                await update.message.reply_text(FLOOD_WARNING)
+        except TelegramError as e:
+            logger.warning(
+                "Не удалось предупредить о флуде пользователя %s: %s", user.id, e,
+                extra={"shop": shop.name, "user_id": user.id},
+            )
+    raise ApplicationHandlerStop
+
+# ---------- Кэш подписок ----------
+class MembershipCache:
+    """
+    Кэш статусов участника в обязательных чатах: (chat_ref, user_id) -> status.
+    Подтверждённое членство живёт ttl секунд, отказ — negative_ttl.
+    """
+
+    def __init__(self, ttl: int, negative_ttl: int, max_size: int):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries: dict[tuple[str, int], tuple[str, float]] = {}
+
+    def get(self, chat_ref: str, user_id: int) -> str | None:
+        entry = self._entries.get((chat_ref, user_id))
+        if entry is not None and entry[1] > time.monotonic():
+            self.hits += 1
+            MEMBERSHIP_CACHE_HITS.inc()
+            return entry[0]
+        if entry is not None:
+            del self._entries[(chat_ref, user_id)]
+        self.misses += 1
+        MEMBERSHIP_CACHE_MISSES.inc()
+        return None
+
+    def set(self, chat_ref: str, user_id: int, status: str):
+        ttl = self.ttl if status in MEMBER_STATUSES else self.negative_ttl
+        if ttl <= 0:
+            return
+        key = (chat_ref, user_id)
+        self._entries.pop(key, None)
+        self._entries[key] = (status, time.monotonic() + ttl)
+        if len(self._entries) > self.max_size:
+            self._evict()
+
+    def invalidate(self, chat_ref: str, user_id: int):
+        self._entries.pop((chat_ref, user_id), None)
+
+    def _evict(self):
+        # Сначала выбрасываем просроченные записи, затем самые старые
+        now = time.monotonic()
+        for key in [k for k, (_, expires) in self._entries.items() if expires <= now]:
+            del self._entries[key]
+        while len(self._entries) > self.max_size:
+            del self._entries[next(iter(self._entries))]
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "size": len(self._entries),
+        }
+
+membership_cache = MembershipCache(MEMBERSHIP_TTL, MEMBERSHIP_NEGATIVE_TTL, MEMBERSHIP_CACHE_SIZE)
+
+def required_chat_ref(shop: "Shop", chat) -> str | None:
+    """Сопоставляет чат из апдейта с каналом / беседой магазина (по @username или числовому id)."""
+    candidates = {str(chat.id)}
+    if chat.username:
+        candidates.add(f"@{chat.username}".lower())
+    for chat_ref in (shop.channel_id, shop.chat_id):
+        if chat_ref.lower() in candidates:
+            return chat_ref
+    return None
+
+async def get_member_status(context: ContextTypes.DEFAULT_TYPE, chat_ref: str, user_id: int) -> str:
+    status = membership_cache.get(chat_ref, user_id)
+    if status is None:
+        member = await context.bot.get_chat_member(chat_id=chat_ref, user_id=user_id)
+        status = member.status
+        membership_cache.set(chat_ref, user_id, status)
+    return status
+
+async def check_subscriptions(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> tuple[bool, str]:
+    """
+    Проверяет, состоит ли пользователь в обязательном канале и беседе.
+    Возвращает (True, '') при успехе либо (False, текст_ошибки).
+    Статусы берутся из кэша, при промахе оба запроса выполняются параллельно.
+    """
+    shop = shop_of(context)
+    channel_result, chat_result = await asyncio.gather(
+        get_member_status(context, shop.channel_id, user_id),
+        get_member_status(context, shop.chat_id, user_id),
+        return_exceptions=True,
+    )
+
+    # Сначала проверяем канал (ростер должен быть public, например @shop_mrush1)
+    if isinstance(channel_result, Exception):
+        logger.error(
+            "Ошибка проверки подписки на канал %s: %s", shop.channel_id, channel_result,
+            extra={"shop": shop.name, "user_id": user_id},
+        )
+        return False, "❌ Произошла ошибка при проверке подписки на канал."
+    if channel_result == "kicked":
+        return False, "❌ Вы были заблокированы в канале и не можете использовать бота."
+    if channel_result not in MEMBER_STATUSES:
+        return False, "❌ Вы не подписаны на основной канал."
+
+    # Затем проверяем беседу (должна быть публичной супергруппой, например @chat_mrush1)
+    if isinstance(chat_result, Exception):
+        logger.error(
+            "Ошибка проверки участия в беседе %s: %s", shop.chat_id, chat_result,
+            extra={"shop": shop.name, "user_id": user_id},
+        )
+        return False, "❌ Произошла ошибка при проверке вашего статуса в беседе."
+    if chat_result == "kicked":
+        return False, "❌ Вы были заблокированы в беседе и не можете использовать бота."
+    if chat_result not in MEMBER_STATUSES:
+        return False, "❌ Вы не состоите в обязательной беседе."
+
+    return True, ""
+
+# ---------- Хранилище постов ----------
+class PostStore(abc.ABC):
+    """
+    Интерфейс хранилища опубликованных постов. Проверки идут по PostLedger
+    в памяти, хранилище нужно, чтобы восстановить его после перезапуска.
+    Хранилище одно на все магазины, посты помечены именем магазина.
+    """
+
+    @abc.abstractmethod
+    def iter_posts(self, shop: str, since: datetime):
+        """Все посты магазина новее since в порядке публикации: (user_id, text, posted_at, message_id в канале)."""
+
+    @abc.abstractmethod
+    def add_post(self, shop: str, user_id: int, text: str, posted_at: datetime, message_id: int | None = None):
+        """Сохраняет опубликованный пост магазина."""
+
+    def iter_images(self, shop: str, since: datetime):
+        """Отпечатки изображений постов магазина новее since: (user_id, hashes, posted_at)."""
+        return iter(())
+
+    def add_images(self, shop: str, user_id: int, hashes: tuple[int, ...], posted_at: datetime):
+        pass
+
+    def prune(self, older_than: datetime):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+class MemoryPostStore(PostStore):
+    """Ничего не сохраняет: история постов живёт только в PostLedger до перезапуска."""
+
+    def iter_posts(self, shop: str, since: datetime):
+        return iter(())
+
+    def add_post(self, shop: str, user_id: int, text: str, posted_at: datetime, message_id: int | None = None):
+        pass
+
+class SQLitePostStore(PostStore):
+    """
+    Хранит посты в SQLite (WAL). Новые посты копятся в буфере и записываются
+    пачкой: при заполнении буфера или по таймеру (flush).
+    """
+
+    def __init__(self, path: str, batch_size: int):
+        self.batch_size = batch_size
+        self._pending: list[tuple[str, int, str, float, int | None]] = []
+        self._pending_images: list[tuple[str, int, str, float]] = []
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS posts (
+                user_id INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                posted_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_posts_user_time ON posts (user_id, posted_at);
+            CREATE INDEX IF NOT EXISTS idx_posts_time ON posts (posted_at);
+            CREATE TABLE IF NOT EXISTS post_images (
+                user_id INTEGER NOT NULL,
+                hashes TEXT NOT NULL,
+                posted_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_post_images_time ON post_images (posted_at);
+            """
+        )
+        # Базы, созданные до поиска, не хранили сообщение в канале
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(posts)")}
+        if "message_id" not in columns:
+            self._conn.execute("ALTER TABLE posts ADD COLUMN message_id INTEGER")
+        # ...и не делились на магазины: их посты достаются магазину по умолчанию
+        for table in ("posts", "post_images"):
+            if "shop" not in {row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")}:
+                self._conn.execute(f"ALTER TABLE {table} ADD COLUMN shop TEXT NOT NULL DEFAULT '{DEFAULT_SHOP}'")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_posts_shop_time ON posts (shop, posted_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_post_images_shop_time ON post_images (shop, posted_at)")
+        self._conn.commit()
+
+    def iter_posts(self, shop: str, since: datetime):
+        self.flush()
+        rows = self._conn.execute(
+            "SELECT user_id, text, posted_at, message_id FROM posts WHERE shop = ? AND posted_at >= ? ORDER BY posted_at",
+            (shop, since.timestamp()),
+        )
+        for user_id, text, ts, message_id in rows:
+            yield user_id, text, datetime.fromtimestamp(ts), message_id
+
+    def add_post(self, shop: str, user_id: int, text: str, posted_at: datetime, message_id: int | None = None):
+        self._pending.append((shop, user_id, text, posted_at.timestamp(), message_id))
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def iter_images(self, shop: str, since: datetime):
+        self.flush()
+        rows = self._conn.execute(
+            "SELECT user_id, hashes, posted_at FROM post_images WHERE shop = ? AND posted_at >= ? ORDER BY posted_at",
+            (shop, since.timestamp()),
+        )
+        for user_id, hashes, ts in rows:
+            yield user_id, tuple(int(value, 16) for value in hashes.split(",")), datetime.fromtimestamp(ts)
+
+    def add_images(self, shop: str, user_id: int, hashes: tuple[int, ...], posted_at: datetime):
+        self._pending_images.append((shop, user_id, ",".join(f"{value:016x}" for value in hashes), posted_at.timestamp()))
+        if len(self._pending_images) >= self.batch_size:
+            self.flush()
+
+    def prune(self, older_than: datetime):
+        self.flush()
+        with self._conn:
+            self._conn.execute("DELETE FROM posts WHERE posted_at < ?", (older_than.timestamp(),))
+            self._conn.execute("DELETE FROM post_images WHERE posted_at < ?", (older_than.timestamp(),))
+
+    def flush(self):
+        if not self._pending and not self._pending_images:
+            return
+        with self._conn:
+            self._conn.executemany(
+                "INSERT INTO posts (shop, user_id, text, posted_at, message_id) VALUES (?, ?, ?, ?, ?)", self._pending
+            )
+            self._conn.executemany(
+                "INSERT INTO post_images (shop, user_id, hashes, posted_at) VALUES (?, ?, ?, ?)", self._pending_images
+            )
+        self._pending.clear()
+        self._pending_images.clear()
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+
+def create_post_store() -> PostStore:
+    if POST_STORE == "memory":
+        return MemoryPostStore()
+    if POST_STORE == "sqlite":
+        return SQLitePostStore(DB_PATH, POST_FLUSH_BATCH)
+    raise ValueError(f"Неизвестное хранилище постов: {POST_STORE}")
+
+post_store = create_post_store()
+
+# ---------- Глобальный индекс похожих объявлений ----------
+# MinHash по множеству слов + LSH: кандидаты ищутся по совпадению полос сигнатуры,
+# затем проверяются точным коэффициентом Жаккара по множествам слов (jaccard_similarity).
+MINHASH_PERMUTATIONS = 64
+LSH_BANDS = 8
+DUPLICATE_THRESHOLD = 0.9
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_minhash_rng = random.Random(1)
+_MINHASH_PARAMS = [
+    (_minhash_rng.randrange(1, _MERSENNE_PRIME), _minhash_rng.randrange(0, _MERSENNE_PRIME))
+    for _ in range(MINHASH_PERMUTATIONS)
+]
+
+def token_hashes(text: str) -> array:
+    """Отпечаток текста: отсортированные хэши уникальных слов в нижнем регистре."""
+    return array("q", sorted({hash(word) for word in text.lower().split()}))
+
+@lru_cache(maxsize=65536)
+def _token_minhash(token_hash: int) -> tuple[int, ...]:
+    return tuple((a * token_hash + b) % _MERSENNE_PRIME for a, b in _MINHASH_PARAMS)
+
+def minhash_signature(hashes: array) -> tuple[int, ...]:
+    return tuple(map(min, zip(*map(_token_minhash, hashes))))
+
+def jaccard_similarity(hashes1: array, hashes2: array) -> float:
+    set1, set2 = set(hashes1), set(hashes2)
+    union = len(set1 | set2)
+    return len(set1 & set2) / union if union else 0.0
+
+class DuplicateIndex:
+    """
+    Индекс всех объявлений за window (по всем пользователям).
+    Вставка инкрементальная, устаревшие записи удаляются по времени.
+    """
+
+    def __init__(self, window: timedelta, threshold: float, bands: int = LSH_BANDS):
+        self.window = window
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = MINHASH_PERMUTATIONS // bands
+        self._buckets: list[dict[int, list[int]]] = [{} for _ in range(bands)]
+        self._posts: dict[int, tuple[int, datetime, array, tuple[int, ...]]] = {}
+        self._order: deque[int] = deque()
+        self._next_id = 0
+
+    def __len__(self) -> int:
+        return len(self._posts)
+
+    def _band_keys(self, signature: tuple[int, ...]) -> tuple[int, ...]:
+        rows = self.rows
+        return tuple(hash(signature[i * rows:(i + 1) * rows]) for i in range(self.bands))
+
+    def add(self, user_id: int, text: str, posted_at: datetime) -> int | None:
+        """Добавляет объявление и возвращает его id в индексе (None для текста без слов)."""
+        hashes = token_hashes(text)
+        if not hashes:
+            return None
+        band_keys = self._band_keys(minhash_signature(hashes))
+        post_id = self._next_id
+        self._next_id += 1
+        self._posts[post_id] = (user_id, posted_at, hashes, band_keys)
+        self._order.append(post_id)
+        for bucket, key in zip(self._buckets, band_keys):
+            bucket.setdefault(key, []).append(post_id)
+        return post_id
+
+    def remove(self, post_id: int):
+        post = self._posts.pop(post_id, None)
+        if post is None:
+            return
+        for bucket, key in zip(self._buckets, post[3]):
+            ids = bucket[key]
+            ids.remove(post_id)
+            if not ids:
+                del bucket[key]
+
+    def expire(self, now: datetime):
+        cutoff = now - self.window
+        while self._order:
+            # id удалённых через remove объявлений просто пропускаем
+            post = self._posts.get(self._order[0])
+            if post is not None and post[1] >= cutoff:
+                break
+            self.remove(self._order.popleft())
+
+    def find_similar(self, text: str, now: datetime) -> tuple[int, datetime] | None:
+        """Возвращает (user_id, posted_at) похожего объявления либо None."""
+        self.expire(now)
+        hashes = token_hashes(text)
+        if not hashes:
+            return None
+        candidates = set()
+        for bucket, key in zip(self._buckets, self._band_keys(minhash_signature(hashes))):
+            candidates.update(bucket.get(key, ()))
+        for post_id in candidates:
+            user_id, posted_at, post_hashes, _ = self._posts[post_id]
+            if jaccard_similarity(hashes, post_hashes) >= self.threshold:
+                return user_id, posted_at
+        return None
+
+# ---------- Индекс изображений ----------
+# dHash фотографий и поиск по расстоянию Хэмминга (multi-index hashing): хэш делится
+# на IMAGE_HASH_CHUNKS частей, и если хэши отличаются не больше чем на d бит, то хотя бы
+# одна часть отличается не больше чем на d // IMAGE_HASH_CHUNKS бит.
+IMAGE_HASH_BITS = 64
+IMAGE_HASH_CHUNKS = 4
+
+def dhash(data: bytes) -> int:
+    """64-битный разностный хэш: сравнение яркости соседних пикселей уменьшенной копии."""
+    # Pillow нужен только для фотографий — не тратим на его импорт время запуска
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as image:
+        # JPEG декодируется сразу в уменьшенном виде
+        image.draft("L", (36, 32))
+        pixels = list(image.convert("L").resize((9, 8), Image.Resampling.BILINEAR).getdata())
+    value = 0
+    for row in range(0, 72, 9):
+        for col in range(row, row + 8):
+            value = (value << 1) | (pixels[col] > pixels[col + 1])
+    return value
+
+class ImageIndex:
+    """
+    Изображения всех объявлений за window, устроен как DuplicateIndex: объявление
+    добавляется со всеми своими хэшами, удаляется целиком, устаревшие — по времени.
+    """
+
+    def __init__(self, window: timedelta, max_distance: int, chunks: int = IMAGE_HASH_CHUNKS):
+        self.window = window
+        self.max_distance = max_distance
+        self.chunks = chunks
+        self.chunk_bits = IMAGE_HASH_BITS // chunks
+        self._mask = (1 << self.chunk_bits) - 1
+        # Все отличия части хэша не больше чем в max_distance // chunks бит
+        self._flips = [
+            sum(1 << bit for bit in bits)
+            for distance in range(max_distance // chunks + 1)
+            for bits in combinations(range(self.chunk_bits), distance)
+        ]
+        # Часть хэша -> [(хэш, id объявления)]: кандидата можно проверить, не заглядывая в _posts
+        self._buckets: list[dict[int, list[tuple[int, int]]]] = [{} for _ in range(chunks)]
+        self._posts: dict[int, tuple[int, datetime, tuple[int, ...]]] = {}
+        self._order: deque[int] = deque()
+        self._next_id = 0
+
+    def __len__(self) -> int:
+        return len(self._posts)
+
+    def _chunk_keys(self, image_hash: int) -> list[int]:
+        return [(image_hash >> (i * self.chunk_bits)) & self._mask for i in range(self.chunks)]
+
+    def add(self, user_id: int, hashes: tuple[int, ...], posted_at: datetime) -> int | None:
+        """Добавляет изображения объявления и возвращает id в индексе (None, если их нет)."""
+        if not hashes:
+            return None
+        post_id = self._next_id
+        self._next_id += 1
+        self._posts[post_id] = (user_id, posted_at, hashes)
+        self._order.append(post_id)
+        for image_hash in hashes:
+            for bucket, key in zip(self._buckets, self._chunk_keys(image_hash)):
+                bucket.setdefault(key, []).append((image_hash, post_id))
+        return post_id
+
+    def remove(self, post_id: int):
+        post = self._posts.pop(post_id, None)
+        if post is None:
+            return
+        for image_hash in post[2]:
+            for bucket, key in zip(self._buckets, self._chunk_keys(image_hash)):
+                entries = bucket[key]
+                entries.remove((image_hash, post_id))
+                if not entries:
+                    del bucket[key]
+
+    def expire(self, now: datetime):
+        cutoff = now - self.window
+        while self._order:
+            post = self._posts.get(self._order[0])
+            if post is not None and post[1] >= cutoff:
+                break
+            self.remove(self._order.popleft())
+
+    def find_similar(self, hashes: tuple[int, ...], now: datetime) -> tuple[int, datetime] | None:
+        """Возвращает (user_id, posted_at) объявления с похожим изображением либо None."""
+        self.expire(now)
+        max_distance = self.max_distance
+        for image_hash in hashes:
+            for bucket, key in zip(self._buckets, self._chunk_keys(image_hash)):
+                for flip in self._flips:
+                    for post_hash, post_id in bucket.get(key ^ flip, ()):
+                        if (image_hash ^ post_hash).bit_count() <= max_distance:
+                            user_id, posted_at, _ = self._posts[post_id]
+                            return user_id, posted_at
+        return None
+
+class TelegramPhotoFetcher:
+    """Скачивает файл по file_id через Bot API. В тестах подменяется локальным источником."""
+
+    async def fetch(self, bot, file_id: str) -> bytes:
+        telegram_file = await bot.get_file(file_id)
+        return bytes(await telegram_file.download_as_bytearray())
+
+class ImageHasher:
+    """
+    Отпечатки фотографий объявления. Каждый файл скачивается один раз (отпечатки
+    запоминаются по file_id), декодирование идёт в пуле потоков, а не в цикле событий.
+    """
+
+    def __init__(self, fetcher, workers: int, cache_size: int):
+        self.fetcher = fetcher
+        self.cache_size = cache_size
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image-hash")
+        self._hashes: dict[str, int] = {}
+
+    async def hash_photo(self, bot, file_id: str) -> int | None:
+        image_hash = self._hashes.get(file_id)
+        if image_hash is not None:
+            return image_hash
+        try:
+            data = await self.fetcher.fetch(bot, file_id)
+            image_hash = await asyncio.get_running_loop().run_in_executor(self._executor, dhash, data)
+        except Exception as e:
+            # Без отпечатка объявление проверяется только по тексту
+            logger.warning("Не удалось получить отпечаток изображения %s: %s", file_id, e)
+            return None
+        self._hashes[file_id] = image_hash
+        if len(self._hashes) > self.cache_size:
+            del self._hashes[next(iter(self._hashes))]
+        return image_hash
+
+    async def hash_photos(self, bot, file_ids: list[str]) -> tuple[int, ...]:
+        hashes = await asyncio.gather(*(self.hash_photo(bot, file_id) for file_id in file_ids))
+        return tuple(image_hash for image_hash in hashes if image_hash is not None)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+image_hasher = ImageHasher(TelegramPhotoFetcher(), IMAGE_HASH_WORKERS, IMAGE_HASH_CACHE_SIZE)
+
+# ---------- Журнал постов ----------
+class PostRecord:
+    """Опубликованный пост: время (unix) и отпечаток текста вместо самого текста."""
+
+    __slots__ = ("posted_at", "fingerprint")
+
+    def __init__(self, posted_at: float, fingerprint: array):
+        self.posted_at = posted_at
+        self.fingerprint = fingerprint
+
+class PostLedger:
+    """
+    Посты каждого пользователя за window в порядке публикации. Постов у
+    пользователя единицы, поэтому хватает обычного списка. Устаревшие записи
+    выбрасываются при обращении к пользователю, пользователи без записей —
+    периодической чисткой sweep.
+    """
+
+    def __init__(self, window: timedelta):
+        self.window = window.total_seconds()
+        self._users: dict[int, list[PostRecord]] = {}
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def recent(self, user_id: int, now: float) -> list[PostRecord]:
+        records = self._users.get(user_id)
+        if not records:
+            return []
+        cutoff = now - self.window
+        if records[0].posted_at < cutoff:
+            records[:] = [record for record in records if record.posted_at >= cutoff]
+        return records
+
+    def add(self, user_id: int, fingerprint: array, posted_at: float):
+        self._users.setdefault(user_id, []).append(PostRecord(posted_at, fingerprint))
+
+    def sweep(self, now: float) -> int:
+        """Чистит устаревшие записи у всех пользователей; возвращает число выброшенных пользователей."""
+        idle = [user_id for user_id in self._users if not self.recent(user_id, now)]
+        for user_id in idle:
+            del self._users[user_id]
+        return len(idle)
+
+def check_post_limit_and_duplicates(shop: "Shop", user_id: int, text: str) -> tuple[bool, str]:
+    now = datetime.now()
+    now_ts = now.timestamp()
+    records = shop.post_ledger.recent(user_id, now_ts)
+
+    # Счётчик за сутки сбрасывается в полночь по времени магазина, а не сервера
+    day_start = shop.local_now().replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+    if sum(1 for record in records if record.posted_at >= day_start) >= shop.daily_post_limit:
+        return reject("daily_limit", f"❌ Вы превысили лимит в {shop.daily_post_limit} поста за сутки. Попробуйте завтра.")
+
+    # Проверка на дубликаты (90%+ схожести по словам)
+    fingerprint = token_hashes(text)
+    for record in records:
+        if jaccard_similarity(fingerprint, record.fingerprint) >= 0.9:
+            hours_left = 24 - (now_ts - record.posted_at) // 3600
+            return reject("duplicate", f"❌ Похожий пост уже публиковался. Повторная публикация возможна через {int(hours_left)} ч.")
+
+    # Похожие объявления других пользователей
+    return check_global_duplicates(shop, text, now)
+
+def check_global_duplicates(shop: "Shop", text: str, now: datetime) -> tuple[bool, str]:
+    match = shop.duplicate_index.find_similar(text, now)
+    if match:
+        _, post_time = match
+        hours_left = 24 - (now - post_time).total_seconds() // 3600
+        return reject("global_duplicate", f"❌ Похожее объявление уже публиковалось. Повторная публикация возможна через {int(hours_left)} ч.")
+    return True, ""
+
+def check_image_duplicates(shop: "Shop", hashes: tuple[int, ...], now: datetime) -> tuple[bool, str]:
+    match = shop.image_index.find_similar(hashes, now) if hashes else None
+    if match:
+        _, post_time = match
+        hours_left = 24 - (now - post_time).total_seconds() // 3600
+        return reject("image_duplicate", f"❌ Такое изображение уже публиковалось. Повторная публикация возможна через {int(hours_left)} ч.")
+    return True, ""
+
+def reserve_post(shop: "Shop", user_id: int, text: str, image_hashes: tuple[int, ...] = ()) -> tuple[bool, str, int | None, int | None]:
+    """
+    Повторно проверяет глобальные индексы текстов и изображений и сразу занимает в них
+    место под объявление. Между проверками и постановкой в очередь есть сетевые запросы,
+    поэтому без этого одинаковые объявления, проверяемые параллельно, прошли бы оба.
+    Возвращает (ok, текст_ошибки, id_в_индексе, id_в_индексе_изображений).
+    """
+    now = datetime.now()
+    ok, error = check_global_duplicates(shop, text, now)
+    if ok:
+        ok, error = check_image_duplicates(shop, image_hashes, now)
+    if not ok:
+        return False, error, None, None
+    return True, "", shop.duplicate_index.add(user_id, text, now), shop.image_index.add(user_id, image_hashes, now)
+
+def add_successful_post(shop: "Shop", user_id: int, text: str, image_hashes: tuple[int, ...] = (), message_id: int | None = None):
+    # В глобальные индексы объявление попадает ещё при постановке в очередь (reserve_post)
+    now = datetime.now()
+    shop.post_ledger.add(user_id, token_hashes(text), now.timestamp())
+    post_store.add_post(shop.name, user_id, text, now, message_id)
+    shop.search_index.add(text, message_id, now)
+    if image_hashes:
+        post_store.add_images(shop.name, user_id, image_hashes, now)
+
+# ---------- Поиск объявлений ----------
+SEARCH_ACTIONS = {
+    "продам": "sell", "продаю": "sell", "продажа": "sell",
+    "куплю": "buy", "покупка": "buy",
+    "обмен": "trade", "обменяю": "trade",
+}
+SEARCH_ACTION_LABELS = {"sell": "Продам", "buy": "Куплю", "trade": "Обмен"}
+
+# Окончания для грубого стемминга: «аккаунта», «аккаунты» и «аккаунтом» ищутся как «аккаунт»
+_RUSSIAN_ENDINGS = sorted(
+    [
+        "ами", "ями", "ого", "его", "ому", "ему", "ыми", "ими", "ией", "иях", "иям",
+        "ая", "яя", "ое", "ее", "ые", "ие", "ой", "ей", "ий", "ый", "ом", "ем", "ам", "ям", "ах", "ях", "ов", "ев",
+        "а", "я", "о", "е", "ы", "и", "у", "ю", "ь",
+    ],
+    key=len,
+    reverse=True,
+)
+# Сокращения и частые опечатки рынка -> основа полного слова. Применяются к основам
+# и в объявлениях, и в запросах: «акк», «акки» и «аккаунты» находят друг друга
+SEARCH_SYNONYMS = {
+    "акк": "аккаунт",
+    "акаунт": "аккаунт",
+    "крист": "кристалл",
+}
+_SEARCH_WORD = re.compile(r"\w+")
+_PRICE_BEFORE = re.compile(r"(\d[\d ]{0,8}?)\s*$")
+_PRICE_AFTER = re.compile(r"(?:цена|за|стоимость)\s*:?\s*(\d+)")
+_PRICE_FILTER = re.compile(r"\b(до|от)\s+(\d+)", re.IGNORECASE)
+_STEM_CACHE_SIZE = 200000
+
+def stem(word: str) -> str:
+    for ending in _RUSSIAN_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            word = word[:-len(ending)]
+            break
+    return SEARCH_SYNONYMS.get(word, word)
+
+_stems: dict[str, str] = {}
+
+def search_terms(words: list[str]) -> set[str]:
+    """Основы слов. Они запоминаются: знакомое слово стоит одного обращения к словарю."""
+    stems = list(map(_stems.get, words))
+    if None in stems:
+        if len(_stems) > _STEM_CACHE_SIZE:
+            _stems.clear()
+        for i, word_stem in enumerate(stems):
+            if word_stem is None:
+                stems[i] = _stems[words[i]] = stem(words[i])
+    return set(stems)
+
+def normalize_search_text(text: str) -> str:
+    return text.lower().replace("ё", "е")
+
+def search_words(text: str) -> list[str]:
+    return _SEARCH_WORD.findall(normalize_search_text(text))
+
+def extract_action(words: list[str]) -> str | None:
+    for word in words:
+        action = SEARCH_ACTIONS.get(word)
+        if action:
+            return action
+    return None
+
+def action_term(action: str) -> str:
+    # Не совпадает ни с одним словом текста: \w+ не захватывает «#»
+    return f"#{action}"
+
+def extract_price(text_lower: str) -> int | None:
+    """Цена из текста в нижнем регистре: «500₽», «1 000 руб», «цена 500», «за 500»."""
+    for marker in ("₽", "руб"):
+        end = text_lower.find(marker)
+        while end >= 0:
+            match = _PRICE_BEFORE.search(text_lower, max(0, end - 12), end)
+            if match:
+                return int(match.group(1).replace(" ", ""))
+            end = text_lower.find(marker, end + 1)
+    match = _PRICE_AFTER.search(text_lower)
+    return int(match.group(1)) if match else None
+
+class SearchAd:
+    """Опубликованное объявление в поиске: ссылка, время, действие, цена и начало текста."""
+
+    __slots__ = ("message_id", "posted_at", "action", "price", "snippet")
+
+    def __init__(self, message_id: int | None, posted_at: datetime, action: str | None, price: int | None, snippet: str):
+        self.message_id = message_id
+        self.posted_at = posted_at
+        self.action = action
+        self.price = price
+        self.snippet = snippet
+
+class SearchIndex:
+    """
+    Инвертированный индекс объявлений за window: основа слова (и действие) ->
+    отсортированный массив id объявлений. id выдаются по времени публикации,
+    поэтому устаревшие объявления — начало каждого массива; compact отрезает его.
+    """
+
+    def __init__(self, window: timedelta):
+        self.window = window
+        self._postings: defaultdict[str, array] = defaultdict(partial(array, "q"))
+        self._ads: dict[int, SearchAd] = {}
+        self._next_id = 0
+        self._first_id = 0  # самое старое объявление в окне
+        self._deferred: list[tuple[str, int | None, datetime]] | None = None
+
+    def __len__(self) -> int:
+        return len(self._ads)
+
+    @property
+    def ready(self) -> bool:
+        return self._deferred is None
+
+    def add(self, text: str, message_id: int | None, posted_at: datetime):
+        """Добавляет объявление; объявления добавляются в порядке публикации."""
+        if self._deferred is not None:
+            # Идёт загрузка: новое объявление должно получить id после старых
+            self._deferred.append((text, message_id, posted_at))
+        else:
+            self._index(text, message_id, posted_at)
+
+    def _index(self, text: str, message_id: int | None, posted_at: datetime):
+        text_lower = normalize_search_text(text)
+        words = _SEARCH_WORD.findall(text_lower)
+        action = extract_action(words)
+        terms = search_terms(words)
+        if action:
+            terms.add(action_term(action))
+
+        ad_id = self._next_id
+        self._next_id += 1
+        snippet = " ".join(text[:160].split())[:120]
+        self._ads[ad_id] = SearchAd(message_id, posted_at, action, extract_price(text_lower), snippet)
+        postings = self._postings
+        for term in terms:
+            postings[term].append(ad_id)
+
+    async def load(self, posts, batch: int = 2000):
+        """
+        Восстанавливает индекс при запуске из (text, message_id, posted_at), отдавая
+        управление циклу событий каждые batch объявлений. Объявления, опубликованные
+        во время загрузки, добавляются после неё.
+        """
+        self._deferred = []
+        try:
+            for i, (text, message_id, posted_at) in enumerate(posts, 1):
+                self._index(text, message_id, posted_at)
+                if i % batch == 0:
+                    await asyncio.sleep(0)
+        finally:
+            deferred, self._deferred = self._deferred, None
+            for post in deferred:
+                self._index(*post)
+
+    def get(self, ad_id: int) -> SearchAd | None:
+        return self._ads.get(ad_id)
+
+    def expire(self, now: datetime):
+        cutoff = now - self.window
+        while self._first_id < self._next_id and self._ads[self._first_id].posted_at < cutoff:
+            del self._ads[self._first_id]
+            self._first_id += 1
+
+    def compact(self, now: datetime):
+        """Удаляет из массивов id устаревших объявлений."""
+        self.expire(now)
+        for term in list(self._postings):
+            postings = self._postings[term]
+            start = bisect_left(postings, self._first_id)
+            if start == len(postings):
+                del self._postings[term]
+            elif start:
+                del postings[:start]
+
+    def search(
+        self,
+        terms: list[str],
+        now: datetime,
+        action: str | None = None,
+        min_price: int | None = None,
+        max_price: int | None = None,
+        limit: int = SEARCH_MAX_RESULTS,
+    ) -> list[int]:
+        """id объявлений со всеми словами terms, от новых к старым."""
+        self.expire(now)
+        wanted = search_terms(terms)
+        if action:
+            wanted.add(action_term(action))
+        lists = []
+        for term in wanted:
+            postings = self._postings.get(term)
+            if not postings:
+                return []
+            lists.append(postings)
+        lists.sort(key=len)
+
+        if len(lists) > 1:
+            candidates = sorted(self._intersect(lists), reverse=True)
+        elif lists:
+            stop = bisect_left(lists[0], self._first_id)
+            candidates = (lists[0][i] for i in range(len(lists[0]) - 1, stop - 1, -1))
+        else:
+            candidates = range(self._next_id - 1, self._first_id - 1, -1)
+
+        filter_price = min_price is not None or max_price is not None
+        low = min_price if min_price is not None else 0
+        high = max_price if max_price is not None else float("inf")
+        ads = self._ads
+        results = []
+        for ad_id in candidates:
+            if filter_price:
+                price = ads[ad_id].price
+                if price is None or not low <= price <= high:
+                    continue
+            results.append(ad_id)
+            if len(results) >= limit:
+                break
+        return results
+
+    def _intersect(self, lists: list[array]) -> set[int]:
+        """
+        Пересечение массивов, от короткого к длинному. Сравнимые по длине массивы
+        пересекаются множествами, а в гораздо более длинных кандидаты ищутся бинарным поиском.
+        """
+        shortest = lists[0]
+        matches = set(shortest[bisect_left(shortest, self._first_id):])
+        for postings in lists[1:]:
+            if len(matches) * 32 < len(postings):
+                matches = {ad_id for ad_id in matches if _contains(postings, ad_id)}
+            else:
+                matches.intersection_update(postings)
+            if not matches:
+                break
+        return matches
+
+def _contains(postings: array, value: int) -> bool:
+    i = bisect_left(postings, value)
+    return i < len(postings) and postings[i] == value
+
+def parse_search_query(query: str) -> tuple[list[str], str | None, int | None, int | None]:
+    """«куплю акк до 500» -> (слова, действие, цена от, цена до)."""
+    min_price = max_price = None
+    for bound, value in _PRICE_FILTER.findall(query):
+        if bound.lower() == "до":
+            max_price = int(value)
+        else:
+            min_price = int(value)
+    words = search_words(_PRICE_FILTER.sub(" ", query))
+    action = extract_action(words)
+    terms = [word for word in words if word not in SEARCH_ACTIONS]
+    return terms, action, min_price, max_price
+
+def channel_post_link(channel_id: str, message_id: int) -> str:
+    if channel_id.startswith("@"):
+        return f"https://t.me/{channel_id[1:]}/{message_id}"
+    return f"https://t.me/c/{channel_id.removeprefix('-100')}/{message_id}"
+
+def format_search_page(shop: "Shop", results: list[int], page: int) -> tuple[str, InlineKeyboardMarkup | None]:
+    pages = (len(results) + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE
+    lines = [f"🔎 Найдено объявлений: {len(results)}" + (f" (стр. {page + 1}/{pages})" if pages > 1 else "")]
+    for number, ad_id in enumerate(results[page * SEARCH_PAGE_SIZE:(page + 1) * SEARCH_PAGE_SIZE], page * SEARCH_PAGE_SIZE + 1):
+        ad = shop.search_index.get(ad_id)
+        if ad is None:
+            continue
+        details = [SEARCH_ACTION_LABELS.get(ad.action, "Объявление")]
+        if ad.price is not None:
+            details.append(f"{ad.price}₽")
+        details.append(ad.posted_at.strftime("%d.%m %H:%M"))
+        snippet = html.escape(ad.snippet)
+        if ad.message_id:
+            snippet = f"<a href='{channel_post_link(shop.channel_id, ad.message_id)}'>{snippet}</a>"
+        lines.append(f"\n{number}. <b>{' · '.join(details)}</b>\n{snippet}")
+
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀️ Назад", callback_data=f"search:{page - 1}"))
+    if page + 1 < pages:
+        buttons.append(InlineKeyboardButton("Дальше ▶️", callback_data=f"search:{page + 1}"))
+    return "\n".join(lines), InlineKeyboardMarkup([buttons]) if buttons else None
+
+# ---------- Правила модерации ----------
+def keyword_trie_pattern(words) -> str:
+    """
+    Собирает регулярное выражение-префиксное дерево для списка слов.
+    Нужен только факт вхождения, поэтому ветка обрывается на самом коротком слове.
+    Стоимость проверки позиции зависит от глубины дерева, а не от длины списка.
+    """
+    trie: dict = {}
+    for word in words:
+        node = trie
+        for char in word.lower():
+            node = node.setdefault(char, {})
+        node[""] = None
+
+    def build(node) -> str:
+        if "" in node:
+            return ""
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items())]
+        return branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+
+    return build(trie) if trie else "(?!)"
+
+_WORD_CHAR = re.compile(r"\w")
+
+class MessageRules:
+    """
+    Проверки текста объявления, скомпилированные при запуске в одно регулярное
+    выражение: мат, действия и упоминания собираются за один проход по тексту.
+    """
+
+    def __init__(self, actions, forbidden_words, allowed_contacts, caps_ratio: float = 0.7, caps_min_length: int = 10):
+        self.allowed_contacts = frozenset(contact.lower() for contact in allowed_contacts)
+        self.caps_ratio = caps_ratio
+        self.caps_min_length = caps_min_length
+        # Мат идёт первым: при совпадении начала с действием он важнее
+        self._pattern = re.compile(
+            "(?=(?P<profanity>" + keyword_trie_pattern(forbidden_words) + ")"
+            "|(?P<action>" + keyword_trie_pattern(actions) + ")"
+            "|@(?P<mention>[a-z0-9_]+))"
+        )
+
+    @classmethod
+    def from_file(cls, path: str, admin_username: str = ADMIN_USERNAME) -> "MessageRules":
+        with open(path, encoding="utf-8") as rules_file:
+            config = json.load(rules_file)
+        return cls(
+            actions=config.get("actions", ACTION_WORDS),
+            forbidden_words=config.get("forbidden_words", FORBIDDEN_WORDS),
+            allowed_contacts=config.get("allowed_contacts", [admin_username]),
+            caps_ratio=config.get("caps_ratio", 0.7),
+            caps_min_length=config.get("caps_min_length", 10),
+        )
+
+    def check(self, text: str, user_username: str) -> tuple[bool, str]:
+        text_lower = text.lower()
+        # Ники берём из исходного текста, если lower() не изменил длину строки
+        source = text if len(text_lower) == len(text) else text_lower
+        has_action = has_profanity = mentions_bot = False
+        usernames = []
+        for match in self._pattern.finditer(text_lower):
+            kind = match.lastgroup
+            if kind == "profanity":
+                has_profanity = True
+            elif kind == "action":
+                has_action = True
+            else:
+                start, end = match.span("mention")
+                if end - start >= 5:
+                    usernames.append(source[start:end])
+                if text_lower.endswith("bot", start, end) and not _WORD_CHAR.match(text_lower, end):
+                    mentions_bot = True
+
+        # Проверка на наличие @username (связь с продавцом/покупателем)
+        if not usernames:
+            return reject("no_contact", "❌ В сообщении отсутствует контактная информация (@username).")
+
+        # Проверка действия (продам/куплю/обмен)
+        if not has_action:
+            return reject("no_action", "❌ Укажите действие: продам/куплю/обмен")
+
+        # Мат
+        if has_profanity:
+            return reject("profanity", "❌ Обнаружен мат. Уберите его.")
+
+        # Слишком много капса
+        if len(text) > self.caps_min_length and sum(map(str.isupper, text)) / len(text) > self.caps_ratio:
+            return reject("caps", "❌ Слишком много текста в верхнем регистре (капс).")
+
+        # Упоминания ботов
+        if mentions_bot:
+            return reject("bot_mention", "❌ Упоминания ботов запрещены.")
+
+        # Лишние упоминания чужих @username
+        allowed = self.allowed_contacts | {(user_username or "").lower()}
+        for username in usernames:
+            username_lower = username.lower()
+            if username_lower.endswith("bot"):
+                continue
+            if username_lower not in allowed:
+                return reject("foreign_mention", f"❌ Упоминание @{username} запрещено. Укажите свой контакт (@ваш_ник).")
+
+        return True, "✅ Сообщение соответствует требованиям."
+
+def load_message_rules(path: str | None, admin_username: str) -> MessageRules:
+    if path:
+        return MessageRules.from_file(path, admin_username)
+    return MessageRules(ACTION_WORDS, FORBIDDEN_WORDS, [admin_username])
+
+def check_file_extension(file_name: str) -> bool:
+    if not file_name:
+        return False
+    return any(file_name.lower().endswith(ext) for ext in ALLOWED_IMAGE_EXTENSIONS)
+
+def thumbnail_id(msg) -> str | None:
+    """Самая маленькая копия фотографии (или превью документа) — её хватает для отпечатка."""
+    if msg.photo:
+        return msg.photo[0].file_id
+    if msg.document and msg.document.thumbnail:
+        return msg.document.thumbnail.file_id
+    return None
+
+def remember_thumbnail(user_data: dict, file_id: str, thumbnail: str | None):
+    if thumbnail:
+        user_data.setdefault("post_thumbnails", {})[file_id] = thumbnail
+
+# ---------- Тексты и медиа ----------
+# {rules_link} и {admin_username} подставляются для каждого магазина (Shop)
+INSTRUCTIONS_TEXT = (
+    "1. Нажмите «📤 Разместить объявление»\n"
+    "2. Отправьте до 5 фотографий (если нужно)\n"
+    "3. Отправьте текст объявления\n"
+    "4. Готово!\n\n"
+    "📌 <b>Основные правила:</b>\n"
+    "• Укажите действие: продам/куплю/обмен\n"
+    "• Укажите цену или бюджет\n"
+    "• Оставьте свой @username для связи\n"
+    "• Не используйте мат и капс\n"
+    "• Можно прикрепить до 5 фотографий к одному объявлению\n\n"
+    "Полные правила: {rules_link}"
+)
+GREETING_TEXT = (
+    "<b>🤖 Привет! Я бот для размещения объявлений о покупке/продаже цифровых ценностей.</b>\n\n"
+    "📝 <b>Как разместить объявление:</b>\n" + INSTRUCTIONS_TEXT
+)
+HELP_TEXT = (
+    "📌 <b>Как разместить объявление:</b>\n" + INSTRUCTIONS_TEXT + "\n\n"
+    "🔎 <b>Поиск по объявлениям:</b> /search куплю акк до 500"
+)
+
+EXAMPLE_PHOTO_PATH = "primerbot.jpg"
+EXAMPLE_CAPTION = (
+    "Пример объявления:\n"
+    "«Продам за 100₽ или обменяю на акк посильнее с моей доплатой. "
+    "На аккаунте есть возможность указать свою почту. "
+    "Контакты для связи: @{admin_username}»"
+)
+
+class MediaAssets:
+    """
+    Статические файлы бота. Каждый файл загружается в Telegram один раз, дальше
+    отправляется по file_id. file_id хранятся в SQLite по хэшу содержимого,
+    поэтому переживают перезапуск и сбрасываются при замене файла. file_id
+    действителен только для загрузившего бота, поэтому в ключе есть и id бота.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._conn: sqlite3.Connection | None = None
+        self._hashes: dict[str, str] = {}
+        self._file_ids: dict[str, str] = {}
+        self._upload_lock = asyncio.Lock()
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS media_assets (content_hash TEXT PRIMARY KEY, file_id TEXT NOT NULL)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def _content_hash(self, path: str) -> str:
+        if path not in self._hashes:
+            with open(path, "rb") as asset:
+                self._hashes[path] = hashlib.sha256(asset.read()).hexdigest()
+        return self._hashes[path]
+
+    def _file_id(self, content_hash: str) -> str | None:
+        if content_hash not in self._file_ids:
+            row = self._db().execute(
+                "SELECT file_id FROM media_assets WHERE content_hash = ?", (content_hash,)
+            ).fetchone()
+            if not row:
+                return None
+            self._file_ids[content_hash] = row[0]
+        return self._file_ids[content_hash]
+
+    def _store(self, content_hash: str, file_id: str | None):
+        if file_id:
+            self._file_ids[content_hash] = file_id
+        else:
+            self._file_ids.pop(content_hash, None)
+        with self._db() as conn:
+            if file_id:
+                conn.execute("INSERT OR REPLACE INTO media_assets VALUES (?, ?)", (content_hash, file_id))
+            else:
+                conn.execute("DELETE FROM media_assets WHERE content_hash = ?", (content_hash,))
+
+    async def send_photo(self, bot, chat_id: int, path: str, **kwargs):
+        content_hash = f"{bot.id}:{self._content_hash(path)}"
+        file_id = self._file_id(content_hash)
+        if file_id:
+            try:
+                return await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+            except BadRequest as e:
+                logger.warning("Telegram отклонил file_id для %s: %s. Загружаем файл заново.", path, e)
+                self._store(content_hash, None)
+
+        # Загружаем файл один раз, даже если его одновременно запросили несколько пользователей
+        async with self._upload_lock:
+            file_id = self._file_id(content_hash)
+            if file_id:
+                return await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+            with open(path, "rb") as photo:
+                message = await bot.send_photo(chat_id=chat_id, photo=photo, **kwargs)
+            self._store(content_hash, message.photo[-1].file_id)
+            return message
+
+media_assets = MediaAssets(DB_PATH)
+
+async def send_welcome_message(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
+    shop = shop_of(context)
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text=shop.greeting_text,
+        parse_mode="HTML",
+        disable_web_page_preview=True,
+        reply_markup=MAIN_MENU,
+    )
+
+    # Пример изображения
+    try:
+        await media_assets.send_photo(context.bot, chat_id, EXAMPLE_PHOTO_PATH, caption=shop.example_caption)
+    except FileNotFoundError:
+        await context.bot.send_message(chat_id=chat_id, text="⚠️ Не удалось найти пример изображения.", disable_web_page_preview=True)
+
+# ---------- Очередь публикаций ----------
+class TokenBucket:
+    """Ограничитель частоты: до capacity токенов, пополнение rate токенов в секунду."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    async def acquire(self, cost: float = 1.0):
+        cost = min(cost, self.capacity)
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= cost:
+                self._tokens -= cost
+                return
+            await asyncio.sleep((cost - self._tokens) / self.rate)
+
+class PublishJob:
+    """Объявление, прошедшее проверки и ожидающее отправки в канал."""
+
+    __slots__ = (
+        "shop", "user_id", "chat_id", "message_id", "text", "photos", "document",
+        "index_id", "deferred_id", "image_hashes", "image_id",
+    )
+
+    def __init__(
+        self,
+        shop: "Shop",
+        user_id: int,
+        chat_id: int,
+        message_id: int,
+        text: str,
+        photos: list[str],
+        document: str | None,
+        index_id: int | None = None,
+        deferred_id: int | None = None,
+        image_hashes: tuple[int, ...] = (),
+        image_id: int | None = None,
+    ):
+        self.shop = shop
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.text = text
+        self.photos = photos
+        self.document = document
+        self.index_id = index_id
+        self.deferred_id = deferred_id
+        self.image_hashes = image_hashes
+        self.image_id = image_id
+
+    @property
+    def cost(self) -> int:
+        # Каждая фотография альбома считается отдельным сообщением
+        return max(len(self.photos), 1)
+
+def release_reservation(job: PublishJob):
+    """Освобождает место объявления в индексах похожих текстов и изображений."""
+    if job.index_id is not None:
+        job.shop.duplicate_index.remove(job.index_id)
+    if job.image_id is not None:
+        job.shop.image_index.remove(job.image_id)
+
+async def send_to_channel(bot, job: PublishJob):
+    """Публикует объявление и возвращает сообщение в канале (первое сообщение альбома)."""
+    channel_id = job.shop.channel_id
+    if len(job.photos) == 1:
+        # Одна фотография - используем send_photo
+        return await bot.send_photo(chat_id=channel_id, photo=job.photos[0], caption=job.text)
+    if job.photos:
+        # Несколько фотографий - используем send_media_group, подпись только к первой
+        media_group = [
+            InputMediaPhoto(media=photo_id, caption=job.text if i == 0 else None)
+            for i, photo_id in enumerate(job.photos)
+        ]
+        return (await bot.send_media_group(chat_id=channel_id, media=media_group))[0]
+    if job.document:
+        return await bot.send_document(chat_id=channel_id, document=job.document, caption=job.text)
+    return await bot.send_message(chat_id=channel_id, text=job.text, disable_web_page_preview=True)
+
+class ChannelPublisher:
+    """
+    Очередь отправки объявлений в канал. Один воркер отправляет посты с частотой
+    не выше лимита канала, повторяет попытки при RetryAfter и сетевых ошибках
+    и сообщает автору результат. У пользователя в очереди не больше одного поста:
+    повторные отправки, пока пост ждёт публикации, не ставятся в очередь.
+    У каждого магазина своя очередь: свой канал и свой лимит.
+    """
+
+    def __init__(self, rate_per_minute: int, burst: int, max_attempts: int):
+        self.bucket = TokenBucket(rate_per_minute / 60, burst)
+        self.max_attempts = max_attempts
+        self.bot = None
+        self._queue: asyncio.Queue[PublishJob] = asyncio.Queue()
+        self._pending: set[int] = set()
+        self._worker_task: asyncio.Task | None = None
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def is_pending(self, user_id: int) -> bool:
+        return user_id in self._pending
+
+    def submit(self, job: PublishJob) -> bool:
+        if job.user_id in self._pending:
+            return False
+        self._pending.add(job.user_id)
+        self._queue.put_nowait(job)
+        return True
+
+    def start(self, bot):
+        self.bot = bot
+        self._worker_task = asyncio.create_task(self._worker())
+
+    async def stop(self, timeout: float = 10):
+        """Даёт очереди опустеть (не дольше timeout секунд) и останавливает воркер."""
+        if self._worker_task is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            # Они остаются в deferred_posts и встанут в очередь при следующем запуске
+            logger.warning("Не опубликовано при остановке: %s объявлений", self._queue.qsize())
+        self._worker_task.cancel()
+        self._worker_task = None
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            # При отмене воркера (stop) строка не удаляется: неотправленный пост
+            # остаётся в deferred_posts и вернётся в очередь при запуске
+            try:
+                await self._publish(job)
+            except Exception as e:
+                logger.exception("Ошибка очереди публикаций: %s", e)
+                self._forget(job)
+            finally:
+                self._pending.discard(job.user_id)
+                self._queue.task_done()
+
+    def _forget(self, job: PublishJob):
+        """Судьба поста решена (вышел или окончательно отклонён): автор может отправлять следующий."""
+        self._pending.discard(job.user_id)
+        if job.deferred_id is not None:
+            deferred_posts.remove(job.deferred_id)
+
+    async def _publish(self, job: PublishJob):
+        backoff = 1
+        for attempt in range(1, self.max_attempts + 1):
+            await self.bucket.acquire(job.cost)
+            try:
+                message = await send_to_channel(self.bot, job)
+            except RetryAfter as e:
+                logger.warning("RetryAfter при публикации (попытка %s): ждём %s с", attempt, e.retry_after)
+                await asyncio.sleep(e.retry_after)
+            except BadRequest as e:
+                logger.error(
+                    "Telegram отклонил объявление пользователя %s: %s", job.user_id, e,
+                    extra={"shop": job.shop.name, "user_id": job.user_id},
+                )
+                break
+            except NetworkError as e:
+                logger.warning("Сетевая ошибка при публикации (попытка %s): %s", attempt, e)
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+            except TelegramError as e:
+                # Forbidden, ChatMigrated, InvalidToken, Conflict: повтор не поможет
+                logger.error(
+                    "Ошибка Telegram при публикации объявления пользователя %s: %s", job.user_id, e,
+                    extra={"shop": job.shop.name, "user_id": job.user_id},
+                )
+                break
+            else:
+                add_successful_post(job.shop, job.user_id, job.text, job.image_hashes, message.message_id)
+                self._forget(job)
+                await self._notify(job, "✅ Ваше объявление успешно опубликовано!")
+                return
+
+        # Пост не вышел — освобождаем место в индексах похожих объявлений
+        release_reservation(job)
+        self._forget(job)
+        await self._notify(job, "❌ Произошла ошибка при публикации объявления. Попробуйте чуть позже.")
+
+    async def _notify(self, job: PublishJob, text: str):
+        try:
+            await self.bot.send_message(
+                chat_id=job.chat_id,
+                text=text,
+                reply_to_message_id=job.message_id,
+                allow_sending_without_reply=True,
+                reply_markup=MAIN_MENU,
+                disable_web_page_preview=True,
+            )
+        except Exception as e:
+            logger.error(
+                "Не удалось уведомить пользователя %s: %s", job.user_id, e,
+                extra={"shop": job.shop.name, "user_id": job.user_id},
+            )
+
+class DeferredQueue:
+    """
+    Принятые объявления, ещё не вышедшие в канал. Лежат в SQLite, пока не будут
+    опубликованы (переживают перезапуск). Принятые в нерабочее время выпускаются
+    с началом рабочего дня магазина, остальные сразу отмечены выпущенными
+    (released) и после перезапуска снова ставятся в очередь канала. Очередь общая,
+    у пользователя в каждом магазине в ней не больше одного объявления.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._conn: sqlite3.Connection | None = None
+        self._jobs: dict[int, PublishJob] = {}
+        self._queued_at: dict[int, datetime] = {}
+        self._users: set[tuple[str, int]] = set()
+        self._released: set[int] = set()
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path)
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS deferred_posts (
+                    id INTEGER PRIMARY KEY,
+                    user_id INTEGER NOT NULL,
+                    chat_id INTEGER NOT NULL,
+                    message_id INTEGER NOT NULL,
+                    text TEXT NOT NULL,
+                    photos TEXT NOT NULL,
+                    document TEXT,
+                    queued_at REAL NOT NULL
+                )
+                """
+            )
+            # Очереди, созданные до магазинов, принадлежат магазину по умолчанию
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(deferred_posts)")}
+            if "shop" not in columns:
+                self._conn.execute(f"ALTER TABLE deferred_posts ADD COLUMN shop TEXT NOT NULL DEFAULT '{DEFAULT_SHOP}'")
+            # Хэши изображений в том же виде, что и в post_images; пустая строка — без изображений
+            if "hashes" not in columns:
+                self._conn.execute("ALTER TABLE deferred_posts ADD COLUMN hashes TEXT NOT NULL DEFAULT ''")
+            # Объявление уже передано в очередь канала (ChannelPublisher)
+            if "released" not in columns:
+                self._conn.execute("ALTER TABLE deferred_posts ADD COLUMN released INTEGER NOT NULL DEFAULT 0")
+            self._conn.commit()
+        return self._conn
+
+    def _keep(self, job: PublishJob, queued_at: datetime):
+        self._jobs[job.deferred_id] = job
+        self._queued_at[job.deferred_id] = queued_at
+        self._users.add((job.shop.name, job.user_id))
+
+    def is_pending(self, shop: "Shop", user_id: int) -> bool:
+        return (shop.name, user_id) in self._users
+
+    def add(self, job: PublishJob, released: bool = False) -> bool:
+        """Сохраняет объявление; released — оно сразу уходит в очередь канала."""
+        if (job.shop.name, job.user_id) in self._users:
+            return False
+        queued_at = datetime.now()
+        with self._db() as conn:
+            cursor = conn.execute(
+                "INSERT INTO deferred_posts "
+                "(shop, user_id, chat_id, message_id, text, photos, document, hashes, queued_at, released) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    job.shop.name, job.user_id, job.chat_id, job.message_id, job.text,
+                    json.dumps(job.photos), job.document,
+                    ",".join(f"{value:016x}" for value in job.image_hashes), queued_at.timestamp(), int(released),
+                ),
+            )
+        job.deferred_id = cursor.lastrowid
+        self._keep(job, queued_at)
+        if released:
+            self._released.add(job.deferred_id)
+        return True
+
+    def mark_released(self, job: PublishJob):
+        """Объявление передано в очередь канала: после перезапуска оно встанет туда сразу."""
+        with self._db() as conn:
+            conn.execute("UPDATE deferred_posts SET released = 1 WHERE id = ?", (job.deferred_id,))
+
+    def load(self, shop: "Shop") -> list[tuple[PublishJob, datetime, bool]]:
+        """
+        Читает очередь магазина после перезапуска: (объявление, время приёма, выпущено ли)
+        в порядке приёма. Выпущенные не попадут в take_unreleased.
+        """
+        rows = self._db().execute(
+            "SELECT id, user_id, chat_id, message_id, text, photos, document, hashes, queued_at, released "
+            "FROM deferred_posts WHERE shop = ? ORDER BY id",
+            (shop.name,),
+        ).fetchall()
+        loaded = []
+        for deferred_id, user_id, chat_id, message_id, text, photos, document, hashes, queued_at, released in rows:
+            image_hashes = tuple(int(value, 16) for value in hashes.split(",")) if hashes else ()
+            job = PublishJob(
+                shop, user_id, chat_id, message_id, text, json.loads(photos), document,
+                deferred_id=deferred_id, image_hashes=image_hashes,
+            )
+            self._keep(job, datetime.fromtimestamp(queued_at))
+            if released:
+                self._released.add(deferred_id)
+            loaded.append((job, self._queued_at[deferred_id], bool(released)))
+        return loaded
+
+    def take_unreleased(self, shop: "Shop") -> list[PublishJob]:
+        """Объявления магазина, которые ещё не запланированы к выпуску; отмечает их запланированными."""
+        jobs = [
+            job for deferred_id, job in self._jobs.items()
+            if job.shop is shop and deferred_id not in self._released
+        ]
+        self._released.update(job.deferred_id for job in jobs)
+        return jobs
+
+    def remove(self, deferred_id: int):
+        job = self._jobs.pop(deferred_id, None)
+        if job is None:
+            return
+        del self._queued_at[deferred_id]
+        self._users.discard((job.shop.name, job.user_id))
+        self._released.discard(deferred_id)
+        with self._db() as conn:
+            conn.execute("DELETE FROM deferred_posts WHERE id = ?", (deferred_id,))
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+deferred_posts = DeferredQueue(DB_PATH)
+
+def release_schedule(jobs: list[PublishJob], window: float, rate_per_minute: int) -> list[float]:
+    """
+    Задержки выпуска (секунды от начала): объявления равномерно распределены по window,
+    но интервал не меньше, чем нужно каналу на предыдущее объявление при rate_per_minute.
+    """
+    if not jobs:
+        return []
+    spacing = window / len(jobs)
+    delays = []
+    delay = 0.0
+    for job in jobs:
+        delays.append(delay)
+        delay += max(spacing, job.cost * 60 / rate_per_minute)
+    return delays
+
+async def release_deferred_posts(context: ContextTypes.DEFAULT_TYPE):
+    """Начало рабочего дня: расписывает выпуск отложенных объявлений по DEFERRED_RELEASE_WINDOW."""
+    shop = shop_of(context)
+    await shop.indexes_loaded()
+    jobs = deferred_posts.take_unreleased(shop)
+    if not jobs:
+        return
+    delays = release_schedule(jobs, DEFERRED_RELEASE_WINDOW, shop.channel_rate_per_minute)
+    for job, delay in zip(jobs, delays):
+        context.job_queue.run_once(release_deferred_post, when=delay, data=job)
+    logger.info("Отложенные объявления магазина %s: %s выйдут в течение %s с", shop.name, len(jobs), int(delays[-1]) + 1)
+
+async def release_deferred_post(context: ContextTypes.DEFAULT_TYPE):
+    job = context.job.data
+    if not job.shop.publisher.submit(job):
+        # У автора уже есть объявление в очереди канала — пробуем чуть позже
+        context.job_queue.run_once(release_deferred_post, when=60, data=job)
+        return
+    deferred_posts.mark_released(job)
+
+# ---------- Черновики ----------
+# Ключи user_data, из которых состоит черновик объявления; остальное (результаты поиска) не сохраняется
+DRAFT_KEYS = ("awaiting_post", "post_photos", "post_thumbnails", "post_text")
+
+class SQLitePersistence(BasePersistence):
+    """
+    Черновики объявлений магазина в SQLite. Раз в update_interval PTB передаёт
+    user_data пользователей, получивших апдейты; строка пишется, только если
+    черновик изменился, а все изменения интервала — одной транзакцией
+    (write_pending). Черновики, не менявшиеся дольше ttl, не загружаются и
+    отдаются на удаление через expired(). chat_data, bot_data и разговоры не хранятся.
+    """
+
+    def __init__(self, db_path: str, shop: str, ttl: timedelta, update_interval: float):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.db_path = db_path
+        self.shop = shop
+        self.ttl = ttl
+        self._conn: sqlite3.Connection | None = None
+        # Только пользователи с сохранённым черновиком: хэш JSON и время изменения
+        self._written: dict[int, int] = {}
+        self._updated: dict[int, float] = {}
+        # user_id -> JSON черновика для записи, None — удалить строку
+        self._pending: dict[int, str | None] = {}
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS drafts (
+                    shop TEXT NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    data TEXT NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (shop, user_id)
+                ) WITHOUT ROWID
+                """
+            )
+            self._conn.commit()
+        return self._conn
+
+    async def get_user_data(self) -> dict[int, dict]:
+        cutoff = time.time() - self.ttl.total_seconds()
+        with self._db() as conn:
+            conn.execute("DELETE FROM drafts WHERE shop = ? AND updated_at < ?", (self.shop, cutoff))
+        rows = self._db().execute("SELECT user_id, data, updated_at FROM drafts WHERE shop = ?", (self.shop,))
+        user_data = {}
+        for user_id, data, updated_at in rows:
+            user_data[user_id] = json.loads(data)
+            self._written[user_id] = hash(data)
+            self._updated[user_id] = updated_at
+        return user_data
+
+    async def update_user_data(self, user_id: int, data: dict):
+        draft = {key: data[key] for key in DRAFT_KEYS if key in data}
+        if not any(draft.values()):
+            # Черновика нет (объявление отправлено или не начато)
+            if user_id in self._written:
+                self._pending[user_id] = None
+            else:
+                self._pending.pop(user_id, None)
+            return
+        encoded = json.dumps(draft, ensure_ascii=False, sort_keys=True)
+        if self._written.get(user_id) != hash(encoded):
+            self._pending[user_id] = encoded
+
+    async def drop_user_data(self, user_id: int):
+        if user_id in self._written:
+            self._pending[user_id] = None
+
+    def write_pending(self):
+        """Записывает изменения, накопленные за интервал, одной транзакцией."""
+        if not self._pending:
+            return
+        began = time.perf_counter()
+        now = time.time()
+        pending, self._pending = self._pending, {}
+        with self._db() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO drafts (shop, user_id, data, updated_at) VALUES (?, ?, ?, ?)",
+                [(self.shop, user_id, data, now) for user_id, data in pending.items() if data is not None],
+            )
+            conn.executemany(
+                "DELETE FROM drafts WHERE shop = ? AND user_id = ?",
+                [(self.shop, user_id) for user_id, data in pending.items() if data is None],
+            )
+        for user_id, data in pending.items():
+            if data is None:
+                self._written.pop(user_id, None)
+                self._updated.pop(user_id, None)
+            else:
+                self._written[user_id] = hash(data)
+                self._updated[user_id] = now
+        DRAFT_ROWS_WRITTEN.inc(len(pending))
+        DRAFT_FLUSH_LATENCY.observe(time.perf_counter() - began)
+
+    def expired(self, now: float) -> list[int]:
+        """Пользователи, чьи черновики не менялись дольше ttl."""
+        cutoff = now - self.ttl.total_seconds()
+        return [user_id for user_id, updated_at in self._updated.items() if updated_at < cutoff]
+
+    async def flush(self):
+        self.write_pending()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
 
-from telegram import (
-    Update,
-    InlineKeyboardButton,
-    InlineKeyboardMarkup,
-    ReplyKeyboardMarkup,
-    KeyboardButton,
-    InputMediaPhoto
-)
-from telegram.ext import (
-    Application,
-    CommandHandler,
-    MessageHandler,
-    CallbackQueryHandler,
-    ContextTypes,
-    filters,
-)
-from flask import Flask
-from dotenv import load_dotenv
+    async def get_chat_data(self) -> dict:
+        return {}
 
-# ---------- Flask (healthcheck для Railway) ----------
-app = Flask(__name__)
+    async def get_bot_data(self) -> dict:
+        return {}
 
-@app.route("/")
-def health_check():
-    return "Mrush1 Bot is running", 200
+    async def get_callback_data(self):
+        return None
 
-def run_flask():
-    app.run(
-        host="0.0.0.0",
-        port=int(os.getenv("PORT", 8000)),
-        debug=False,
-        use_reloader=False
-    )
+    async def get_conversations(self, name: str) -> dict:
+        return {}
 
-# ---------- Логирование ----------
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO,
-)
-logger = logging.getLogger(__name__)
+    async def update_conversation(self, name: str, key, new_state):
+        pass
 
-# ---------- Конфигурация ----------
-load_dotenv()
-TOKEN = os.getenv("BOT_TOKEN")
-if not TOKEN:
-    raise ValueError("BOT_TOKEN не найден в переменных окружения!")
+    async def update_chat_data(self, chat_id: int, data: dict):
+        pass
 
-# Канал (обязательная подписка)
-CHANNEL_ID = os.getenv("CHANNEL_ID", "@shop_mrush1")
-# Беседа (обязательное участие)
-CHAT_ID = "@chat_mrush1"  # Публичная супергруппа (см. https://t.me/chat_mrush1)
+    async def update_bot_data(self, data: dict):
+        pass
 
-START_HOUR = 5
-END_HOUR = 20
+    async def update_callback_data(self, data):
+        pass
 
-FORBIDDEN_WORDS = {"сука", "блять", "пиздец", "хуй", "ебать"}
-ALLOWED_IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif"}
+    async def drop_chat_data(self, chat_id: int):
+        pass
 
-# Хранение информации о постах в оперативной памяти
-user_posts = {}
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        pass
 
-# Простое меню бота
-MAIN_MENU = ReplyKeyboardMarkup(
-    keyboard=[
-        [KeyboardButton("📤 Разместить объявление")],
-        [KeyboardButton("❓ Помощь")],
-    ],
-    resize_keyboard=True,
-)
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        pass
 
-# Inline-кнопки для быстрого перехода и проверки
-SUBSCRIBE_CHECK_KEYBOARD = InlineKeyboardMarkup([
-    [
-        InlineKeyboardButton("Канал @shop_mrush1", url="https://t.me/shop_mrush1")
-    ],
-    [
-        InlineKeyboardButton("Беседа @chat_mrush1", url="https://t.me/chat_mrush1")
-    ],
-    [
-        InlineKeyboardButton("Проверить подписку", callback_data="check_subscription")
-    ]
-])
+    async def refresh_bot_data(self, bot_data: dict):
+        pass
 
-def is_within_working_hours() -> bool:
-    now = datetime.now()
-    current_time = now.hour + now.minute / 60
-    return START_HOUR <= current_time < END_HOUR
+async def expire_drafts(context: ContextTypes.DEFAULT_TYPE):
+    """Удаляет брошенные черновики: пользователь начнёт заново с «Разместить объявление»."""
+    application = context.application
+    expired = application.persistence.expired(time.time())
+    for user_id in expired:
+        application.drop_user_data(user_id)
+    DRAFTS_EXPIRED.inc(len(expired))
 
-async def check_subscriptions(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> tuple[bool, str]:
+# ---------- Магазины ----------
+class Shop:
     """
-    Проверяет, состоит ли пользователь в обязательном канале и беседе.
-    Возвращает (True, '') при успехе либо (False, текст_ошибки).
+    Магазин (тенант): свой бот, обязательные канал и беседа, правила модерации,
+    лимиты и часы работы. Индексы объявлений и очередь публикаций у каждого
+    магазина свои; цикл событий, HTTP-пул, хранилище и кэши — общие на процесс.
     """
-    # Сначала проверяем канал (ростер должен быть public: @shop_mrush1)
-    try:
-        member_channel = await context.bot.get_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
-        if member_channel.status == "kicked":
-            return False, "❌ Вы были заблокированы в канале и не можете использовать бота."
-        if member_channel.status not in ["member", "administrator", "creator"]:
-            return False, "❌ Вы не подписаны на основной канал."
-    except Exception as e:
-        logger.error(f"Ошибка проверки подписки на канал {CHANNEL_ID}: {e}")
-        return False, "❌ Произошла ошибка при проверке подписки на канал."
 
-    # Затем проверяем беседу (должна быть публичной супергруппой: @chat_mrush1)
-    try:
-        member_chat = await context.bot.get_chat_member(chat_id=CHAT_ID, user_id=user_id)
-        if member_chat.status == "kicked":
-            return False, "❌ Вы были заблокированы в беседе и не можете использовать бота."
-        if member_chat.status not in ["member", "administrator", "creator"]:
-            return False, "❌ Вы не состоите в обязательной беседе."
-    except Exception as e:
-        logger.error(f"Ошибка проверки участия в беседе {CHAT_ID}: {e}")
-        return False, "❌ Произошла ошибка при проверке вашего статуса в беседе."
+    def __init__(
+        self,
+        name: str,
+        token: str,
+        channel_id: str,
+        chat_id: str,
+        admin_username: str,
+        rules: MessageRules,
+        rules_url: str,
+        daily_post_limit: int,
+        channel_rate_per_minute: int,
+        timezone: ZoneInfo,
+        timezone_label: str,
+        start_hour: int,
+        end_hour: int,
+        webhook_path: str,
+    ):
+        self.name = name
+        self.token = token
+        self.channel_id = channel_id
+        self.chat_id = chat_id
+        self.admin_username = admin_username
+        self.rules = rules
+        self.daily_post_limit = daily_post_limit
+        self.channel_rate_per_minute = channel_rate_per_minute
+        self.timezone = timezone
+        self.start_hour = start_hour
+        self.end_hour = end_hour
+        self.webhook_path = webhook_path
+        self.working_hours_text = f"с {start_hour}:00 до {end_hour}:00 по {timezone_label}"
+        self.subscribe_keyboard = subscribe_check_keyboard(channel_id, chat_id)
+        rules_link = f"<a href='{rules_url}'>{rules_url.removeprefix('https://')}</a>"
+        self.greeting_text = GREETING_TEXT.format(rules_link=rules_link)
+        self.help_text = HELP_TEXT.format(rules_link=rules_link)
+        self.example_caption = EXAMPLE_CAPTION.format(admin_username=admin_username)
 
-    return True, ""
+        self.post_ledger = PostLedger(DUPLICATE_WINDOW)
+        self.duplicate_index = DuplicateIndex(DUPLICATE_WINDOW, DUPLICATE_THRESHOLD)
+        self.image_index = ImageIndex(DUPLICATE_WINDOW, IMAGE_HASH_DISTANCE)
+        self.search_index = SearchIndex(SEARCH_WINDOW)
+        self.search_index_loader: asyncio.Task | None = None
+        self.index_loader: asyncio.Task | None = None
+        self.publisher = ChannelPublisher(channel_rate_per_minute, CHANNEL_BURST, PUBLISH_MAX_ATTEMPTS)
+        self.application: Application | None = None
 
-def check_post_limit_and_duplicates(user_id: int, text: str) -> tuple[bool, str]:
-    now = datetime.now()
-    if user_id not in user_posts:
-        user_posts[user_id] = {"posts": [], "count": 0, "date": now}
-        return True, ""
+    @classmethod
+    def from_config(cls, config: dict) -> "Shop":
+        """
+        Магазин из словаря настроек; не указанные ключи берутся из переменных окружения:
+        {"name": "mrush1", "token": "..." или "token_env": "MRUSH1_TOKEN",
+         "channel_id": "@shop_mrush1", "chat_id": "@chat_mrush1", "admin_username": "...",
+         "rules_path": "rules.json", "rules_url": "...", "daily_post_limit": 3,
+         "channel_rate_per_minute": 20, "timezone": "Europe/Moscow", "timezone_label": "МСК",
+         "start_hour": 8, "end_hour": 23, "webhook_path": "/telegram/mrush1"}
+        """
+        name = config["name"]
+        token = config.get("token") or os.getenv(config.get("token_env", ""))
+        if not token:
+            raise ValueError(f"Не задан токен бота магазина {name}!")
+        admin_username = config.get("admin_username", ADMIN_USERNAME)
+        return cls(
+            name=name,
+            token=token,
+            channel_id=config.get("channel_id", CHANNEL_ID),
+            chat_id=config.get("chat_id", CHAT_ID),
+            admin_username=admin_username,
+            rules=load_message_rules(config.get("rules_path", RULES_PATH), admin_username),
+            rules_url=config.get("rules_url", RULES_URL),
+            daily_post_limit=config.get("daily_post_limit", DAILY_POST_LIMIT),
+            channel_rate_per_minute=config.get("channel_rate_per_minute", CHANNEL_RATE_PER_MINUTE),
+            timezone=ZoneInfo(config["timezone"]) if "timezone" in config else TIMEZONE,
+            timezone_label=config.get("timezone_label", TIMEZONE_LABEL),
+            start_hour=config.get("start_hour", START_HOUR),
+            end_hour=config.get("end_hour", END_HOUR),
+            webhook_path=config.get("webhook_path", f"{WEBHOOK_PATH}/{name}"),
+        )
 
-    user_data = user_posts[user_id]
-    # Сбрасываем счётчик, если наступил новый день
-    if now.date() != user_data["date"].date():
-        user_posts[user_id] = {"posts": [], "count": 0, "date": now}
+    async def indexes_loaded(self):
+        """Дожидается восстановления индексов объявлений после запуска (load_indexes)."""
+        if self.index_loader is not None and not self.index_loader.done():
+            await asyncio.shield(self.index_loader)
 
-    if user_posts[user_id]["count"] >= 3:
-        return False, "❌ Вы превысили лимит в 3 поста за сутки. Попробуйте завтра."
+    @property
+    def search_ready(self) -> bool:
+        """Поиск готов: load_indexes прочитал объявления, а load_search_index их проиндексировал."""
+        return all(loader is None or loader.done() for loader in (self.index_loader, self.search_index_loader))
 
-    # Проверка на дубликаты (90%+ схожести)
-    for post, post_time in user_data["posts"]:
-        similarity = calculate_similarity(text.strip(), post.strip())
-        if similarity >= 0.9:
-            time_diff = now - post_time
-            if time_diff < timedelta(days=1):
-                hours_left = 24 - time_diff.total_seconds() // 3600
-                return False, f"❌ Похожий пост уже публиковался. Повторная публикация возможна через {int(hours_left)} ч."
+    def local_now(self) -> datetime:
+        return datetime.now(self.timezone)
 
-    return True, ""
+    def is_within_working_hours(self) -> bool:
+        now = self.local_now()
+        current_time = now.hour + now.minute / 60
+        return self.start_hour <= current_time < self.end_hour
 
-def calculate_similarity(text1: str, text2: str) -> float:
-    """Вычисляет схожесть двух текстов (0.0 - 1.0)"""
-    if not text1 or not text2:
-        return 0.0
-    
-    # Приводим к нижнему регистру и убираем лишние пробелы
-    text1 = text1.lower().strip()
-    text2 = text2.lower().strip()
-    
-    if text1 == text2:
-        return 1.0
-    
-    # Простой алгоритм схожести на основе общих слов
-    words1 = set(text1.split())
-    words2 = set(text2.split())
-    
-    if not words1 or not words2:
-        return 0.0
-    
-    intersection = words1.intersection(words2)
-    union = words1.union(words2)
-    
-    return len(intersection) / len(union) if union else 0.0
+def load_shops() -> list[Shop]:
+    """Магазины из SHOPS_PATH либо единственный магазин из переменных окружения."""
+    if not SHOPS_PATH:
+        return [Shop.from_config({"name": DEFAULT_SHOP, "token": TOKEN, "webhook_path": WEBHOOK_PATH})]
+    with open(SHOPS_PATH, encoding="utf-8") as shops_file:
+        loaded = [Shop.from_config(config) for config in json.load(shops_file)]
+    names = [shop.name for shop in loaded]
+    if not loaded or len(set(names)) != len(names):
+        raise ValueError(f"В {SHOPS_PATH} нужен хотя бы один магазин, имена не должны повторяться")
+    return loaded
 
-def add_successful_post(user_id: int, text: str):
-    now = datetime.now()
-    user_data = user_posts[user_id]
-    user_data["posts"].append([text, now])
-    user_data["count"] += 1
-    user_data["date"] = now
-
-def check_message(text: str, user_username: str) -> tuple[bool, str]:
-    text_lower = text.lower()
-    user_username = (user_username or "").lower()
-
-    # Проверка на наличие @username (связь с продавцом/покупателем)
-    usernames = re.findall(r"@([a-zA-Z0-9_]{5,})", text)
-    if not usernames:
-        return False, "❌ В сообщении отсутствует контактная информация (@username)."
-
-    # Проверка действия (продам/куплю/обмен)
-    actions = ["продам", "обмен", "куплю", "продаю", "обменяю", "покупка", "продажа", "#офтоп", "#оффтоп"]
-    if not any(action in text_lower for action in actions):
-        return False, "❌ Укажите действие: продам/куплю/обмен"
-
-    # Мат
-    if any(word in text_lower for word in FORBIDDEN_WORDS):
-        return False, "❌ Обнаружен мат. Уберите его."
-
-    # Слишком много капса
-    if len(text) > 10 and (sum(c.isupper() for c in text) / len(text) > 0.7):
-        return False, "❌ Слишком много текста в верхнем регистре (капс)."
-
-    # Упоминания ботов
-    if re.search(r"@[a-zA-Z0-9_]*bot\b", text_lower):
-        return False, "❌ Упоминания ботов запрещены."
-
-    # Лишние упоминания чужих @username
-    for username in usernames:
-        username_lower = username.lower()
-        if username_lower.endswith("bot"):
-            continue
-        if username_lower not in [user_username, "vardges_grigoryan"]:
-            return False, f"❌ Упоминание @{username} запрещено. Укажите свой контакт (@ваш_ник)."
+shops = load_shops()
 
-    return True, "✅ Сообщение соответствует требованиям."
+def shop_of(context: ContextTypes.DEFAULT_TYPE) -> Shop:
+    """Магазин, чей бот получил апдейт (или чья задача JobQueue выполняется)."""
+    return context.bot_data["shop"]
 
-def check_file_extension(file_name: str) -> bool:
-    if not file_name:
-        return False
-    return any(file_name.lower().endswith(ext) for ext in ALLOWED_IMAGE_EXTENSIONS)
+# ---------- Проверка объявления ----------
+# Классы стоимости шагов проверки: чем меньше, тем раньше шаг выполняется
+COST_TRIVIAL = 0  # сравнение полей сообщения
+COST_CPU = 1      # разбор текста
+COST_STORAGE = 2  # обращение к хранилищу и индексам
+COST_NETWORK = 3  # запросы к Bot API
 
-# ---------- Приветственное сообщение ----------
-async def send_welcome_message(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
-    greeting = (
-        "<b>🤖 Привет! Я бот для размещения объявлений о покупке/продаже цифровых ценностей.</b>\n\n"
-        "📝 <b>Как разместить объявление:</b>\n"
-        "1. Нажмите «📤 Разместить объявление»\n"
-        "2. Отправьте до 5 фотографий (если нужно)\n"
-        "3. Отправьте текст объявления\n"
-        "4. Готово!\n\n"
-        "📌 <b>Основные правила:</b>\n"
-        "• Укажите действие: продам/куплю/обмен\n"
-        "• Укажите цену или бюджет\n"
-        "• Оставьте свой @username для связи\n"
-        "• Не используйте мат и капс\n"
-        "• Можно прикрепить до 5 фотографий к одному объявлению\n\n"
-        "Полные правила: <a href='https://t.me/shop_mrush1/13'>t.me/shop_mrush1/13</a>"
-    )
+class PostDraft:
+    """Объявление, которое проверяется перед постановкой в очередь публикаций."""
 
-    await context.bot.send_message(
-        chat_id=chat_id,
-        text=greeting,
-        parse_mode="HTML",
-        disable_web_page_preview=True,
-        reply_markup=MAIN_MENU,
-    )
+    __slots__ = ("shop", "user_id", "username", "text", "document", "thumbnails", "image_hashes", "context")
 
-    # Пример изображения
-    try:
-        with open("primerbot.jpg", "rb") as photo:
-            await context.bot.send_photo(
-                chat_id=chat_id,
-                photo=photo,
-                caption=(
-                    "Пример объявления:\n"
-                    "«Продам за 100₽ или обменяю на акк посильнее с моей доплатой. "
-                    "На аккаунте есть возможность указать свою почту. "
-                    "Контакты для связи: @vardges_grigoryan»"
-                ),
+    def __init__(
+        self,
+        shop: Shop,
+        user_id: int,
+        username: str,
+        text: str,
+        document,
+        context: ContextTypes.DEFAULT_TYPE,
+        thumbnails: list[str] = (),
+    ):
+        self.shop = shop
+        self.user_id = user_id
+        self.username = username
+        self.text = text
+        self.document = document
+        self.thumbnails = thumbnails
+        self.image_hashes: tuple[int, ...] = ()
+        self.context = context
+
+class Validator:
+    """
+    Шаг проверки: check(draft) возвращает (ok, текст_ошибки), может быть корутиной.
+    reply_markup — клавиатура, которую получит пользователь при отказе,
+    либо функция магазина, возвращающая её.
+    """
+
+    def __init__(self, name: str, cost: int, check, reply_markup=MAIN_MENU):
+        self.name = name
+        self.cost = cost
+        self.check = check
+        self.reply_markup = reply_markup
+        self._runs = VALIDATOR_RUNS.labels(name)
+        self._rejections = VALIDATOR_REJECTIONS.labels(name)
+
+    def markup(self, shop: Shop):
+        return self.reply_markup(shop) if callable(self.reply_markup) else self.reply_markup
+
+    async def run(self, draft: PostDraft) -> tuple[bool, str]:
+        self._runs.inc()
+        result = self.check(draft)
+        if inspect.isawaitable(result):
+            result = await result
+        if not result[0]:
+            self._rejections.inc()
+            logger.info(
+                "Объявление пользователя %s отклонено: %s", draft.user_id, self.name,
+                extra={"shop": draft.shop.name, "user_id": draft.user_id, "reason": self.name},
             )
-    except FileNotFoundError:
-        await context.bot.send_message(chat_id=chat_id, text="⚠️ Не удалось найти пример изображения.", disable_web_page_preview=True)
+        return result
+
+class ValidationPipeline:
+    """
+    Выполняет шаги от дешёвых к дорогим и останавливается на первом отказе,
+    поэтому отклонённое по содержанию объявление не стоит ни одного запроса к API.
+    Сетевые шаги независимы друг от друга и при concurrent_network идут параллельно.
+    """
+
+    def __init__(self, validators: list[Validator], concurrent_network: bool):
+        ordered = sorted(validators, key=lambda validator: validator.cost)
+        self.local = [validator for validator in ordered if validator.cost < COST_NETWORK]
+        self.network = [validator for validator in ordered if validator.cost >= COST_NETWORK]
+        self.concurrent_network = concurrent_network
+
+    async def run(self, draft: PostDraft) -> tuple[Validator | None, str]:
+        """Возвращает (None, '') либо (отказавший шаг, текст ошибки)."""
+        for validator in self.local:
+            ok, error = await validator.run(draft)
+            if not ok:
+                return validator, error
+
+        if self.concurrent_network and len(self.network) > 1:
+            results = await asyncio.gather(*(validator.run(draft) for validator in self.network))
+        else:
+            results = []
+            for validator in self.network:
+                results.append(await validator.run(draft))
+                if not results[-1][0]:
+                    break
+        for validator, (ok, error) in zip(self.network, results):
+            if not ok:
+                return validator, error
+        return None, ""
+
+def validate_text_present(draft: PostDraft) -> tuple[bool, str]:
+    if draft.text:
+        return True, ""
+    return False, "❌ Добавьте текст объявления (можно как подпись к фото)."
+
+def validate_document(draft: PostDraft) -> tuple[bool, str]:
+    if draft.document and not check_file_extension(draft.document.file_name):
+        return False, "❌ Недопустимые файлы. Разрешены только JPG, JPEG, PNG, GIF."
+    return True, ""
+
+def validate_not_queued(draft: PostDraft) -> tuple[bool, str]:
+    if draft.shop.publisher.is_pending(draft.user_id) or deferred_posts.is_pending(draft.shop, draft.user_id):
+        return False, "⏳ Предыдущее объявление ещё ждёт публикации. Дождитесь его, прежде чем отправлять новое."
+    return True, ""
+
+async def validate_subscriptions(draft: PostDraft) -> tuple[bool, str]:
+    # Перед публикацией ещё раз убеждаемся, что пользователь подписан
+    ok, error = await check_subscriptions(draft.context, draft.user_id)
+    if ok:
+        return True, ""
+    return False, f"{error}\nПожалуйста, подпишитесь на канал и беседу и нажмите «Проверить подписку»:"
+
+async def validate_images(draft: PostDraft) -> tuple[bool, str]:
+    if not draft.thumbnails:
+        return True, ""
+    draft.image_hashes = await image_hasher.hash_photos(draft.context.bot, draft.thumbnails)
+    return check_image_duplicates(draft.shop, draft.image_hashes, datetime.now())
+
+post_validation = ValidationPipeline(
+    [
+        Validator("text_present", COST_TRIVIAL, validate_text_present),
+        Validator("document", COST_TRIVIAL, validate_document),
+        Validator("not_queued", COST_TRIVIAL, validate_not_queued),
+        Validator("content", COST_CPU, lambda draft: draft.shop.rules.check(draft.text, draft.username)),
+        Validator(
+            "limit_and_duplicates", COST_STORAGE,
+            lambda draft: check_post_limit_and_duplicates(draft.shop, draft.user_id, draft.text),
+        ),
+        Validator("subscriptions", COST_NETWORK, validate_subscriptions, lambda shop: shop.subscribe_keyboard),
+        Validator("images", COST_NETWORK, validate_images),
+    ],
+    concurrent_network=VALIDATE_NETWORK_CONCURRENTLY,
+)
 
 # ---------- Обработка поста ----------
 async def handle_post(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    shop = shop_of(context)
     msg = update.message
     user = msg.from_user
     user_id = user.id
@@ -274,45 +2590,133 @@ async def handle_post(update: Update, context: ContextTypes.DEFAULT_TYPE):
     saved_photos = context.user_data.get("post_photos", [])
     current_photos = msg.photo or []
     document = msg.document
+    photos = saved_photos or ([current_photos[-1].file_id] if current_photos else [])
+    if saved_photos:
+        saved_thumbnails = context.user_data.get("post_thumbnails", {})
+        thumbnails = [saved_thumbnails[photo] for photo in saved_photos if saved_thumbnails.get(photo)]
+    else:
+        thumbnails = [thumbnail for thumbnail in [thumbnail_id(msg)] if thumbnail]
+
+    # Сразу после запуска индексы дубликатов ещё восстанавливаются
+    await shop.indexes_loaded()
+    # Проверки от дешёвых к дорогим, до первого отказа
+    draft = PostDraft(shop, user_id, user_username, text, document, context, thumbnails)
+    validator, error = await post_validation.run(draft)
+    if validator:
+        await msg.reply_text(error, reply_markup=validator.markup(shop), disable_web_page_preview=True)
+        return
+
+    reserved, error, index_id, image_id = reserve_post(shop, user_id, text, draft.image_hashes)
+    if not reserved:
+        await msg.reply_text(error, reply_markup=MAIN_MENU, disable_web_page_preview=True)
+        return
+
+    job = PublishJob(
+        shop=shop,
+        user_id=user_id,
+        chat_id=msg.chat_id,
+        message_id=msg.message_id,
+        text=text,
+        photos=photos,
+        document=document.file_id if document and not photos else None,
+        index_id=index_id,
+        image_hashes=draft.image_hashes,
+        image_id=image_id,
+    )
 
-    if not is_within_working_hours():
-        current_time = datetime.now().strftime("%H:%M")
+    # Объявление сохраняется до публикации, чтобы пережить перезапуск; в нерабочее
+    # время оно ждёт начала дня в отложенной очереди
+    working = shop.is_within_working_hours()
+    if not deferred_posts.add(job, released=working):
+        release_reservation(job)
         await msg.reply_text(
-            f"⏰ Бот работает с 8:00 до 23:00 по МСК. Сейчас {current_time}. Пожалуйста, напишите завтра с 8:00.",
+            "⏳ Предыдущее объявление ещё ждёт публикации. Дождитесь его, прежде чем отправлять новое.",
             reply_markup=MAIN_MENU,
             disable_web_page_preview=True
         )
         return
-
-    # Перед публикацией ещё раз убеждаемся, что пользователь подписан
-    subscriptions_ok, subscriptions_msg = await check_subscriptions(context, user_id)
-    if not subscriptions_ok:
+    if not working:
         await msg.reply_text(
-            f"{subscriptions_msg}\n"
-            "Пожалуйста, подпишитесь на канал и беседу и нажмите «Проверить подписку»:",
-            reply_markup=SUBSCRIBE_CHECK_KEYBOARD,
+            f"🌙 Бот публикует объявления {shop.working_hours_text}. Ваше объявление проверено "
+            f"и выйдет после {shop.start_hour}:00 — мы сообщим, когда оно будет опубликовано.",
+            reply_markup=MAIN_MENU,
             disable_web_page_preview=True
         )
         return
 
-    if not text:
-        await msg.reply_text("❌ Добавьте текст объявления (можно как подпись к фото).", reply_markup=MAIN_MENU, disable_web_page_preview=True)
-        return
+    shop.publisher.submit(job)
+    await msg.reply_text(
+        "⏳ Объявление принято и будет опубликовано в ближайшее время.",
+        reply_markup=MAIN_MENU,
+        disable_web_page_preview=True
+    )
 
-    # Лимит и дубликаты
-    limit_ok, limit_msg = check_post_limit_and_duplicates(user_id, text)
-    if not limit_ok:
-        await msg.reply_text(limit_msg, reply_markup=MAIN_MENU, disable_web_page_preview=True)
-        return
+# ---------- Альбомы ----------
+class AlbumBuffer:
+    """Фотографии одного альбома, пришедшие отдельными апдейтами."""
 
-    # Проверка контента
-    content_ok, content_msg = check_message(text, user_username)
-    if not content_ok:
-        await msg.reply_text(content_msg, reply_markup=MAIN_MENU, disable_web_page_preview=True)
+    __slots__ = ("update", "context", "items", "caption", "invalid_documents", "timer")
+
+    def __init__(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        self.update = update
+        self.context = context
+        self.items: list[tuple[int, str, str | None]] = []  # (message_id, file_id, thumbnail)
+        self.caption: str | None = None
+        self.invalid_documents = False
+        self.timer: asyncio.TimerHandle | None = None
+
+album_buffers: dict[tuple[str, int, str], AlbumBuffer] = {}  # (магазин, чат, media_group_id)
+
+def collect_album_item(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Копит сообщения альбома и откладывает обработку на ALBUM_DEBOUNCE секунд
+    после последнего из них: весь альбом обрабатывается одним вызовом.
+    """
+    msg = update.message
+    key = (shop_of(context).name, msg.chat_id, msg.media_group_id)
+    album = album_buffers.get(key)
+    if album is None:
+        album = album_buffers[key] = AlbumBuffer(update, context)
+    else:
+        album.timer.cancel()
+
+    if msg.photo:
+        album.items.append((msg.message_id, msg.photo[-1].file_id, thumbnail_id(msg)))
+    elif check_file_extension(msg.document.file_name):
+        album.items.append((msg.message_id, msg.document.file_id, thumbnail_id(msg)))
+    else:
+        album.invalid_documents = True
+
+    if msg.caption and not album.caption:
+        album.caption = msg.caption.strip()
+        album.update = update
+
+    # Обработка альбома идёт в очереди апдейтов того же пользователя
+    user_id = msg.from_user.id
+    album.timer = asyncio.get_running_loop().call_later(
+        ALBUM_DEBOUNCE,
+        lambda: context.application.create_task(
+            update_scheduler.submit(user_id, lambda: process_album(key)), update=album.update
+        ),
+    )
+
+async def flush_albums(shop: Shop, chat_id: int):
+    """Обрабатывает альбомы чата, не дожидаясь таймера (пришло следующее сообщение)."""
+    for key in [key for key in album_buffers if key[:2] == (shop.name, chat_id)]:
+        album_buffers[key].timer.cancel()
+        await process_album(key)
+
+async def process_album(key: tuple[str, int, str]):
+    album = album_buffers.pop(key, None)
+    if album is None:
         return
+    msg = album.update.message
+    user_data = album.context.user_data
+    items = sorted(album.items)
+    file_ids = [file_id for _, file_id, _ in items]
+    thumbnails = {file_id: thumbnail for _, file_id, thumbnail in items if thumbnail}
 
-    # Проверка документа, если он есть
-    if document and not check_file_extension(document.file_name):
+    if album.invalid_documents:
         await msg.reply_text(
             "❌ Недопустимые файлы. Разрешены только JPG, JPEG, PNG, GIF.",
             reply_markup=MAIN_MENU,
@@ -320,82 +2724,75 @@ async def handle_post(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    try:
-        # Если есть сохранённые фотографии (режим создания поста с несколькими фото)
-        if saved_photos:
-            if len(saved_photos) == 1:
-                # Одна фотография - используем send_photo
-                await context.bot.send_photo(
-                    chat_id=CHANNEL_ID,
-                    photo=saved_photos[0],
-                    caption=text
-                )
-            else:
-                # Несколько фотографий - используем send_media_group
-                media_group = []
-                for i, photo_id in enumerate(saved_photos):
-                    # Подпись только к первой фотографии
-                    if i == 0:
-                        media_group.append(InputMediaPhoto(media=photo_id, caption=text))
-                    else:
-                        media_group.append(InputMediaPhoto(media=photo_id))
-                
-                await context.bot.send_media_group(
-                    chat_id=CHANNEL_ID,
-                    media=media_group
-                )
-        # Если фотография в текущем сообщении (старый способ - для обратной совместимости)
-        elif current_photos:
-            await context.bot.send_photo(
-                chat_id=CHANNEL_ID,
-                photo=current_photos[-1].file_id,
-                caption=text
-            )
-        # Если документ в текущем сообщении
-        elif document:
-            await context.bot.send_document(
-                chat_id=CHANNEL_ID,
-                document=document.file_id,
-                caption=text
+    # Альбом без режима создания поста публикуется одним объявлением
+    if not user_data.get("awaiting_post", False):
+        skipped = len(file_ids) - 5
+        if skipped > 0:
+            await msg.reply_text(
+                f"ℹ️ В объявление попадут первые 5 фотографий альбома. Не поместилось: {skipped}.",
+                disable_web_page_preview=True
             )
-        # Только текст
-        else:
-            await context.bot.send_message(chat_id=CHANNEL_ID, text=text, disable_web_page_preview=True)
+        user_data["post_photos"] = file_ids[:5]
+        user_data["post_thumbnails"] = thumbnails
+        try:
+            await handle_post(album.update, album.context)
+        finally:
+            user_data.pop("post_photos", None)
+            user_data.pop("post_thumbnails", None)
+        return
 
-        add_successful_post(user_id, text)
-        await msg.reply_text("✅ Ваше объявление успешно опубликовано!", reply_markup=MAIN_MENU, disable_web_page_preview=True)
-    except Exception as e:
-        logger.exception(f"Ошибка при публикации объявления: {e}")
+    photos = user_data.get("post_photos", [])
+    added = file_ids[:5 - len(photos)]
+    if not added:
         await msg.reply_text(
-            "❌ Произошла ошибка при публикации объявления. Попробуйте чуть позже.",
+            "❌ Вы уже добавили максимальное количество фотографий (5). "
+            "Отправьте текст объявления для публикации.",
             reply_markup=MAIN_MENU,
             disable_web_page_preview=True
         )
+        return
+
+    photos.extend(added)
+    user_data["post_photos"] = photos
+    for file_id in added:
+        remember_thumbnail(user_data, file_id, thumbnails.get(file_id))
+    if album.caption:
+        user_data["post_text"] = album.caption
+
+    skipped = len(file_ids) - len(added)
+    await msg.reply_text(
+        f"✅ Фотографии добавлены ({len(photos)}/5)."
+        + (f" Не поместилось: {skipped}." if skipped else "")
+        + f"\nМожно добавить ещё {5 - len(photos)} фотографий или отправить текст объявления для публикации.",
+        reply_markup=MAIN_MENU,
+        disable_web_page_preview=True
+    )
 
 # ---------- Команды / колбэки / сообщения ----------
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Срабатывает, когда пользователь пишет /start.
-    Проверяем, подписан ли пользователь на канал @shop_mrush1 и беседу @chat_mrush1.
+    Проверяем, подписан ли пользователь на канал и беседу магазина.
     Если нет — выводим сообщение и Inline-клавиатуру.
     Если да, показываем приветственное меню.
     """
+    shop = shop_of(context)
     user_id = update.effective_user.id
 
-    if not is_within_working_hours():
-        current_time = datetime.now().strftime("%H:%M")
+    if not shop.is_within_working_hours():
+        current_time = shop.local_now().strftime("%H:%M")
         await update.message.reply_text(
-            f"⏰ Бот работает с 8:00 до 23:00 по МСК. Сейчас {current_time}. Пожалуйста, напишите позже.",
+            f"⏰ Бот публикует объявления {shop.working_hours_text}. Сейчас {current_time}. "
+            f"Объявление можно отправить уже сейчас — оно выйдет после {shop.start_hour}:00.",
             disable_web_page_preview=True
         )
-        return
 
     subscriptions_ok, subscriptions_msg = await check_subscriptions(context, user_id)
     if not subscriptions_ok:
         await update.message.reply_text(
             f"{subscriptions_msg}\n"
             "После подписки нажмите «Проверить подписку».",
-            reply_markup=SUBSCRIBE_CHECK_KEYBOARD,
+            reply_markup=shop.subscribe_keyboard,
             disable_web_page_preview=True
         )
         return
@@ -404,33 +2801,45 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def contact_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
-        "👨‍💻 Если у вас возникли вопросы — пишите администратору: @vardges_grigoryan",
+        f"👨‍💻 Если у вас возникли вопросы — пишите администратору: @{shop_of(context).admin_username}",
         reply_markup=MAIN_MENU,
         disable_web_page_preview=True
     )
 
 async def show_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    help_text = (
-        "📌 <b>Как разместить объявление:</b>\n"
-        "1. Нажмите «📤 Разместить объявление»\n"
-        "2. Отправьте до 5 фотографий (если нужно)\n"
-        "3. Отправьте текст объявления\n"
-        "4. Готово!\n\n"
-        "📌 <b>Основные правила:</b>\n"
-        "• Укажите действие: продам/куплю/обмен\n"
-        "• Укажите цену или бюджет\n"
-        "• Оставьте свой @username для связи\n"
-        "• Не используйте мат и капс\n"
-        "• Можно прикрепить до 5 фотографий к одному объявлению\n\n"
-        "Полные правила: <a href='https://t.me/shop_mrush1/13'>t.me/shop_mrush1/13</a>"
-    )
     await update.message.reply_text(
-        help_text,
+        shop_of(context).help_text,
         parse_mode="HTML",
         reply_markup=MAIN_MENU,
         disable_web_page_preview=True
     )
 
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/search запрос — объявления за SEARCH_WINDOW с постраничным выводом."""
+    query = " ".join(context.args)
+    terms, action, min_price, max_price = parse_search_query(query)
+    if not (terms or action or min_price is not None or max_price is not None):
+        await update.message.reply_text(
+            "🔎 Напишите, что ищете, например:\n/search куплю акк до 500\n/search продам кристаллы",
+            disable_web_page_preview=True
+        )
+        return
+
+    shop = shop_of(context)
+    if not shop.search_ready:
+        await update.message.reply_text("⏳ Поиск обновляется после перезапуска. Попробуйте через минуту.", disable_web_page_preview=True)
+        return
+
+    results = shop.search_index.search(terms, datetime.now(), action, min_price, max_price)
+    if not results:
+        await update.message.reply_text("🔎 Ничего не найдено. Попробуйте изменить запрос.", disable_web_page_preview=True)
+        return
+
+    # Страницы листаются по сохранённому списку, без повторного поиска
+    context.user_data["search_results"] = results
+    text, keyboard = format_search_page(shop, results, 0)
+    await update.message.reply_text(text, parse_mode="HTML", reply_markup=keyboard, disable_web_page_preview=True)
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.message
     text = msg.text
@@ -447,9 +2856,16 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         context.user_data["awaiting_post"] = True
         context.user_data["post_photos"] = []  # Список file_id фотографий
+        context.user_data["post_thumbnails"] = {}  # file_id фотографии -> file_id маленькой копии
         context.user_data["post_text"] = None  # Текст объявления
         return
 
+    # Фотографии альбома приходят отдельными апдейтами — собираем их вместе
+    if msg.media_group_id and (msg.photo or msg.document):
+        collect_album_item(update, context)
+        return
+    await flush_albums(shop_of(context), msg.chat_id)
+
     # Если пользователь уже выбрал «Разместить объявление»
     if context.user_data.get("awaiting_post", False):
         # Если это фотография
@@ -467,6 +2883,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # Сохраняем file_id самой большой версии фотографии
             photos.append(msg.photo[-1].file_id)
             context.user_data["post_photos"] = photos
+            remember_thumbnail(context.user_data, msg.photo[-1].file_id, thumbnail_id(msg))
             
             # Если есть подпись к фото, сохраняем её как текст
             if msg.caption:
@@ -504,6 +2921,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # Для документов-изображений сохраняем file_id
             photos.append(msg.document.file_id)
             context.user_data["post_photos"] = photos
+            remember_thumbnail(context.user_data, msg.document.file_id, thumbnail_id(msg))
             
             # Если есть подпись к документу, сохраняем её как текст
             if msg.caption:
@@ -529,6 +2947,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # Очищаем данные
             context.user_data["awaiting_post"] = False
             context.user_data.pop("post_photos", None)
+            context.user_data.pop("post_thumbnails", None)
             context.user_data.pop("post_text", None)
             return
 
@@ -542,7 +2961,20 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
+    try:
+        await query.answer()
+    except BadRequest as e:
+        # Нажатие, пролежавшее в очереди перезапуска, уже не ответить — но обработать можно
+        logger.info("Не удалось ответить на нажатие кнопки: %s", e)
+
+    if query.data.startswith("search:"):
+        results = context.user_data.get("search_results")
+        if not results:
+            await query.edit_message_text("🔎 Результаты поиска устарели. Повторите /search.", disable_web_page_preview=True)
+            return
+        text, keyboard = format_search_page(shop_of(context), results, int(query.data.split(":", 1)[1]))
+        await query.edit_message_text(text, parse_mode="HTML", reply_markup=keyboard, disable_web_page_preview=True)
+        return
 
     if query.data == "check_subscription":
         user_id = query.from_user.id
@@ -557,34 +2989,475 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
                     f"{subscriptions_msg}\n\n"
                     "Убедитесь, что подписались и нажмите «Проверить подписку» снова."
                 ),
-                reply_markup=SUBSCRIBE_CHECK_KEYBOARD,
+                reply_markup=shop_of(context).subscribe_keyboard,
                 disable_web_page_preview=True
             )
 
+async def chat_member_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Сбрасывает кэш подписки, когда пользователь вступил/вышел из канала или беседы."""
+    member_update = update.chat_member
+    chat_ref = required_chat_ref(shop_of(context), member_update.chat)
+    if chat_ref:
+        membership_cache.invalidate(chat_ref, member_update.new_chat_member.user.id)
+
+async def flush_post_store(context: ContextTypes.DEFAULT_TYPE):
+    """Периодически сбрасывает буфер постов на диск и удаляет устаревшие записи."""
+    post_store.prune(datetime.now() - POST_RETENTION)
+
+async def sweep_post_ledger(context: ContextTypes.DEFAULT_TYPE):
+    shop = shop_of(context)
+    evicted = shop.post_ledger.sweep(time.time())
+    logger.debug("Журнал постов %s: выброшено %s пользователей, осталось %s", shop.name, evicted, len(shop.post_ledger))
+
+async def load_search_index(shop: Shop, posts: list):
+    began = time.perf_counter()
+    await shop.search_index.load(posts)
+    logger.info(
+        "Поисковый индекс %s собран: %s объявлений за %.2f с",
+        shop.name, len(shop.search_index), time.perf_counter() - began,
+    )
+
+async def compact_search_index(context: ContextTypes.DEFAULT_TYPE):
+    shop_of(context).search_index.compact(datetime.now())
+
+async def load_indexes(application: Application, batch: int = 50):
+    """
+    Восстанавливает индексы объявлений магазина из хранилища, отдавая управление
+    циклу событий каждые batch записей: /start и меню отвечают сразу после запуска,
+    а проверка объявлений ждёт конца загрузки (Shop.indexes_loaded).
+    """
+    shop = application.bot_data["shop"]
+    began = time.perf_counter()
+    now = datetime.now()
+    search_posts = []
+    posts = list(post_store.iter_posts(shop.name, now - POST_RETENTION))
+    for i, (user_id, text, posted_at, message_id) in enumerate(posts, 1):
+        if posted_at >= now - SEARCH_WINDOW:
+            search_posts.append((text, message_id, posted_at))
+        if posted_at >= now - DUPLICATE_WINDOW:
+            shop.post_ledger.add(user_id, token_hashes(text), posted_at.timestamp())
+            shop.duplicate_index.add(user_id, text, posted_at)
+        if i % batch == 0:
+            await asyncio.sleep(0)
+    # Поиск не нужен для приёма объявлений — собираем его отдельно
+    shop.search_index_loader = asyncio.create_task(load_search_index(shop, search_posts))
+    images = list(post_store.iter_images(shop.name, now - DUPLICATE_WINDOW))
+    for i, (user_id, hashes, posted_at) in enumerate(images, 1):
+        shop.image_index.add(user_id, hashes, posted_at)
+        if i % batch == 0:
+            await asyncio.sleep(0)
+    # Неопубликованные объявления снова занимают место в индексе, как при приёме
+    pending = deferred_posts.load(shop)
+    for job, queued_at, _ in pending:
+        job.index_id = shop.duplicate_index.add(job.user_id, job.text, queued_at)
+        job.image_id = shop.image_index.add(job.user_id, job.image_hashes, queued_at)
+    # Не дождавшиеся публикации до остановки возвращаются в очередь канала в прежнем порядке
+    released = [job for job, _, was_released in pending if was_released]
+    for job in released:
+        shop.publisher.submit(job)
+    deferred = len(pending) - len(released)
+    logger.info(
+        "Индекс объявлений %s восстановлен за %.2f с: %s записей, изображений %s, отложено %s, в очереди канала %s",
+        shop.name, time.perf_counter() - began, len(shop.duplicate_index), len(shop.image_index), deferred, len(released),
+    )
+    # Перезапуск в рабочее время: не ждём следующего утра
+    if deferred and shop.is_within_working_hours():
+        application.job_queue.run_once(release_deferred_posts, when=0)
+
+async def post_init(application: Application):
+    shop = application.bot_data["shop"]
+    shop.index_loader = asyncio.create_task(load_indexes(application))
+    shop.publisher.start(application.bot)
+    if CATCH_UP:
+        await catch_up(application)
+
+async def post_stop(application: Application):
+    shop = application.bot_data["shop"]
+    # Остановка сразу после запуска: индексы могут ещё загружаться
+    for loader in (shop.index_loader, shop.search_index_loader):
+        if loader is not None:
+            loader.cancel()
+    await shop.publisher.stop()
+
+def shutdown_shared():
+    """Закрывает общие для всех магазинов ресурсы, когда остановлены все приложения."""
+    post_store.close()
+    deferred_posts.close()
+    image_hasher.close()
+    logger.info("Кэш подписок: %s", membership_cache.stats())
+
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
-    logger.exception(f"Ошибка: {context.error}")
+    user = getattr(update, "effective_user", None)
+    logger.error(
+        "Ошибка: %s", context.error, exc_info=context.error, extra={"user_id": user.id if user else None}
+    )
 
-# ---------- main ----------
-def main():
-    # Запуск Flask в отдельном потоке
-    flask_thread = threading.Thread(target=run_flask, daemon=True)
-    flask_thread.start()
+# ---------- Планировщик апдейтов ----------
+class UserScheduler:
+    """
+    Апдейты разных пользователей обрабатываются параллельно (не больше limit
+    пользователей одновременно), апдейты одного пользователя — строго по порядку.
+    Если принято max_pending необработанных апдейтов, submit ждёт освобождения места.
+    """
 
-    # Приложение PTB
-    application = Application.builder().token(TOKEN).build()
+    def __init__(self, limit: int, max_pending: int):
+        self._slots = asyncio.Semaphore(limit)
+        self._backlog = asyncio.Semaphore(max_pending)
+        self._queues: dict[object, deque] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self.pending = 0
 
+    async def submit(self, key, job):
+        """Ставит job (корутинную функцию без аргументов) в очередь пользователя key."""
+        await self._backlog.acquire()
+        self.pending += 1
+        queue = self._queues.get(key)
+        if queue is not None:
+            queue.append(job)
+            return
+        self._queues[key] = deque([job])
+        self._idle.clear()
+        task = asyncio.create_task(self._drain(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _drain(self, key):
+        queue = self._queues[key]
+        async with self._slots:
+            while queue:
+                try:
+                    await queue[0]()
+                except Exception as e:
+                    logger.exception("Ошибка обработки апдейта: %s", e)
+                finally:
+                    queue.popleft()
+                    self.pending -= 1
+                    self._backlog.release()
+            del self._queues[key]
+            if not self._queues:
+                self._idle.set()
+
+    async def join(self):
+        """Ждёт, пока будут обработаны все принятые апдейты."""
+        await self._idle.wait()
+
+update_scheduler = UserScheduler(UPDATE_CONCURRENCY, UPDATE_BACKLOG)
+
+def update_key(update: object):
+    """Ключ очереди: пользователь, иначе чат; апдейты без них не упорядочиваются."""
+    if isinstance(update, Update):
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+    return object()
+
+class UserOrderedApplication(Application):
+    """Application, передающий апдейты в update_scheduler вместо последовательной обработки."""
+
+    async def process_update(self, update: object):
+        await update_scheduler.submit(update_key(update), partial(super().process_update, update))
+
+    async def stop(self):
+        await super().stop()
+        await update_scheduler.join()
+
+    async def update_persistence(self):
+        await super().update_persistence()
+        # PTB передаёт черновики по одному — записываем изменения интервала пачкой
+        if isinstance(self.persistence, SQLitePersistence):
+            self.persistence.write_pending()
+
+# ---------- Апдейты, накопившиеся за время перезапуска ----------
+STALE_NOTICE = (
+    "⚠️ Пока бот перезапускался, ваши сообщения устарели и не были обработаны. "
+    "Если вы отправляли объявление, отправьте его ещё раз."
+)
+
+def catch_up_priority(update: Update) -> int:
+    """Сначала нажатия кнопок и /start (пользователь ждёт ответа), затем подписки, затем черновики."""
+    if update.callback_query:
+        return 0
+    if update.message and update.message.text and update.message.text.startswith("/start"):
+        return 0
+    if update.chat_member:
+        return 1
+    return 2
+
+def update_date(update: Update) -> datetime | None:
+    """Время апдейта; у нажатий кнопок его нет."""
+    if update.message:
+        return update.message.date
+    if update.chat_member:
+        return update.chat_member.date
+    return None
+
+async def fetch_pending_updates(bot) -> list[Update]:
+    """Забирает все ожидающие апдейты через getUpdates и подтверждает их получение."""
+    # Пока установлен webhook, getUpdates недоступен; ожидающие апдейты сохраняются
+    await bot.delete_webhook(drop_pending_updates=False)
+    updates = []
+    offset = None
+    while True:
+        batch = await bot.get_updates(offset=offset, timeout=0, allowed_updates=ALLOWED_UPDATES)
+        if not batch:
+            return updates
+        updates.extend(batch)
+        offset = batch[-1].update_id + 1
+
+async def catch_up(application: Application):
+    """
+    Обрабатывает апдейты, пришедшие, пока бот был остановлен, до приёма новых.
+    Первыми идут пользователи с апдейтом высшего catch_up_priority, апдейты одного
+    пользователя — как пришли; параллельно не больше CATCH_UP_CONCURRENCY пользователей.
+    Сообщения старше CATCH_UP_MAX_AGE пропускаются, их авторы получают одно уведомление.
+    Анти-флуд на это время отключён: новые апдейты ещё не принимаются.
+    """
+    began = time.perf_counter()
+    updates = await fetch_pending_updates(application.bot)
+    if not updates:
+        return
+    cutoff = application.bot_data["shop"].local_now() - timedelta(seconds=CATCH_UP_MAX_AGE)
+    fresh = []
+    stale_chats: dict[int, int] = {}  # user_id -> chat_id
+    for update in updates:
+        date = update_date(update)
+        if date is not None and date < cutoff:
+            CATCH_UP_UPDATES.labels("skipped").inc()
+            if update.message and update.message.chat.type == "private":
+                stale_chats[update.message.from_user.id] = update.message.chat_id
+            continue
+        fresh.append(update)
+
+    # Приоритет выбирает, чьи апдейты пойдут первыми, но не переставляет апдейты
+    # одного пользователя: его поздний /start не должен обогнать ранний черновик
+    groups: dict[object, list[Update]] = {}
+    for update in fresh:
+        groups.setdefault(update_key(update), []).append(update)
+    ordered = sorted(groups.items(), key=lambda item: min(map(catch_up_priority, item[1])))
+
+    scheduler = UserScheduler(CATCH_UP_CONCURRENCY, UPDATE_BACKLOG)
+    application.bot_data["catching_up"] = True
+    try:
+        for key, group in ordered:
+            for update in group:
+                CATCH_UP_UPDATES.labels("processed").inc()
+                await scheduler.submit(key, partial(Application.process_update, application, update))
+        for user_id, chat_id in stale_chats.items():
+            notify = partial(application.bot.send_message, chat_id=chat_id, text=STALE_NOTICE, reply_markup=MAIN_MENU)
+            await scheduler.submit(user_id, notify)
+        await scheduler.join()
+    finally:
+        application.bot_data["catching_up"] = False
+    logger.info(
+        "После перезапуска обработано %s апдейтов, пропущено %s (уведомлено %s пользователей) за %.2f с",
+        len(fresh), len(updates) - len(fresh), len(stale_chats), time.perf_counter() - began,
+    )
+
+# ---------- Webhook-сервер ----------
+class TelegramWebhookHandler(tornado.web.RequestHandler):
+    """Принимает апдейты от Telegram и кладёт их в очередь приложения."""
+
+    def initialize(self, bot_app: Application):
+        self.bot_app = bot_app
+
+    async def post(self):
+        # Без секрета webhook не запускается (см. main), так что проверка обязательна
+        secret = self.request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not WEBHOOK_SECRET or not hmac.compare_digest(secret, WEBHOOK_SECRET):
+            raise tornado.web.HTTPError(403)
+        try:
+            data = json.loads(self.request.body)
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        await self.bot_app.update_queue.put(Update.de_json(data, self.bot_app.bot))
+
+class HealthHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write("Mrush1 Bot is running")
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", CONTENT_TYPE_LATEST)
+        self.write(generate_latest())
+
+class ReadinessHandler(tornado.web.RequestHandler):
+    def initialize(self, bot_apps: list[Application]):
+        self.bot_apps = bot_apps
+
+    def get(self):
+        if not all(bot_app.running for bot_app in self.bot_apps):
+            raise tornado.web.HTTPError(503)
+        self.write("ready")
+
+def make_web_app(applications: list[Application], webhooks: bool = True) -> tornado.web.Application:
+    """Health, readiness и метрики; при webhooks — ещё и свой путь webhook у каждого магазина."""
+    routes = [
+        (application.bot_data["shop"].webhook_path, TelegramWebhookHandler, {"bot_app": application})
+        for application in applications
+    ] if webhooks else []
+    return tornado.web.Application(routes + [
+        (r"/", HealthHandler),
+        (r"/ready", ReadinessHandler, {"bot_apps": applications}),
+        (r"/metrics", MetricsHandler),
+    ])
+
+def stop_signal() -> asyncio.Event:
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    return stop_event
+
+async def stop_applications(applications: list[Application]):
+    """Останавливает все магазины, затем закрывает их ботов (общий HTTP-пул) и общие ресурсы."""
+    for application in applications:
+        if application.running:
+            if application.updater and application.updater.running:
+                await application.updater.stop()
+            await application.stop()
+            await application.post_stop(application)
+    for application in applications:
+        await application.shutdown()
+    shutdown_shared()
+
+async def start_applications(applications: list[Application], start_updates):
+    """
+    Запускает магазины параллельно, по фазам: getMe, post_init (индексы
+    восстанавливаются в фоне), приём апдейтов (start_updates(application)) и обработка.
+    """
+    await asyncio.gather(*(application.initialize() for application in applications))
+    startup.mark("initialize")
+    await asyncio.gather(*(application.post_init(application) for application in applications))
+    startup.mark("post_init")
+    await asyncio.gather(*(start_updates(application) for application in applications))
+    await asyncio.gather(*(application.start() for application in applications))
+    startup.mark("start")
+    TIME_TO_READY.set(time.perf_counter() - PROCESS_STARTED)
+    startup.report()
+
+async def set_webhook(application: Application):
+    await application.bot.set_webhook(
+        url=WEBHOOK_URL.rstrip("/") + application.bot_data["shop"].webhook_path,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=ALLOWED_UPDATES,
+        drop_pending_updates=not CATCH_UP,
+    )
+
+async def start_polling(application: Application):
+    await application.updater.start_polling(
+        allowed_updates=ALLOWED_UPDATES,
+        drop_pending_updates=not CATCH_UP,
+    )
+
+async def run_webhook(applications: list[Application]):
+    """
+    Один asyncio-процесс: HTTP-сервер на PORT принимает апдейты всех магазинов
+    и отвечает на health/readiness-проверки, PTB обрабатывает очереди апдейтов.
+    """
+    stop_event = stop_signal()
+    server = HTTPServer(make_web_app(applications))
+    server.listen(PORT)
+
+    try:
+        await start_applications(applications, set_webhook)
+        logger.info("Webhook-сервер слушает порт %s, магазинов: %s", PORT, len(applications))
+        await stop_event.wait()
+    finally:
+        server.stop()
+        await stop_applications(applications)
+
+async def run_polling(applications: list[Application]):
+    """
+    Long polling для каждого магазина в общем цикле событий; health, readiness
+    и метрики на PORT отдаёт тот же HTTP-сервер, что и в режиме webhook.
+    """
+    stop_event = stop_signal()
+    server = HTTPServer(make_web_app(applications, webhooks=False))
+    server.listen(PORT)
+
+    try:
+        await start_applications(applications, start_polling)
+        logger.info("Запуск polling, магазинов: %s", len(applications))
+        await stop_event.wait()
+    finally:
+        server.stop()
+        await stop_applications(applications)
+
+# ---------- main ----------
+def build_application(shop: Shop, request: HTTPXRequest | None = None, telegram_bot=None) -> Application:
+    """
+    Собирает приложение магазина с хендлерами. request — общий для магазинов HTTP-пул,
+    telegram_bot заменяет бота по токену магазина (для бенчмарков).
+    """
+    builder = Application.builder()
+    if telegram_bot is not None:
+        builder = builder.bot(telegram_bot)
+    else:
+        builder = (
+            builder
+            .token(shop.token)
+            .request(request or create_api_request())
+            .get_updates_request(create_updates_request())
+        )
+    if DRAFT_PERSISTENCE:
+        builder = builder.persistence(SQLitePersistence(DB_PATH, shop.name, DRAFT_TTL, DRAFT_FLUSH_INTERVAL))
+    application = (
+        builder
+        .application_class(UserOrderedApplication)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .build()
+    )
+    application.bot_data["shop"] = shop
+    shop.application = application
+
+    if FLOOD_CONTROL:
+        application.add_handler(TypeHandler(Update, flood_guard), group=-1)
     application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("search", search_command))
     application.add_handler(CallbackQueryHandler(callback_query_handler))
+    application.add_handler(ChatMemberHandler(chat_member_handler, ChatMemberHandler.CHAT_MEMBER))
     application.add_handler(
         MessageHandler(filters.TEXT | filters.PHOTO | filters.Document.IMAGE, handle_message)
     )
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = instrument_handler(handler.callback)
+
     application.add_error_handler(error_handler)
+    # Хранилище общее — сбрасываем его задачей одного (первого) магазина
+    if shop is shops[0]:
+        application.job_queue.run_repeating(flush_post_store, interval=POST_FLUSH_INTERVAL, first=POST_FLUSH_INTERVAL)
+    application.job_queue.run_repeating(sweep_post_ledger, interval=LEDGER_SWEEP_INTERVAL, first=LEDGER_SWEEP_INTERVAL)
+    application.job_queue.run_repeating(compact_search_index, interval=SEARCH_COMPACT_INTERVAL, first=SEARCH_COMPACT_INTERVAL)
+    application.job_queue.run_daily(release_deferred_posts, time=dtime(shop.start_hour, tzinfo=shop.timezone))
+    if DRAFT_PERSISTENCE:
+        application.job_queue.run_repeating(expire_drafts, interval=DRAFT_SWEEP_INTERVAL, first=DRAFT_SWEEP_INTERVAL)
+    return application
 
-    logger.info("Запуск polling (синхронный)...")
-    application.run_polling(
-        allowed_updates=Update.ALL_TYPES,
-        drop_pending_updates=True,
-    )
+def main():
+    # Один HTTP-пул на все магазины: соединения с api.telegram.org общие
+    request = create_api_request()
+    applications = [build_application(shop, request) for shop in shops]
+    startup.mark("build")
+
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL:
+            raise ValueError("Для режима webhook нужен WEBHOOK_URL!")
+        if not WEBHOOK_SECRET:
+            # Иначе любой, кто узнал адрес, может подсовывать апдейты от чужого имени
+            raise ValueError("Для режима webhook нужен WEBHOOK_SECRET!")
+        logger.info("Запуск в режиме webhook...")
+        asyncio.run(run_webhook(applications))
+        return
+
+    asyncio.run(run_polling(applications))
+
+# Конфигурация, хранилища, магазины и хендлеры готовы
+startup.mark("setup")
 
 if __name__ == "__main__":
     main()